@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Measures the time it takes to import modules in a new Django process (with
+the web settings), and the memory used by the process after the import
+(maximum resident set size), as each gunicorn worker does when it starts.
+
+By default it compares a process that only sets up Django, one that also
+imports the pipelines module (which sends tasks by name, as the web
+application does now) and one that also imports the workers of
+pypln.backend (as the pipelines module used to do). Usage:
+
+    python contrib/benchmark_imports.py [module ...]
+"""
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+DEFAULT_MODULES = [
+    'pypln.web.backend_adapter.pipelines',
+    'pypln.backend.workers',
+]
+
+MEASURE = """
+import json, resource, sys, time
+import django
+django.setup()
+start = time.time()
+try:
+    for module in sys.argv[1:]:
+        __import__(module)
+except ImportError as error:
+    print(json.dumps({'error': str(error)}))
+    sys.exit()
+elapsed = time.time() - start
+print(json.dumps({'seconds': elapsed,
+    'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+"""
+
+
+def measure(modules, repeat):
+    environment = dict(os.environ)
+    environment.setdefault('DJANGO_SETTINGS_MODULE', 'pypln.web.settings')
+    environment['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT,
+        environment.get('PYTHONPATH')]))
+    results = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', MEASURE] +
+                modules, env=environment)
+        result = json.loads(output.splitlines()[-1])
+        if 'error' in result:
+            raise ImportError(result['error'])
+        results.append(result)
+    return (min(result['seconds'] for result in results),
+            min(result['max_rss_kb'] for result in results))
+
+
+def main():
+    modules = sys.argv[1:] or DEFAULT_MODULES
+    repeat = 5
+    print('{:<50} {:>10} {:>12}'.format('imports', 'time (ms)', 'RSS (MB)'))
+    for index in range(len(modules) + 1):
+        imported = modules[:index]
+        try:
+            seconds, max_rss_kb = measure(imported, repeat)
+        except ImportError as error:
+            print('{} could not be imported: {}'.format(imported[-1], error))
+            break
+        print('{:<50} {:10.1f} {:12.1f}'.format(
+            ' + '.join(['django'] + imported), seconds * 1000,
+            max_rss_kb / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
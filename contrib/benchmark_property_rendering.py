@@ -0,0 +1,227 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Compares the time it takes to turn a stored analysis result into the JSON
+sent by PropertyDetail using the serializer (decoding BSON to Python objects,
+serializing them and rendering JSON) and converting the raw BSON straight to
+JSON, as a raw BSON path (with pymongo's `RawBSONDocument`) would do.
+
+The raw BSON path was measured and not shipped: the converter below has to
+be pure Python (there is no C transcoder), so it's only faster for small
+results, which are cheap anyway, and slower for big nested lists like
+`pos`. It also needs pymongo >= 3.2. Run this again to check whether that
+is still true before adding such a path.
+
+Both paths start from the raw BSON bytes, so the time spent fetching the
+document from MongoDB is not included. Usage:
+
+    python contrib/benchmark_property_rendering.py [number of tokens]
+"""
+import binascii
+import datetime
+import os
+import struct
+import sys
+import timeit
+from json.encoder import encode_basestring_ascii
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+settings.configure()
+
+from bson import BSON
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+
+# Converter from raw BSON to JSON
+
+_INT32 = struct.Struct('<i')
+_INT64 = struct.Struct('<q')
+_DOUBLE = struct.Struct('<d')
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class UnsupportedBSONType(ValueError):
+    pass
+
+
+if str is bytes:
+    # On Python 2 the encoder accepts UTF-8 encoded strings
+    _encode_string = encode_basestring_ascii
+else:
+    def _encode_string(data):
+        return encode_basestring_ascii(data.decode('utf-8')).encode('ascii')
+
+
+def _encode_float(value):
+    if value != value:
+        return b'NaN'
+    if value in (float('inf'), float('-inf')):
+        return b'Infinity' if value > 0 else b'-Infinity'
+    return repr(value).encode('ascii')
+
+
+def _encode_datetime(milliseconds):
+    # Same format used by rest_framework's JSONEncoder for naive datetimes
+    value = _EPOCH + datetime.timedelta(milliseconds=milliseconds)
+    representation = value.isoformat()
+    if value.microsecond:
+        representation = representation[:23] + representation[26:]
+    return _encode_string(representation.encode('ascii'))
+
+
+def _write_value(data, element_type, position, output):
+    """
+    Writes the JSON representation of the value that starts at `position`
+    to `output` and returns the position where the next element starts.
+    """
+    if element_type == b'\x02':
+        length = _INT32.unpack_from(data, position)[0]
+        start = position + 4
+        output.append(_encode_string(data[start:start + length - 1]))
+        return start + length
+    if element_type in (b'\x03', b'\x04'):
+        return _write_document(data, position, output,
+                is_array=element_type == b'\x04')
+    if element_type == b'\x10':
+        output.append(str(_INT32.unpack_from(data, position)[0]).encode(
+            'ascii'))
+        return position + 4
+    if element_type == b'\x12':
+        output.append(str(_INT64.unpack_from(data, position)[0]).encode(
+            'ascii'))
+        return position + 8
+    if element_type == b'\x01':
+        output.append(_encode_float(_DOUBLE.unpack_from(data, position)[0]))
+        return position + 8
+    if element_type == b'\x08':
+        output.append(b'true' if data[position:position + 1] == b'\x01'
+                else b'false')
+        return position + 1
+    if element_type == b'\x0a':
+        output.append(b'null')
+        return position
+    if element_type == b'\x07':
+        output.append(b'"' + binascii.hexlify(data[position:position + 12]) +
+                b'"')
+        return position + 12
+    if element_type == b'\x09':
+        output.append(_encode_datetime(_INT64.unpack_from(data,
+            position)[0]))
+        return position + 8
+    raise UnsupportedBSONType("BSON type {!r} can't be converted to "
+            "JSON.".format(element_type))
+
+
+def _write_document(data, position, output, is_array=False):
+    end = position + _INT32.unpack_from(data, position)[0] - 1
+    position += 4
+    output.append(b'[' if is_array else b'{')
+    first = True
+    append = output.append
+    find = data.index
+    unpack_int32 = _INT32.unpack_from
+    while position < end:
+        element_type = data[position:position + 1]
+        name_end = find(b'\x00', position + 1)
+        if first:
+            first = False
+        else:
+            append(b',')
+        # Array keys are just the indexes, so we skip them.
+        if not is_array:
+            append(_encode_string(data[position + 1:name_end]))
+            append(b':')
+        # Strings are by far the most common values in analysis results, so
+        # they're handled here instead of in `_write_value`.
+        if element_type == b'\x02':
+            start = name_end + 5
+            position = start + unpack_int32(data, name_end + 1)[0]
+            append(_encode_string(data[start:position - 1]))
+        else:
+            position = _write_value(data, element_type, name_end + 1, output)
+    append(b']' if is_array else b'}')
+    return end + 1
+
+
+
+def bson_value_to_json(data, name):
+    """
+    Converts the value of the top level key `name` of a raw BSON document to
+    JSON bytes. Raises `KeyError` if the key does not exist.
+    """
+    end = len(data) - 1
+    position = 4
+    while position < end:
+        element_type = data[position:position + 1]
+        name_end = data.index(b'\x00', position + 1)
+        if data[position + 1:name_end] == name.encode('utf-8'):
+            output = []
+            _write_value(data, element_type, name_end + 1, output)
+            return b''.join(output)
+        position = _write_value(data, element_type, name_end + 1, [])
+    raise KeyError(name)
+
+
+# Benchmark
+
+def build_document(size):
+    words = [u'Alice', u'was', u'beginning', u'to', u'get', u'very', u'tired',
+            u'of', u'sitting', u'by', u'her', u'sister', u'a\xe7\xe3o', u'.']
+    tokens = [words[index % len(words)] for index in range(size)]
+    return {
+        'tokens': tokens,
+        'pos': [[token, u'NN', index] for index, token in enumerate(tokens)],
+        'freqdist': [[word, size // len(words)] for word in words],
+    }
+
+
+def default_path(raw, name):
+    document = BSON(raw).decode()
+
+    class PropertySerializer(serializers.Serializer):
+        value = serializers.SerializerMethodField()
+
+        def get_value(self, obj):
+            return obj[name]
+
+    return JSONRenderer().render(PropertySerializer(document).data)
+
+
+def raw_bson_path(raw, name):
+    return b'{"value":' + bson_value_to_json(raw, name) + b'}'
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeat = 5
+    for name, value in sorted(build_document(size).items()):
+        raw = BSON.encode({name: value})
+        print('{} ({} items, {} bytes of BSON)'.format(name, len(value),
+            len(raw)))
+        for label, function in (('default', default_path),
+                ('raw bson', raw_bson_path)):
+            best = min(timeit.repeat(lambda: function(raw, name), number=1,
+                repeat=repeat))
+            print('    {:<10} {:8.2f} ms'.format(label, best * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3 @@
+-- Adds the pipeline chosen by each corpus (see the ANALYSIS_PIPELINES
+-- setting). Existing corpora keep using the default pipeline.
+ALTER TABLE core_corpus ADD COLUMN pipeline varchar(50) NOT NULL DEFAULT 'default';
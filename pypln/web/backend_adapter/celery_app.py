@@ -0,0 +1,31 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import os
+
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pypln.web.settings')
+
+# Sends tasks to the workers by name, so it's configured by the `BROKER_URL`
+# and `CELERY_*` Django settings. The only tasks it runs are `finish_stages`
+# and `fail_stages`, in a worker started with:
+#
+#     celery -A pypln.web.backend_adapter.celery_app worker -Q pipelines.finished
+app = Celery('pypln.web')
+app.config_from_object('django.conf:settings')
@@ -0,0 +1,79 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import uuid
+
+from django.db import models
+from django.utils import timezone
+
+
+def new_request_key():
+    return uuid.uuid4().hex
+
+
+class PipelineRequest(models.Model):
+    """
+    A pipeline that must be sent to the broker for a document. Requests are
+    saved in the same transaction as the document, and sent later by
+    `pypln.web.backend_adapter.pipelines.dispatch_pipelines`, so saving a
+    document does not depend on the broker.
+
+    `stages` has the comma separated names of the workers that should run,
+    or is null to run the default pipeline. The `key` is recorded in the
+    analysis when the pipeline is sent, so a request is never sent twice.
+    `claim` identifies the dispatcher that is sending the request. Requests in
+    the interactive `lane` (single uploads) are sent before the ones in the
+    bulk lane (bulk uploads and reprocessing), to another queue.
+    `finished_at` is set when the analysis is found to be finished (by
+    `pypln.web.webhooks.delivery.collect_notifications`).
+    """
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    )
+    INTERACTIVE = 'interactive'
+    BULK = 'bulk'
+    LANE_CHOICES = (
+        (INTERACTIVE, 'Interactive'),
+        (BULK, 'Bulk'),
+    )
+
+    document = models.ForeignKey('core.Document')
+    key = models.CharField(max_length=32, unique=True,
+            default=new_request_key)
+    stages = models.TextField(null=True, blank=True)
+    force = models.BooleanField(default=False)
+    lane = models.CharField(max_length=20, choices=LANE_CHOICES,
+            default=INTERACTIVE, db_index=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+            default=PENDING, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now,
+            db_index=True)
+    claim = models.CharField(max_length=32, blank=True, db_index=True)
+    sent_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    finished_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    last_error = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return u'{} ({})'.format(self.document, self.status)
@@ -16,41 +16,621 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+from collections import namedtuple
+import datetime
+
 from bson import ObjectId
-from celery import group
+from celery import group, signature
+from celery.backends.base import DisabledBackend
+# The canvas classes are also imported under other names, so `route`
+# keeps working when tests replace `group` or `chain` in this module.
+from celery.canvas import Signature, chain as Chain, group as Group
 from django.conf import settings
-from pypln.backend.workers import *
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Count, Min
+from django.utils import timezone
+from pypln.web.backend_adapter.celery_app import app
+from pypln.web.backend_adapter.models import PipelineRequest, new_request_key
 from pypln.web.core.models import mongodb_storage
+from pypln.web.core.mongodb import connection_manager
+
+# Names of the Celery tasks of the workers (in pypln.backend). Tasks are sent
+# by name, so the web application doesn't import the workers.
+WORKER_TASKS = {
+    'Extractor': 'pypln.backend.workers.extractor.Extractor',
+    'Tokenizer': 'pypln.backend.workers.tokenizer.Tokenizer',
+    'PalavrasRaw': 'pypln.backend.workers.palavras_raw.PalavrasRaw',
+    'POS': 'pypln.backend.workers.pos.POS',
+    'Lemmatizer': 'pypln.backend.workers.lemmatizer_pt.Lemmatizer',
+    'NounPhrase': 'pypln.backend.workers.palavras_noun_phrase.NounPhrase',
+    'SemanticTagger':
+        'pypln.backend.workers.palavras_semantic_tagger.SemanticTagger',
+    'FreqDist': 'pypln.backend.workers.freqdist.FreqDist',
+    'Statistics': 'pypln.backend.workers.statistics.Statistics',
+    'ElasticIndexer': 'pypln.backend.workers.elastic_indexer.ElasticIndexer',
+}
+
+# A stage of the analysis runs `worker` after the stage named in `after` is
+# done, and stores `properties` in the analysis record.
+Stage = namedtuple('Stage', ['worker', 'after', 'properties'])
+
+# The default pipeline. Stages must come after the stages they depend on.
+STAGES = (
+    Stage('Extractor', None, ('text', 'file_metadata', 'language',
+        'mimetype', 'forced_decoding')),
+    Stage('Tokenizer', 'Extractor', ('tokens', 'sentences')),
+    Stage('PalavrasRaw', 'Tokenizer', ('palavras_raw_ran', )),
+    Stage('POS', 'PalavrasRaw', ('pos', 'tagset')),
+    # These only store results when palavras is available, so missing
+    # results don't mean they need to run.
+    Stage('Lemmatizer', 'PalavrasRaw', ()),
+    Stage('NounPhrase', 'PalavrasRaw', ()),
+    Stage('SemanticTagger', 'PalavrasRaw', ()),
+    Stage('FreqDist', 'Tokenizer', ('freqdist', )),
+    Stage('Statistics', 'FreqDist', ('average_sentence_length',
+        'average_sentence_repertoire', 'momentum_1', 'momentum_2',
+        'momentum_3', 'momentum_4', 'repertoire')),
+)
+
+# States of the stages of the analysis of a document. The dispatcher records
+# the stages it sends as queued in the `_status` key of the analysis.
+# `finish_stages` records each stage as done when it finishes, and the stages
+# that depend on it as running (they've been sent to the workers), and
+# `fail_stages` records a stage that failed, and the stages that depend on it,
+# as failed. Stages that were not requested (because the pipeline of the
+# document doesn't include them) are skipped.
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+STATES = (QUEUED, RUNNING, DONE, FAILED, SKIPPED)
+
+def resolve_stages(workers):
+    """
+    Returns the stages of the given workers and of every stage they depend
+    on, in the order they must run. Raises `ValueError` if a worker is
+    unknown.
+    """
+    stages = {stage.worker: stage for stage in STAGES}
+    needed = set()
+    for worker in workers:
+        if worker not in stages:
+            raise ValueError("Unknown worker: {}".format(worker))
+        while worker is not None and worker not in needed:
+            needed.add(worker)
+            worker = stages[worker].after
+    return [stage for stage in STAGES if stage.worker in needed]
+
+def stages_for_analyses(analyses):
+    """
+    Returns the stages needed to produce the given analysis results (such as
+    `tokens` or `freqdist`). Raises `ValueError` if one of them is not
+    produced by any stage.
+    """
+    workers = []
+    for name in analyses:
+        producers = [stage.worker for stage in STAGES if name in
+                stage.properties]
+        if not producers:
+            raise ValueError("Unknown analysis: {}".format(name))
+        workers.extend(producers)
+    return resolve_stages(workers)
+
+def get_pipeline_stages(name):
+    """
+    Returns the stages of the pipeline with the given name, as defined in the
+    `ANALYSIS_PIPELINES` setting. Raises `KeyError` if there's no such
+    pipeline and `ImproperlyConfigured` if it has unknown workers or workers
+    without the stages they depend on.
+    """
+    workers = settings.ANALYSIS_PIPELINES[name]
+    try:
+        stages = resolve_stages(workers)
+    except ValueError as exc:
+        raise ImproperlyConfigured("Invalid pipeline {}: {}".format(name,
+            exc))
+    if len(stages) != len(set(workers)):
+        missing = [stage.worker for stage in stages if stage.worker not in
+                workers]
+        raise ImproperlyConfigured("Pipeline {} requires {}.".format(name,
+            ', '.join(missing)))
+    return stages
+
+def requested_stages(corpus, stages=None):
+    """
+    Returns the stages that should run for a new document in `corpus`: the
+    given ones (for example, from `stages_for_analyses`) or, if none are
+    given, the ones in the pipeline of the corpus. Returns None if these are
+    all the stages (the default pipeline).
+    """
+    if not stages:
+        stages = get_pipeline_stages(corpus.pipeline)
+    if len(stages) == len(STAGES):
+        return None
+    return stages
+
+def worker_signature(worker, doc_id):
+    """
+    Returns an (immutable) signature of the task of the given worker for a
+    document.
+    """
+    return signature(WORKER_TASKS[worker], args=(doc_id, ), immutable=True,
+            app=app)
+
+@app.task(ignore_result=True)
+def finish_stages(doc_id, workers, started=()):
+    """
+    Records the stages of the given workers as done (and the `started` ones
+    as running) in the analysis of a document, records when its results were
+    last changed in `_updated` and increments its `_version`, so the cached
+    results and the ETags of the analysis are renewed (results may have been
+    replaced without changing their names).
+    """
+    finished_at = datetime.datetime.utcnow()
+    changes = {'_status.{}'.format(worker): {'state': DONE, 'at': finished_at}
+            for worker in workers}
+    changes['_updated'] = finished_at
+    changes.update({'_status.{}'.format(worker): {'state': RUNNING,
+        'at': finished_at} for worker in started})
+    connection_manager.collection().update({'_id': doc_id},
+            {'$set': changes, '$inc': {'_version': 1}})
 
-def call_default_pipeline(doc_id):
-    palavras_dependent_tasks = group(
-        POS().si(doc_id), Lemmatizer().si(doc_id),
-        NounPhrase().si(doc_id), SemanticTagger().si(doc_id)
-    )
+def task_error(task_id):
+    """
+    Returns a description of the error of a failed task: its exception, if
+    there's a result backend to get it from, or its id otherwise (so it can
+    be found in the logs of the workers).
+    """
+    if not isinstance(app.backend, DisabledBackend):
+        exception = app.AsyncResult(task_id).result
+        if exception is not None:
+            return repr(exception)
+    return "Task {} failed.".format(task_id)
 
-    (Extractor().si(doc_id) | Tokenizer().si(doc_id) |
-        group(
-            (PalavrasRaw().si(doc_id) | palavras_dependent_tasks),
-            (FreqDist().si(doc_id) | group(Statistics().si(doc_id)))
-        )
-    )()
+@app.task(ignore_result=True)
+def fail_stages(task_id, doc_id, worker, dependants=()):
+    """
+    Records the stage of the given worker as failed in the analysis of a
+    document, with the error of its task (`task_id`), and the stages that
+    depend on it as failed too, since they won't run. This is the errback of
+    the tasks of the workers, so Celery passes it the id of the failed task
+    as the first argument.
+    """
+    failed_at = datetime.datetime.utcnow()
+    changes = {'_status.{}'.format(worker): {'state': FAILED,
+        'at': failed_at, 'error': task_error(task_id)}}
+    changes.update({'_status.{}'.format(dependant): {'state': FAILED,
+        'at': failed_at, 'error': "{} failed.".format(worker)}
+        for dependant in dependants})
+    connection_manager.collection().update({'_id': doc_id},
+            {'$set': changes})
 
-def create_pipeline_from_document(doc):
-    call_default_pipeline(ObjectId(doc.blob.name))
+def build_pipeline(doc_id, stages=STAGES):
+    """
+    Builds a canvas that runs the given stages for a document. Each stage runs
+    after the stage it depends on, if this stage is also given, and stages
+    that depend on the same stage run in parallel. Each stage is followed by
+    `finish_stages` and has `fail_stages` as its errback, both sent to
+    `PIPELINE_FINISHED_QUEUE`, so its state is recorded as soon as it
+    finishes or fails.
+    """
+    names = set(stage.worker for stage in stages)
+    dependants = {}
+    for stage in stages:
+        dependants.setdefault(stage.after if stage.after in names else None,
+                []).append(stage)
+
+    def after(worker):
+        workers = []
+        for stage in dependants.get(worker, []):
+            workers.append(stage.worker)
+            workers.extend(after(stage.worker))
+        return workers
+
+    def build(stages):
+        canvases = []
+        for stage in stages:
+            next_stages = dependants.get(stage.worker, [])
+            canvas = worker_signature(stage.worker, doc_id)
+            canvas.link_error(fail_stages.s(doc_id, stage.worker,
+                after(stage.worker)).set(
+                    queue=settings.PIPELINE_FINISHED_QUEUE))
+            canvas = canvas | finish_stages.si(doc_id, [stage.worker],
+                    [next_stage.worker for next_stage in next_stages]).set(
+                            queue=settings.PIPELINE_FINISHED_QUEUE)
+            if next_stages:
+                canvas = canvas | build(next_stages)
+            canvases.append(canvas)
+        if len(canvases) == 1:
+            return canvases[0]
+        return group(canvases)
+
+    return build(dependants[None])
+
+def route(canvas, lane):
+    """
+    Sends every task of a canvas to the queue of the given lane (in the
+    `PIPELINE_QUEUES` setting). Tasks that already have a queue (like
+    `finish_stages`) keep it. Returns the canvas.
+    """
+    if isinstance(canvas, (Chain, Group)):
+        for task in canvas.tasks:
+            route(task, lane)
+    elif isinstance(canvas, Signature) and 'queue' not in canvas.options:
+        canvas.set(queue=settings.PIPELINE_QUEUES[lane])
+    return canvas
+
+def default_pipeline(doc_id):
+    return build_pipeline(doc_id)
+
+def is_stale(stage, keys, worker_versions):
+    current_version = settings.PIPELINE_WORKER_VERSIONS.get(stage.worker)
+    if stage.worker in worker_versions and current_version is not None:
+        return worker_versions[stage.worker] != current_version
+    return any(name not in keys for name in stage.properties)
+
+def plan_pipelines(docs):
+    """
+    Finds out which stages need to run for each one of the given documents,
+    without fetching their analysis results: the stages with missing results
+    or whose results were produced by another version of the worker (as
+    recorded by the workers in the `_worker_versions` key of the analysis,
+    compared with the `PIPELINE_WORKER_VERSIONS` setting), and every stage
+    that depends on them. Returns a dict that maps each document blob name to
+    a (possibly empty) list of stages.
+    """
+    analyses = mongodb_storage.get_keys([doc.blob.name for doc in docs],
+            ['_worker_versions'])
+    plans = {}
+    for doc in docs:
+        analysis = analyses.get(doc.blob.name, {})
+        keys = set(analysis.get('keys', []))
+        worker_versions = analysis.get('_worker_versions', {})
+        stale = set()
+        for stage in STAGES:
+            if stage.after in stale or is_stale(stage, keys, worker_versions):
+                stale.add(stage.worker)
+        plans[doc.blob.name] = [stage for stage in STAGES
+                if stage.worker in stale]
+    return plans
+
+def queued_status(stages, at):
+    """
+    Returns the changes that record the given stages as queued in an
+    analysis.
+    """
+    return {'_status.{}'.format(stage.worker): {'state': QUEUED, 'at': at}
+            for stage in stages}
+
+def analysis_status(analysis):
+    """
+    Works out the state of each stage of an analysis (as returned by
+    `get_keys`, with the `_status` and `_modified` fields). Recorded states
+    are used as they are, so stages sent again stay queued until they're
+    done, even if they have results from the previous run. Stages without a
+    recorded state are done if their results are available (or, for stages
+    without results, if the stage they depend on is done), skipped if the
+    status of other stages was recorded but not theirs, and queued otherwise.
+    Skipped stages don't count for the overall state. Returns a dict with the
+    overall `state`, the `stages` and when the analysis was last sent
+    (`modified_at`).
+    """
+    keys = set(analysis.get('keys', []))
+    # Analyses sent before the status was recorded ran every stage.
+    recorded_status = analysis.get('_status')
+    pipeline_is_known = recorded_status is not None
+    recorded_status = recorded_status or {}
+    states = {}
+    stages = []
+    for stage in STAGES:
+        status = dict(recorded_status.get(stage.worker, {}))
+        if status.get('state') not in STATES:
+            if stage.properties:
+                done = all(name in keys for name in stage.properties)
+            else:
+                done = states.get(stage.after) == DONE
+            if done:
+                status['state'] = DONE
+            elif pipeline_is_known and stage.worker not in recorded_status:
+                status['state'] = SKIPPED
+            else:
+                status['state'] = QUEUED
+        status['name'] = stage.worker
+        if status['state'] != SKIPPED:
+            states[stage.worker] = status['state']
+        stages.append(status)
+
+    if FAILED in states.values():
+        state = FAILED
+    elif RUNNING in states.values():
+        state = RUNNING
+    elif all(stage_state == DONE for stage_state in states.values()):
+        state = DONE
+    else:
+        state = QUEUED
+    return {'state': state, 'stages': stages,
+            'modified_at': analysis.get('_modified')}
+
+def get_analysis_status(blob_names):
+    """
+    Returns a dict that maps each one of the given blob names to the status
+    of its analysis (see `analysis_status`), using a single query.
+    """
+    analyses = mongodb_storage.get_keys(list(set(blob_names)),
+            ['_status', '_modified'])
+    return {name: analysis_status(analyses.get(name, {})) for name in
+            blob_names}
+
+def summarize_status(statuses):
+    """
+    Counts the documents in each state, overall and for each stage, given
+    their statuses.
+    """
+    summary = {
+        'documents': len(statuses),
+        'states': dict.fromkeys(STATES, 0),
+        'stages': {stage.worker: dict.fromkeys(STATES, 0) for stage in
+            STAGES},
+    }
+    for status in statuses:
+        summary['states'][status['state']] += 1
+        for stage in status['stages']:
+            summary['stages'][stage['name']][stage['state']] += 1
+    return summary
+
+def enqueue_pipelines(docs, stages=None, force=False,
+        lane=PipelineRequest.INTERACTIVE):
+    """
+    Saves requests to send the pipelines for the given documents to the
+    queue of the given lane. If `stages` is given (e.g. by `plan_pipelines`),
+    only these stages run. They're sent by `dispatch_pipelines`, so this
+    should be called in the same transaction that saves the documents.
+
+    Documents with the same contents share their analysis (see
+    `MongoDBBase64Storage`), so unless `force` is True, nothing is sent if
+    the same stages were already sent for this analysis.
+    """
+    if stages is not None:
+        stages = ','.join(stage.worker for stage in stages)
+    PipelineRequest.objects.bulk_create([PipelineRequest(document=doc,
+        stages=stages, force=force, lane=lane) for doc in docs])
+
+def enqueue_pipeline(doc, stages=None, force=False,
+        lane=PipelineRequest.INTERACTIVE):
+    enqueue_pipelines([doc], stages, force, lane)
+
+def fair_share(pending, limit):
+    """
+    Picks the ids of at most `limit` of the given pending requests, sharing
+    them equally between the owners of the documents (the ones that have been
+    waiting longer first), so a user with many requests doesn't delay the
+    others. If some owners don't have enough requests, the rest is filled
+    with the oldest requests.
+    """
+    if limit <= 0:
+        return []
+    owners = [row['document__owner'] for row in
+            pending.values('document__owner').annotate(oldest=Min('id'))
+            .order_by('oldest')[:limit]]
+    if not owners:
+        return []
+    quota = max(1, limit // len(owners))
+    ids = []
+    for owner in owners:
+        ids.extend(pending.filter(document__owner=owner).order_by('id')
+                .values_list('id', flat=True)[:quota])
+    if len(ids) < limit:
+        ids.extend(pending.exclude(id__in=ids).order_by('id').values_list(
+            'id', flat=True)[:limit - len(ids)])
+    return ids
+
+def claim_pipeline_requests(batch_size):
+    """
+    Marks at most `batch_size` pending requests as being sent by this
+    dispatcher, for `PIPELINE_DISPATCH_LEASE` seconds (after that, another
+    dispatcher may send them). Returns the claimed requests.
+
+    Interactive requests are claimed first, but at least
+    `PIPELINE_BULK_SHARE` of the batch is left for bulk requests (if there
+    are any). In each lane, the batch is shared between users (see
+    `fair_share`).
+    """
+    now = timezone.now()
+    pending = PipelineRequest.objects.filter(status=PipelineRequest.PENDING,
+            next_attempt_at__lte=now)
+    reserved = int(batch_size * settings.PIPELINE_BULK_SHARE)
+    ids = fair_share(pending.filter(lane=PipelineRequest.INTERACTIVE),
+            batch_size - reserved)
+    ids += fair_share(pending.filter(lane=PipelineRequest.BULK),
+            batch_size - len(ids))
+    claim = new_request_key()
+    pending.filter(id__in=ids).update(claim=claim, next_attempt_at=now +
+            datetime.timedelta(seconds=settings.PIPELINE_DISPATCH_LEASE))
+    return list(PipelineRequest.objects.filter(claim=claim).select_related(
+        'document').order_by('id'))
+
+def retry_later(requests, error):
+    for request in requests:
+        request.attempts += 1
+        request.last_error = error
+        if request.attempts >= settings.PIPELINE_DISPATCH_MAX_ATTEMPTS:
+            request.status = PipelineRequest.FAILED
+        else:
+            delay = settings.PIPELINE_DISPATCH_RETRY_DELAY * 2 ** (
+                    request.attempts - 1)
+            request.next_attempt_at = timezone.now() + datetime.timedelta(
+                    seconds=delay)
+        request.save()
+
+def was_requested(analysis, stages):
+    """
+    Tells if the given stages were already sent for an analysis (possibly for
+    another document with the same contents).
+    """
+    if '_modified' not in analysis:
+        return False
+    # Analyses sent before the status was recorded ran every stage.
+    if '_status' not in analysis:
+        return True
+    return all(stage.worker in analysis['_status'] for stage in stages)
+
+def dispatch_pipelines(batch_size=None):
+    """
+    Sends a batch of pending pipeline requests to the broker as a single
+    group. Requests for documents that share an analysis for which the same
+    stages were already sent are skipped (unless they're forced), as are
+    requests whose key was already recorded in the analysis. Requests that
+    can't be sent are tried again later. Returns the number of requests
+    handled.
+    """
+    batch_size = batch_size or settings.PIPELINE_DISPATCH_BATCH_SIZE
+    requests = claim_pipeline_requests(batch_size)
+    if not requests:
+        return 0
+
+    stages = {stage.worker: stage for stage in STAGES}
+    doc_ids = [ObjectId(request.document.blob.name) for request in requests]
+    analyses = {analysis['_id']: analysis for analysis in
+            connection_manager.collection().find({'_id': {'$in': doc_ids}},
+                {'_modified': True, '_pipeline_requests': True,
+                    '_status': True})}
+    to_send = []
+    canvases = []
+    skipped = []
+    request_stages = {}
+    for request, doc_id in zip(requests, doc_ids):
+        analysis = analyses.get(doc_id)
+        if analysis is None:
+            request.status = PipelineRequest.FAILED
+            request.last_error = "The analysis does not exist."
+            request.save()
+            continue
+
+        if request.stages is None:
+            request_stages[request.id] = STAGES
+        else:
+            request_stages[request.id] = [stages[name] for name in
+                    request.stages.split(',')]
+        if request.key in analysis.get('_pipeline_requests', []) or (
+                not request.force and
+                was_requested(analysis, request_stages[request.id])):
+            skipped.append(request.id)
+            continue
+
+        if request.stages is None:
+            canvas = default_pipeline(doc_id)
+        else:
+            canvas = build_pipeline(doc_id, request_stages[request.id])
+        canvases.append(route(canvas, request.lane))
+        to_send.append((request, doc_id))
+        # Other requests for the same analysis in this batch don't need to be
+        # sent.
+        analysis['_modified'] = True
+        analysis.setdefault('_status', {}).update((stage.worker, {})
+                for stage in request_stages[request.id])
+
+    if canvases:
+        try:
+            group(canvases)()
+        except Exception as exc:
+            retry_later([request for request, doc_id in to_send], repr(exc))
+            to_send = []
+
+    modified_at = datetime.datetime.utcnow()
+    # The cached properties don't need to be invalidated here (this process
+    # doesn't know their keys): only complete analyses are cached, and their
+    # keys include the `_version` that `finish_stages` increments when new
+    # results are stored, so old entries are not used again and expire.
+    for request, doc_id in to_send:
+        changes = queued_status(request_stages[request.id], modified_at)
+        changes['_modified'] = modified_at
+        connection_manager.collection().update({'_id': doc_id},
+                {'$set': changes,
+                 '$addToSet': {'_pipeline_requests': request.key}})
+    PipelineRequest.objects.filter(id__in=skipped + [request.id for request,
+        doc_id in to_send]).update(status=PipelineRequest.SENT,
+                sent_at=timezone.now())
+    return len(requests)
+
+def broker_queue_size(queue):
+    """
+    Returns the number of messages in a queue of the broker, or None if it
+    can't be found out.
+    """
+    connection = app.connection(
+            connect_timeout=settings.PIPELINE_BROKER_TIMEOUT)
+    try:
+        connection.connect()
+        return connection.default_channel.queue_declare(queue=queue,
+                passive=True).message_count
+    except Exception:
+        return None
+    finally:
+        connection.release()
+
+def queue_depths():
+    """
+    Returns, for each lane, the name of its `queue`, the number of requests
+    waiting to be sent by the dispatcher (`pending`) and the number of tasks
+    waiting in the broker (`queued`, None if unknown).
+    """
+    pending = dict(PipelineRequest.objects.filter(
+        status=PipelineRequest.PENDING).values_list('lane').annotate(
+            Count('id')).order_by())
+    return {lane: {
+        'queue': settings.PIPELINE_QUEUES[lane],
+        'pending': pending.get(lane, 0),
+        'queued': broker_queue_size(settings.PIPELINE_QUEUES[lane]),
+    } for lane, _ in PipelineRequest.LANE_CHOICES}
+
+def refresh_backlog():
+    """
+    Counts the pipelines waiting to be sent or processed, in every lane (see
+    `queue_depths`), and stores the count in the `THROTTLE_CACHE_ALIAS`
+    cache: for `PIPELINE_BACKLOG_CACHE_TIMEOUT` seconds as the current
+    backlog, and as the last known one until it's counted again. The
+    dispatcher calls it regularly, so requests don't need to count it. Returns
+    the count.
+    """
+    backlog = sum(depths['pending'] + (depths['queued'] or 0) for depths in
+            queue_depths().values())
+    cache = caches[settings.THROTTLE_CACHE_ALIAS]
+    cache.set('pipeline-backlog', backlog,
+            settings.PIPELINE_BACKLOG_CACHE_TIMEOUT)
+    cache.set('pipeline-backlog-last', backlog, None)
+    return backlog
+
+def get_backlog():
+    """
+    Returns the number of pipelines waiting to be sent or processed, as
+    counted by `refresh_backlog`. If the count expired (because the
+    dispatcher isn't running or doesn't share the cache), a single process
+    counts it again while the others use the last known count (or 0, if it
+    was never counted), so concurrent requests don't all ask the broker.
+    """
+    cache = caches[settings.THROTTLE_CACHE_ALIAS]
+    backlog = cache.get('pipeline-backlog')
+    if backlog is not None:
+        return backlog
+    if cache.add('pipeline-backlog-lock', True,
+            settings.PIPELINE_BACKLOG_CACHE_TIMEOUT):
+        try:
+            return refresh_backlog()
+        finally:
+            cache.delete('pipeline-backlog-lock')
+    return cache.get('pipeline-backlog-last', 0)
 
 def create_indexing_pipeline(doc):
+    # The index name and document type only apply to this document, so they
+    # can't be added to an analysis shared with other documents.
+    private_name = mongodb_storage.make_private(doc.blob.name)
+    if private_name != doc.blob.name:
+        doc.blob.name = private_name
+        doc.save()
     doc_id = ObjectId(doc.blob.name)
-    mongodb_storage.collection.update({'_id': doc_id}, {"$set":
+    connection_manager.collection().update({'_id': doc_id}, {"$set":
             {"index_name": doc.index_name, "doc_type": doc.doc_type}})
-    (Extractor().si(doc_id) | ElasticIndexer().si(doc_id))()
-
-def get_config_from_router(api, timeout=5):
-    client = Client()
-    client.connect(api)
-    client.send_api_request({'command': 'get configuration'})
-    if client.api_poll(timeout):
-        result = client.get_api_reply()
-    else:
-        result = None
-    client.disconnect()
-    return result
+    (worker_signature('Extractor', doc_id) |
+            worker_signature('ElasticIndexer', doc_id))()
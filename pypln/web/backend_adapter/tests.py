@@ -16,32 +16,89 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import datetime
 from StringIO import StringIO
+import unittest
 
 from bson import ObjectId
+from celery import chain, group
 from django.core.files import File
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.contrib.auth.models import User
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
 from mock import patch
 
+from pypln.web.backend_adapter.celery_app import app
+from pypln.web.backend_adapter.models import PipelineRequest
 from pypln.web.backend_adapter.pipelines import (create_indexing_pipeline,
-        call_default_pipeline, create_pipeline_from_document)
-from pypln.web.core.models import IndexedDocument, Document, mongodb_storage
+        default_pipeline, plan_pipelines, STAGES, WORKER_TASKS, enqueue_pipeline, dispatch_pipelines,
+        get_pipeline_stages, requested_stages, resolve_stages,
+        stages_for_analyses, build_pipeline, claim_pipeline_requests,
+        enqueue_pipelines, queue_depths, route, finish_stages, fail_stages)
+from pypln.web.core.models import Corpus, IndexedDocument, Document, mongodb_storage
 from pypln.web.core.tests.utils import TestWithMongo
 
+try:
+    from pypln.backend import workers as backend_workers
+except ImportError:
+    backend_workers = None
 
-__all__ = ["CreatePipelineTest", "CreateIndexingPipelineTest",
-    "CreatePipelineFromDocumentTest"]
+
+__all__ = ["CreatePipelineTest", "FinishStagesTest", "CreateIndexingPipelineTest",
+    "PlanPipelinesTest",
+    "DispatchPipelinesTest", "PipelineDefinitionTest", "LanesTest"]
 
 class CreatePipelineTest(TestWithMongo):
 
-    @patch('pypln.web.backend_adapter.pipelines.Extractor', autospec=True)
-    def test_should_create_pipelines_for_document(self, extractor):
+    @patch('pypln.web.backend_adapter.pipelines.signature')
+    def test_should_create_pipelines_for_document(self, signature):
         _id = ObjectId("123456789012")
-        call_default_pipeline(_id)
-        extractor.assert_called_with()
-        extractor.return_value.si.assert_called_with(_id)
+        default_pipeline(_id)
+        signature.assert_any_call(WORKER_TASKS['Extractor'], args=(_id, ),
+                immutable=True, app=app)
+        self.assertEqual(signature.call_count, len(STAGES))
+
+    @unittest.skipUnless(backend_workers, "pypln.backend is not installed")
+    def test_task_names_match_the_workers(self):
+        for worker, task_name in WORKER_TASKS.items():
+            self.assertEqual(getattr(backend_workers, worker).name, task_name)
+
+
+class FinishStagesTest(TestWithMongo):
+    fixtures = ['users', 'corpora', 'documents']
+
+    def setUp(self):
+        self.doc_id = ObjectId(Document.objects.all()[0].blob.name)
+        mongodb_storage.collection.update({'_id': self.doc_id}, {'$set': {
+            '_status': {'Extractor': {'state': 'queued'},
+                'Tokenizer': {'state': 'queued'},
+                'FreqDist': {'state': 'queued'}}}})
+
+    def status(self):
+        return mongodb_storage.collection.find_one({'_id': self.doc_id})[
+                '_status']
+
+    def test_records_the_stages_as_done_and_increments_the_version(self):
+        finish_stages(self.doc_id, ['Extractor'], ['Tokenizer'])
+        self.assertEqual(self.status()['Tokenizer']['state'], 'running')
+        finish_stages(self.doc_id, ['Tokenizer'])
+        analysis = mongodb_storage.collection.find_one({'_id': self.doc_id})
+        self.assertEqual(analysis['_version'], 2)
+        self.assertIn('_updated', analysis)
+        self.assertEqual(analysis['_status']['Extractor']['state'], 'done')
+        self.assertEqual(analysis['_status']['Tokenizer']['state'], 'done')
+
+    def test_records_the_failed_stage_and_its_dependants_as_failed(self):
+        fail_stages('task-id', self.doc_id, 'Tokenizer', ['FreqDist'])
+        status = self.status()
+        self.assertEqual(status['Extractor']['state'], 'queued')
+        self.assertEqual(status['Tokenizer']['state'], 'failed')
+        self.assertIn('task-id', status['Tokenizer']['error'])
+        self.assertIn('at', status['Tokenizer'])
+        self.assertEqual(status['FreqDist']['state'], 'failed')
 
 
 class CreateIndexingPipelineTest(TestWithMongo):
@@ -62,32 +119,311 @@ class CreateIndexingPipelineTest(TestWithMongo):
         return mongodb_storage.collection.find_one({"_id":
             ObjectId(doc.blob.name)})
 
-    @patch('pypln.web.backend_adapter.pipelines.Extractor', autospec=True)
-    def test_should_create_indexing_pipelines_for_document(self, extractor):
+    @patch('pypln.web.backend_adapter.pipelines.signature')
+    def test_should_create_indexing_pipelines_for_document(self, signature):
         create_indexing_pipeline(self.document)
-        extractor.assert_called_with()
-        extractor.return_value.si.assert_called_with(ObjectId(self.document.blob.name))
+        doc_id = ObjectId(self.document.blob.name)
+        self.assertEqual([call[0] for call in signature.call_args_list],
+                [(WORKER_TASKS['Extractor'], ),
+                    (WORKER_TASKS['ElasticIndexer'], )])
+        signature.assert_called_with(WORKER_TASKS['ElasticIndexer'],
+                args=(doc_id, ), immutable=True, app=app)
 
-    @patch('pypln.web.backend_adapter.pipelines.GridFSDataRetriever', autospec=True)
-    def test_should_add_index_name_to_the_document_in_mongo(self,
-            gridfs_data_retriever):
+    @patch('pypln.web.backend_adapter.pipelines.signature')
+    def test_should_add_index_name_to_the_document_in_mongo(self, signature):
         create_indexing_pipeline(self.document)
         mongo_document = self.get_mongo_doc(self.document)
         self.assertEqual(mongo_document['index_name'], self.document.index_name)
 
-    @patch('pypln.web.backend_adapter.pipelines.GridFSDataRetriever', autospec=True)
-    def test_should_add_doc_type_to_the_document_in_mongo(self,
-            gridfs_data_retriever):
+    @patch('pypln.web.backend_adapter.pipelines.signature')
+    def test_should_add_doc_type_to_the_document_in_mongo(self, signature):
         create_indexing_pipeline(self.document)
         mongo_document = self.get_mongo_doc(self.document)
         self.assertEqual(mongo_document['doc_type'], self.document.doc_type)
 
 
-class CreatePipelineFromDocumentTest(TestWithMongo):
+class PlanPipelinesTest(TestWithMongo):
     fixtures = ['users', 'corpora', 'documents']
 
-    @patch('pypln.web.backend_adapter.pipelines.call_default_pipeline', autospec=True)
-    def test_create_pipeline_from_document_instantiates_a_document_id(self, fake_call_default_pipeline):
-        doc = Document.objects.all()[0]
-        create_pipeline_from_document(doc)
-        fake_call_default_pipeline.assert_called_with(ObjectId(doc.blob.name))
+    def setUp(self):
+        self.document = Document.objects.all()[0]
+        self.doc_id = ObjectId(self.document.blob.name)
+
+    def plan(self):
+        return [stage.worker for stage in
+                plan_pipelines([self.document])[self.document.blob.name]]
+
+    def test_complete_analysis_needs_nothing(self):
+        self.assertEqual(self.plan(), [])
+
+    def test_missing_result_runs_its_stage_and_the_stages_depending_on_it(self):
+        mongodb_storage.collection.update({'_id': self.doc_id},
+                {'$unset': {'freqdist': True}})
+        self.assertEqual(self.plan(), ['FreqDist', 'Statistics'])
+
+    def test_missing_analysis_runs_everything(self):
+        mongodb_storage.collection.remove({'_id': self.doc_id})
+        self.assertEqual(self.plan(), [stage.worker for stage in STAGES])
+
+    @override_settings(PIPELINE_WORKER_VERSIONS={'PalavrasRaw': '2'})
+    def test_outdated_worker_version_runs_its_stage_again(self):
+        mongodb_storage.collection.update({'_id': self.doc_id},
+                {'$set': {'_worker_versions': {'PalavrasRaw': '1'}}})
+        self.assertEqual(self.plan(), ['PalavrasRaw', 'POS', 'Lemmatizer',
+            'NounPhrase', 'SemanticTagger'])
+
+    @override_settings(PIPELINE_WORKER_VERSIONS={'PalavrasRaw': '2'})
+    def test_current_worker_version_is_not_run_again(self):
+        mongodb_storage.collection.update({'_id': self.doc_id},
+                {'$set': {'_worker_versions': {'PalavrasRaw': '2'}}})
+        self.assertEqual(self.plan(), [])
+
+
+@patch('pypln.web.backend_adapter.pipelines.group')
+@patch('pypln.web.backend_adapter.pipelines.default_pipeline')
+class DispatchPipelinesTest(TestWithMongo):
+    fixtures = ['users', 'corpora', 'documents']
+
+    def setUp(self):
+        self.document = Document.objects.all()[0]
+        self.doc_id = ObjectId(self.document.blob.name)
+
+    def get_request(self):
+        return PipelineRequest.objects.get(document=self.document)
+
+    def test_sends_pending_pipelines(self, default_pipeline, group):
+        enqueue_pipeline(self.document)
+        self.assertEqual(dispatch_pipelines(), 1)
+        default_pipeline.assert_called_with(self.doc_id)
+        group.assert_called_with([default_pipeline.return_value])
+        self.assertTrue(group.return_value.called)
+        request = self.get_request()
+        self.assertEqual(request.status, PipelineRequest.SENT)
+        analysis = mongodb_storage.collection.find_one({'_id': self.doc_id})
+        self.assertIn('_modified', analysis)
+        self.assertEqual(analysis['_pipeline_requests'], [request.key])
+        self.assertEqual(set(analysis['_status']), set(stage.worker for stage
+            in STAGES))
+        self.assertEqual(analysis['_status']['Extractor']['state'], 'queued')
+
+    def test_nothing_to_send(self, default_pipeline, group):
+        self.assertEqual(dispatch_pipelines(), 0)
+        self.assertFalse(group.called)
+
+    def test_does_not_send_a_request_twice(self, default_pipeline, group):
+        enqueue_pipeline(self.document)
+        request = self.get_request()
+        mongodb_storage.collection.update({'_id': self.doc_id},
+                {'$set': {'_pipeline_requests': [request.key]}})
+        dispatch_pipelines()
+        self.assertFalse(default_pipeline.called)
+        self.assertEqual(self.get_request().status, PipelineRequest.SENT)
+
+    def test_does_not_send_shared_analysis_again(self, default_pipeline,
+            group):
+        mongodb_storage.collection.update({'_id': self.doc_id},
+                {'$set': {'_modified': datetime.datetime.utcnow()}})
+        enqueue_pipeline(self.document)
+        dispatch_pipelines()
+        self.assertFalse(default_pipeline.called)
+
+    def test_stages_that_were_not_sent_for_a_shared_analysis_are_sent(self,
+            default_pipeline, group):
+        mongodb_storage.collection.update({'_id': self.doc_id},
+                {'$set': {'_modified': datetime.datetime.utcnow(),
+                    '_status': {'Extractor': {'state': 'done'}}}})
+        enqueue_pipeline(self.document)
+        dispatch_pipelines()
+        default_pipeline.assert_called_with(self.doc_id)
+
+    def test_forced_requests_are_sent_again(self, default_pipeline, group):
+        mongodb_storage.collection.update({'_id': self.doc_id},
+                {'$set': {'_modified': datetime.datetime.utcnow()}})
+        enqueue_pipeline(self.document, force=True)
+        dispatch_pipelines()
+        default_pipeline.assert_called_with(self.doc_id)
+
+    @patch('pypln.web.backend_adapter.pipelines.build_pipeline')
+    def test_sends_only_the_requested_stages(self, build_pipeline,
+            default_pipeline, group):
+        stages = [stage for stage in STAGES if stage.worker == 'FreqDist']
+        enqueue_pipeline(self.document, stages)
+        dispatch_pipelines()
+        self.assertFalse(default_pipeline.called)
+        build_pipeline.assert_called_with(self.doc_id, stages)
+
+    def test_failed_requests_are_tried_again_later(self, default_pipeline,
+            group):
+        group.return_value.side_effect = IOError("Broker is down")
+        enqueue_pipeline(self.document)
+        dispatch_pipelines()
+        request = self.get_request()
+        self.assertEqual(request.status, PipelineRequest.PENDING)
+        self.assertEqual(request.attempts, 1)
+        self.assertIn("Broker is down", request.last_error)
+        self.assertGreater(request.next_attempt_at, timezone.now())
+        # It's not tried again before the delay
+        self.assertEqual(dispatch_pipelines(), 0)
+
+    def test_requests_fail_after_too_many_attempts(self, default_pipeline,
+            group):
+        group.return_value.side_effect = IOError("Broker is down")
+        enqueue_pipeline(self.document)
+        with self.settings(PIPELINE_DISPATCH_MAX_ATTEMPTS=1):
+            dispatch_pipelines()
+        self.assertEqual(self.get_request().status, PipelineRequest.FAILED)
+
+
+class PipelineDefinitionTest(TestCase):
+
+    def workers(self, stages):
+        return [stage.worker for stage in stages]
+
+    def test_resolves_the_stages_each_stage_depends_on(self):
+        self.assertEqual(self.workers(resolve_stages(['Statistics'])),
+                ['Extractor', 'Tokenizer', 'FreqDist', 'Statistics'])
+
+    def test_unknown_workers_are_invalid(self):
+        with self.assertRaises(ValueError):
+            resolve_stages(['Horoscope'])
+
+    def test_stages_for_analyses(self):
+        self.assertEqual(self.workers(stages_for_analyses(['tokens',
+            'freqdist'])), ['Extractor', 'Tokenizer', 'FreqDist'])
+
+    def test_unknown_analyses_are_invalid(self):
+        with self.assertRaises(ValueError):
+            stages_for_analyses(['horoscope'])
+
+    def test_configured_pipelines_are_valid(self):
+        for name in settings.ANALYSIS_PIPELINES:
+            self.assertTrue(get_pipeline_stages(name))
+
+    @override_settings(ANALYSIS_PIPELINES={'broken': ['Tokenizer']})
+    def test_pipelines_must_include_the_stages_they_depend_on(self):
+        with self.assertRaises(ImproperlyConfigured):
+            get_pipeline_stages('broken')
+
+    def test_each_stage_is_finished_after_its_task(self):
+        def tasks(canvas):
+            if isinstance(canvas, (chain, group)):
+                return [task for item in canvas.tasks for task in
+                        tasks(item)]
+            return [canvas]
+
+        _id = ObjectId("123456789012")
+        pipeline = tasks(build_pipeline(_id,
+            resolve_stages(['Statistics', 'POS'])))
+        finished = [task for task in pipeline
+                if task.task == finish_stages.name]
+        self.assertEqual([task.args for task in finished], [
+            (_id, ['Extractor'], ['Tokenizer']),
+            (_id, ['Tokenizer'], ['PalavrasRaw', 'FreqDist']),
+            (_id, ['PalavrasRaw'], ['POS']),
+            (_id, ['POS'], []),
+            (_id, ['FreqDist'], ['Statistics']),
+            (_id, ['Statistics'], [])])
+        for task, next_task in zip(pipeline, pipeline[1:]):
+            if task.task != finish_stages.name:
+                self.assertEqual(next_task.task, finish_stages.name)
+        self.assertTrue(all(task.options['queue'] ==
+            settings.PIPELINE_FINISHED_QUEUE for task in finished))
+
+    def test_failed_stages_are_recorded_by_their_errback(self):
+        def tasks(canvas):
+            if isinstance(canvas, (chain, group)):
+                return [task for item in canvas.tasks for task in
+                        tasks(item)]
+            return [canvas]
+
+        _id = ObjectId("123456789012")
+        pipeline = build_pipeline(_id, resolve_stages(['Statistics', 'POS']))
+        errbacks = {task.task: task.options['link_error'] for task in
+                tasks(pipeline) if task.task != finish_stages.name}
+        self.assertEqual(len(errbacks[WORKER_TASKS['Tokenizer']]), 1)
+        errback = errbacks[WORKER_TASKS['Tokenizer']][0]
+        self.assertEqual(errback.task, fail_stages.name)
+        self.assertEqual(errback.args, (_id, 'Tokenizer',
+            ['PalavrasRaw', 'POS', 'FreqDist', 'Statistics']))
+        self.assertEqual(errback.options['queue'],
+                settings.PIPELINE_FINISHED_QUEUE)
+        self.assertEqual(errbacks[WORKER_TASKS['POS']][0].args, (_id, 'POS', []))
+
+    def test_complete_pipeline_is_the_default_one(self):
+        corpus = Corpus(pipeline='default')
+        self.assertIsNone(requested_stages(corpus))
+        corpus.pipeline = 'basic'
+        self.assertEqual(self.workers(requested_stages(corpus)),
+                ['Extractor', 'Tokenizer', 'FreqDist', 'Statistics'])
+        self.assertEqual(self.workers(requested_stages(corpus,
+            resolve_stages(['Tokenizer']))), ['Extractor', 'Tokenizer'])
+
+
+class LanesTest(TestWithMongo):
+    fixtures = ['users', 'corpora', 'documents']
+
+    def setUp(self):
+        self.admin_document = Document.objects.get(owner__username='admin')
+        self.user_document = Document.objects.get(owner__username='user')
+
+    def claim(self, batch_size):
+        return claim_pipeline_requests(batch_size)
+
+    def test_shares_each_batch_between_users(self):
+        enqueue_pipelines([self.admin_document] * 10)
+        enqueue_pipeline(self.user_document)
+        claimed = [request.document for request in self.claim(4)]
+        self.assertEqual(len(claimed), 4)
+        self.assertIn(self.user_document, claimed)
+
+    def test_fills_the_batch_with_requests_of_the_same_user(self):
+        enqueue_pipelines([self.admin_document] * 3)
+        self.assertEqual(len(self.claim(10)), 3)
+
+    @override_settings(PIPELINE_BULK_SHARE=0)
+    def test_interactive_requests_are_claimed_first(self):
+        enqueue_pipelines([self.admin_document] * 3,
+                lane=PipelineRequest.BULK)
+        enqueue_pipeline(self.user_document)
+        self.assertEqual([request.lane for request in self.claim(1)],
+                [PipelineRequest.INTERACTIVE])
+
+    @override_settings(PIPELINE_BULK_SHARE=0.5)
+    def test_part_of_each_batch_is_left_to_bulk_requests(self):
+        enqueue_pipelines([self.admin_document] * 3,
+                lane=PipelineRequest.BULK)
+        enqueue_pipelines([self.user_document] * 3)
+        lanes = sorted(request.lane for request in self.claim(4))
+        self.assertEqual(lanes, [PipelineRequest.BULK] * 2 +
+                [PipelineRequest.INTERACTIVE] * 2)
+
+    def test_routes_every_task_to_the_queue_of_the_lane(self):
+        def tasks(canvas):
+            if isinstance(canvas, (chain, group)):
+                return [task for item in canvas.tasks for task in
+                        tasks(item)]
+            return [canvas]
+
+        routed = tasks(route(build_pipeline(ObjectId()),
+            PipelineRequest.BULK))
+        worker_tasks = [task for task in routed
+                if task.task != finish_stages.name]
+        self.assertEqual(len(worker_tasks), len(STAGES))
+        self.assertTrue(all(task.options['queue'] ==
+            settings.PIPELINE_QUEUES['bulk'] for task in worker_tasks))
+        self.assertTrue(all(task.options['queue'] ==
+            settings.PIPELINE_FINISHED_QUEUE for task in routed
+            if task.task == finish_stages.name))
+
+    @patch('pypln.web.backend_adapter.pipelines.broker_queue_size')
+    def test_queue_depths(self, broker_queue_size):
+        broker_queue_size.return_value = 7
+        enqueue_pipeline(self.user_document)
+        enqueue_pipelines([self.admin_document] * 2,
+                lane=PipelineRequest.BULK)
+        self.assertEqual(queue_depths(), {
+            'interactive': {'queue': settings.PIPELINE_QUEUES['interactive'],
+                'pending': 1, 'queued': 7},
+            'bulk': {'queue': settings.PIPELINE_QUEUES['bulk'],
+                'pending': 2, 'queued': 7},
+        })
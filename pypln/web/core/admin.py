@@ -18,7 +18,23 @@
 # along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
 
 from django.contrib import admin
-from pypln.web.core.models import Corpus, Document
+from django.contrib.admin.views.main import ChangeList
+from pypln.web.core.models import Corpus, Document, prefetch_blob_metadata
+
+
+class DocumentChangeList(ChangeList):
+    def get_results(self, request):
+        super(DocumentChangeList, self).get_results(request)
+        # Evaluating the page here caches the documents (with their metadata)
+        # in the queryset that will be rendered.
+        prefetch_blob_metadata(self.result_list)
+
+
+class DocumentAdmin(admin.ModelAdmin):
+    list_display = ('__unicode__', 'owner', 'corpus', 'uploaded_at', 'size')
+
+    def get_changelist(self, request, **kwargs):
+        return DocumentChangeList
 
 admin.site.register(Corpus)
-admin.site.register(Document)
+admin.site.register(Document, DocumentAdmin)
@@ -0,0 +1,263 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+from collections import OrderedDict
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class LRUCache(object):
+    """
+    In-process cache that keeps at most `max_bytes` of (byte string) values,
+    evicting the least recently used ones first. `on_evict` is called with
+    the key of each evicted value.
+    """
+
+    def __init__(self, max_bytes, on_evict=None):
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        """
+        Keeps the value, unless it's bigger than the cache. Returns True if it
+        was kept.
+        """
+        if len(value) > self.max_bytes:
+            return False
+        evicted_keys = []
+        with self._lock:
+            old_value = self._entries.pop(key, None)
+            if old_value is not None:
+                self.size -= len(old_value)
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                evicted_keys.append(evicted_key)
+        if self.on_evict is not None:
+            for evicted_key in evicted_keys:
+                self.on_evict(evicted_key)
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def delete(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self.size -= len(value)
+
+
+class PropertyCache(object):
+    """
+    Two-tier cache for rendered properties: an `LRUCache` in each process in
+    front of a cache shared by all processes (one of the caches configured in
+    Django's `CACHES` setting).
+
+    Keys must include the version of the analysis (which `finish_stages`
+    increments when results are stored) and only complete analyses should be
+    cached, so entries don't outlive the results they were rendered from:
+    this is what keeps the cache consistent. `invalidate` only frees early
+    the entries of a document that this process knows about (e.g. when a
+    document's blob is replaced); other processes, like the dispatcher, don't
+    know these keys and don't need to call it.
+
+    Concurrent requests for the same key in a process are coalesced by
+    `get_or_lead`: only the first one renders the content, the others wait
+    for it to be cached. Only the leader (identified by the token it got
+    from `get_or_lead`) wakes them up.
+    """
+
+    def __init__(self, local_max_bytes=None, max_entry_bytes=None,
+            alias=None, timeout=None, wait_timeout=None):
+        self.local = LRUCache(local_max_bytes or
+                settings.PROPERTY_CACHE_LOCAL_MAX_BYTES,
+                on_evict=self._forget)
+        self.max_entry_bytes = (max_entry_bytes or
+                settings.PROPERTY_CACHE_MAX_ENTRY_BYTES)
+        self.alias = alias or settings.PROPERTY_CACHE_ALIAS
+        self.timeout = timeout or settings.PROPERTY_CACHE_TIMEOUT
+        self.wait_timeout = (wait_timeout or
+                settings.PROPERTY_CACHE_WAIT_TIMEOUT)
+        self._keys_by_document = {}
+        self._document_by_key = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def reset_stats(self):
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def stats(self):
+        return {
+            'local_hits': self.local_hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'in_flight': len(self._in_flight),
+            'local_entries': len(self.local),
+            'local_bytes': self.local.size,
+            'local_max_bytes': self.local.max_bytes,
+        }
+
+    def _set_local(self, key, document_name, content):
+        with self._lock:
+            self._keys_by_document.setdefault(document_name, set()).add(key)
+            self._document_by_key[key] = document_name
+        if not self.local.set(key, content):
+            self._forget(key)
+
+    def _forget(self, key):
+        with self._lock:
+            document_name = self._document_by_key.pop(key, None)
+            keys = self._keys_by_document.get(document_name)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_document[document_name]
+
+    def get(self, key, document_name):
+        content = self.local.get(key)
+        if content is not None:
+            self.local_hits += 1
+            return content
+        content = self.shared.get(key)
+        if content is not None:
+            self.shared_hits += 1
+            self._set_local(key, document_name, content)
+            return content
+        self.misses += 1
+        return None
+
+    def get_or_lead(self, key, document_name):
+        """
+        Returns the cached content for `key` and a leader token. If it's not
+        cached and no one else in this process is rendering it, the content
+        is None and the caller becomes the leader: it's responsible for
+        rendering it and calling `set` (or `release`, if it can't be cached)
+        with the token. Otherwise, waits for the content to be cached and
+        returns it (or None, if it isn't cached in `wait_timeout` seconds)
+        with a None token: the caller renders it and may cache it, but
+        doesn't wake anyone up.
+        """
+        content = self.get(key, document_name)
+        if content is not None:
+            return content, None
+        with self._lock:
+            event = self._in_flight.get(key)
+            if event is None:
+                # The leader may have cached it (and left) since we looked.
+                content = self.local.get(key)
+                if content is not None:
+                    self.local_hits += 1
+                    return content, None
+                token = self._in_flight[key] = threading.Event()
+                return None, token
+        event.wait(self.wait_timeout)
+        self.coalesced += 1
+        return self.get(key, document_name), None
+
+    def release(self, key, token):
+        """
+        Wakes up the requests waiting for `key` in `get_or_lead`, if `token`
+        is the one given to the leader of `key`.
+        """
+        if token is None:
+            return
+        with self._lock:
+            if self._in_flight.get(key) is not token:
+                return
+            del self._in_flight[key]
+        token.set()
+
+    def set(self, key, document_name, content, token=None):
+        try:
+            if len(content) <= self.max_entry_bytes:
+                self._set_local(key, document_name, content)
+                self.shared.set(key, content, self.timeout)
+        finally:
+            self.release(key, token)
+
+    def cache_stream(self, key, document_name, chunks, token=None):
+        """
+        Yields the given chunks, caching their concatenation when they're over
+        (unless it's too big to be cached).
+        """
+        cached_chunks = []
+        cached_size = 0
+        try:
+            for chunk in chunks:
+                if cached_chunks is not None:
+                    cached_size += len(chunk)
+                    if cached_size > self.max_entry_bytes:
+                        # Requests waiting for this content shouldn't wait
+                        # for the whole stream to find out it won't be cached.
+                        cached_chunks = None
+                        self.release(key, token)
+                    else:
+                        cached_chunks.append(chunk)
+                yield chunk
+            if cached_chunks is not None:
+                self.set(key, document_name, b''.join(cached_chunks), token)
+        finally:
+            self.release(key, token)
+
+    def clear(self):
+        with self._lock:
+            self._keys_by_document = {}
+            self._document_by_key = {}
+        self.local.clear()
+        self.shared.clear()
+
+    def invalidate(self, document_name):
+        with self._lock:
+            keys = self._keys_by_document.pop(document_name, set())
+            for key in keys:
+                self._document_by_key.pop(key, None)
+        for key in keys:
+            self.local.delete(key)
+        if keys:
+            self.shared.delete_many(list(keys))
+
+property_cache = PropertyCache()
@@ -0,0 +1,135 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from rest_framework.utils import encoders
+
+from pypln.web.backend_adapter.pipelines import DONE, FAILED
+from pypln.web.backend_adapter.pipelines import get_analysis_status
+
+
+class PollingFeed(object):
+    """
+    Change feed used by the `events` endpoints to wait between two reads of
+    the status of the analyses. It doesn't know when an analysis changes
+    (the workers change the analyses directly in MongoDB and the version we
+    use has no change streams), so `wait` just sleeps for `interval` seconds:
+    waiting requests poll MongoDB and see changes with up to this delay.
+    """
+
+    def __init__(self, interval=None):
+        self.interval = interval or settings.EVENTS_POLL_INTERVAL
+
+    def wait(self, blob_names, timeout):
+        time.sleep(min(self.interval, timeout))
+
+event_feed = import_string(settings.EVENTS_FEED)()
+
+
+def status_token(statuses):
+    """
+    Returns a short string that changes when the state of any stage in the
+    given statuses (a dict mapping blob names to statuses) changes.
+    """
+    states = sorted((name, stage['name'], stage['state']) for name, status in
+            statuses.items() for stage in status['stages'])
+    return hashlib.sha1(repr(states)).hexdigest()
+
+def stage_events(documents, old_statuses, new_statuses):
+    """
+    Returns an event for each stage whose state changed between
+    `old_statuses` and `new_statuses`. `documents` is a list of
+    `(pk, blob_name)` pairs.
+    """
+    events = []
+    for pk, blob_name in documents:
+        old_stages = {stage['name']: stage['state'] for stage in
+                old_statuses[blob_name]['stages']}
+        new_status = new_statuses[blob_name]
+        for stage in new_status['stages']:
+            if old_stages.get(stage['name']) != stage['state']:
+                event = {'document': pk, 'stage': stage['name'],
+                        'state': stage['state'],
+                        'document_state': new_status['state']}
+                for key in ('at', 'error'):
+                    if key in stage:
+                        event[key] = stage[key]
+                events.append(event)
+    return events
+
+def is_finished(statuses):
+    return all(status['state'] in (DONE, FAILED) for status in
+            statuses.values())
+
+def wait_for_change(blob_names, token, timeout, feed=None):
+    """
+    Waits (at most `timeout` seconds) until the status token of the given
+    analyses is different from `token`. Returns the statuses and the new
+    token.
+    """
+    feed = feed or event_feed
+    deadline = time.time() + timeout
+    statuses = get_analysis_status(blob_names)
+    new_token = status_token(statuses)
+    while new_token == token:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        feed.wait(blob_names, remaining)
+        statuses = get_analysis_status(blob_names)
+        new_token = status_token(statuses)
+    return statuses, new_token
+
+def format_event(event, data):
+    return 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data,
+        cls=encoders.JSONEncoder))
+
+def event_stream(documents, timeout, feed=None):
+    """
+    Yields server-sent events for the given `(pk, blob_name)` pairs: one
+    `stage` event for the state of each stage when it starts and then for
+    each change, until every analysis is done (or failed) or `timeout`
+    seconds pass. The stream ends with an `end` event. Comments are sent
+    while nothing changes, so proxies don't close the connection.
+    """
+    feed = feed or event_feed
+    blob_names = [blob_name for pk, blob_name in documents]
+    deadline = time.time() + timeout
+    empty = {'stages': []}
+    statuses = get_analysis_status(blob_names)
+    old_statuses = dict.fromkeys(blob_names, empty)
+    yield 'retry: {}\n\n'.format(int(settings.EVENTS_RETRY * 1000))
+    while True:
+        for event in stage_events(documents, old_statuses, statuses):
+            yield format_event('stage', event)
+        if is_finished(statuses):
+            break
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        feed.wait(blob_names, remaining)
+        old_statuses, statuses = statuses, get_analysis_status(blob_names)
+        if status_token(old_statuses) == status_token(statuses):
+            yield ': waiting\n\n'
+    yield format_event('end', {'finished': is_finished(statuses),
+        'token': status_token(statuses)})
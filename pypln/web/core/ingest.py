@@ -0,0 +1,176 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import tarfile
+import zipfile
+import zlib
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+
+from pypln.web.backend_adapter.models import PipelineRequest
+from pypln.web.backend_adapter.pipelines import enqueue_pipelines
+from pypln.web.backend_adapter.pipelines import requested_stages
+from pypln.web.core.models import Document, mongodb_storage
+
+
+def check_upload_limits(sizes, max_files=None, max_total_size=None):
+    """
+    Raises `ValueError` if there are more files (with the given sizes) than
+    `max_files` or if they add up to more than `max_total_size` bytes.
+    """
+    max_files = max_files or settings.BULK_UPLOAD_MAX_FILES
+    max_total_size = max_total_size or settings.BULK_UPLOAD_MAX_TOTAL_SIZE
+    if len(sizes) > max_files:
+        raise ValueError("At most {} files can be sent at once.".format(
+            max_files))
+    if sum(sizes) > max_total_size:
+        raise ValueError("The files can't add up to more than {} "
+                "bytes.".format(max_total_size))
+
+
+# Errors raised while reading broken (or encrypted) archives.
+ARCHIVE_ERRORS = (zipfile.BadZipfile, zipfile.LargeZipFile, RuntimeError,
+        tarfile.TarError, zlib.error, IOError, EOFError)
+
+
+def check_file_size(name, size, max_file_size=None):
+    """
+    Raises `ValueError` if the file with the given name and size is bigger
+    than `max_file_size` bytes.
+    """
+    max_file_size = max_file_size or settings.BULK_UPLOAD_MAX_FILE_SIZE
+    if size > max_file_size:
+        raise ValueError("File '{}' is bigger than {} bytes.".format(name,
+            max_file_size))
+
+
+def read_archive(archive, max_file_size=None):
+    """
+    Returns an iterator over the name and the contents (as a `ContentFile`)
+    of each regular file in a zip or (optionally compressed) tar `archive`.
+    Raises `ValueError` if it's not a valid archive, if one of its files is
+    bigger than `max_file_size` or if it's over the limits of
+    `check_upload_limits`, before reading any of them. The iterator also
+    raises `ValueError` if the files turn out to be bigger than the archive
+    said or can't be read (because they're encrypted or corrupted).
+    """
+    max_file_size = max_file_size or settings.BULK_UPLOAD_MAX_FILE_SIZE
+    archive.seek(0)
+    try:
+        if zipfile.is_zipfile(archive):
+            archive.seek(0)
+            archive_file = zipfile.ZipFile(archive)
+            members = [(info.filename, info.file_size, info) for info in
+                    archive_file.infolist()
+                    if not info.filename.endswith('/')]
+            open_member = archive_file.open
+        else:
+            archive.seek(0)
+            archive_file = tarfile.open(fileobj=archive)
+            members = [(member.name, member.size, member) for member in
+                    archive_file.getmembers() if member.isfile()]
+            open_member = archive_file.extractfile
+    except ARCHIVE_ERRORS:
+        raise ValueError("The archive must be a zip or tar file.")
+
+    for name, size, member in members:
+        check_file_size(name, size, max_file_size)
+    check_upload_limits([size for name, size, member in members])
+    return _read_members(members, open_member, max_file_size)
+
+
+def _read_members(members, open_member, max_file_size):
+    # The sizes in the archive headers are not trusted.
+    total_size = sum(size for name, size, member in members)
+    read_size = 0
+    for name, size, member in members:
+        try:
+            data = open_member(member).read(max_file_size + 1)
+        except ARCHIVE_ERRORS:
+            raise ValueError("File '{}' could not be read (it may be "
+                    "encrypted or corrupted).".format(name))
+        check_file_size(name, len(data), max_file_size)
+        read_size += len(data)
+        if read_size > total_size:
+            raise ValueError("The files are bigger than the archive says.")
+        yield name, ContentFile(data, name=os.path.basename(name))
+
+
+def save_document_batch(owner, corpus, names, blob_names, stages=None):
+    """
+    Saves a document in `corpus` for each one of the given blob names (of
+    files that were already stored) and requests their pipelines in a single
+    transaction. Returns a list of (name, document) pairs.
+    """
+    stages = requested_stages(corpus, stages)
+    with transaction.atomic():
+        # `bulk_create` doesn't set the primary keys of the new documents, so
+        # they're saved one by one (but committed together).
+        documents = [Document.objects.create(blob=blob_name, owner=owner,
+            corpus=corpus) for blob_name in blob_names]
+        enqueue_pipelines(documents, stages, lane=PipelineRequest.BULK)
+    return zip(names, documents)
+
+
+def _batches(files, batch_size):
+    # Yields lists of at most `batch_size` (name, file) pairs, or less if
+    # they add up to `BULK_UPLOAD_BATCH_MAX_BYTES`.
+    batch = []
+    batch_bytes = 0
+    for name, content in files:
+        batch.append((name, content))
+        batch_bytes += content.size
+        if len(batch) >= batch_size or \
+                batch_bytes >= settings.BULK_UPLOAD_BATCH_MAX_BYTES:
+            yield batch
+            batch = []
+            batch_bytes = 0
+    if batch:
+        yield batch
+
+
+def create_documents(owner, corpus, files, batch_size=None, stages=None):
+    """
+    Creates a document in `corpus` for each one of the given (name, file)
+    pairs and requests their pipelines (with the given stages, or the
+    pipeline of the corpus). Files are stored `batch_size` at a time, with a
+    single MongoDB insert, or less if they add up to
+    `BULK_UPLOAD_BATCH_MAX_BYTES`, so only one batch is kept in memory. Every
+    document is saved in a single transaction: if reading the files raises
+    an exception, no document is created and the files that were already
+    stored are deleted. Returns a list of (name, document) pairs.
+    """
+    batch_size = batch_size or settings.BULK_UPLOAD_BATCH_SIZE
+    created = []
+    blob_names = []
+    try:
+        with transaction.atomic():
+            for batch in _batches(files, batch_size):
+                batch_blob_names = mongodb_storage.save_many([content for
+                    name, content in batch])
+                blob_names.extend(batch_blob_names)
+                created.extend(save_document_batch(owner, corpus, [name for
+                    name, content in batch], batch_blob_names, stages))
+    except Exception:
+        for blob_name in blob_names:
+            mongodb_storage.delete(blob_name)
+        raise
+    return created
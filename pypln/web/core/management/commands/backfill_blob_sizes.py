@@ -0,0 +1,43 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+from pypln.web.core.models import mongodb_storage
+
+
+class Command(BaseCommand):
+    help = ("Records the size of every stored document that was saved before "
+            "sizes were recorded at write time.")
+
+    def handle(self, *args, **kwargs):
+        missing_size = {'_blob.length': {'$exists': False},
+                'contents': {'$exists': True}}
+        # Records without `contents` (e.g. analyses whose document was
+        # deleted) have no size to record.
+        skipped = mongodb_storage.collection.find({
+            '_blob.length': {'$exists': False},
+            'contents': {'$exists': False}}).count()
+        self.stdout.write("Recording sizes for {} documents... ".format(
+            mongodb_storage.collection.find(missing_size).count()))
+        for document in mongodb_storage.collection.find(missing_size,
+                {'_id': True}):
+            mongodb_storage.store_size(document['_id'])
+
+        self.stdout.write("Done. Skipped {} records without contents.".format(
+            skipped))
@@ -0,0 +1,59 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from pypln.web.backend_adapter.pipelines import dispatch_pipelines
+from pypln.web.backend_adapter.pipelines import refresh_backlog
+
+
+class Command(BaseCommand):
+    help = ("Sends the pipelines requested for new and updated documents to "
+            "the broker. Runs until it's interrupted, unless --once is used. "
+            "It also counts the backlog of pipelines that the views check "
+            "before accepting new documents.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', default=False,
+                help="Send the pending pipelines and exit.")
+        parser.add_argument('--batch-size', type=int,
+                default=settings.PIPELINE_DISPATCH_BATCH_SIZE,
+                help="Number of pipelines sent at a time.")
+        parser.add_argument('--interval', type=float, default=1,
+                help="Seconds to wait when there is nothing to send.")
+
+    def handle(self, *args, **options):
+        backlog_counted_at = None
+        while True:
+            # The backlog is counted again before it expires, so the views
+            # don't need to count it.
+            if backlog_counted_at is None or time.time() - backlog_counted_at \
+                    >= settings.PIPELINE_BACKLOG_CACHE_TIMEOUT / 2.0:
+                refresh_backlog()
+                backlog_counted_at = time.time()
+            handled = dispatch_pipelines(options['batch_size'])
+            if handled:
+                self.stdout.write("Handled {} pipeline requests.".format(
+                    handled))
+            elif options['once']:
+                break
+            else:
+                time.sleep(options['interval'])
@@ -0,0 +1,176 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from pypln.web.core.ingest import save_document_batch
+from pypln.web.core.models import Corpus, mongodb_storage
+
+
+def iter_files(directory):
+    """
+    Yields the path of every file in the directory tree, always in the same
+    order, so an import can be resumed by skipping the files that were already
+    imported.
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            yield os.path.join(root, name)
+
+
+def prepare_file(args):
+    # Runs in the pool processes, so reading, encoding and hashing the files
+    # (the CPU-bound part of the import) is done in parallel.
+    path, max_file_size = args
+    if os.path.getsize(path) > max_file_size:
+        return path, None
+    with open(path, 'rb') as fp:
+        return path, mongodb_storage.prepare(fp.read())
+
+
+class Command(BaseCommand):
+    help = ("Imports every file in a directory tree as a document in a corpus. "
+            "The progress is saved to a checkpoint file after each batch, so an "
+            "interrupted import is resumed when the command is run again (the "
+            "batch that was being imported may be imported twice).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('corpus_id', type=int)
+        parser.add_argument('directory')
+        parser.add_argument('--workers', type=int,
+                default=multiprocessing.cpu_count(),
+                help="Number of processes reading and encoding the files.")
+        parser.add_argument('--batch-size', type=int,
+                default=settings.BULK_UPLOAD_BATCH_SIZE,
+                help="Number of documents stored (and pipelines published) "
+                "at a time.")
+        parser.add_argument('--checkpoint',
+                help="Checkpoint file (defaults to "
+                "import-<corpus_id>.checkpoint in the current directory).")
+
+    def handle(self, corpus_id, directory, **options):
+        try:
+            corpus = Corpus.objects.get(pk=corpus_id)
+        except Corpus.DoesNotExist:
+            raise CommandError("Corpus {} does not exist.".format(corpus_id))
+        directory = os.path.abspath(directory)
+        if not os.path.isdir(directory):
+            raise CommandError("{} is not a directory.".format(directory))
+        checkpoint_path = options['checkpoint'] or \
+                'import-{}.checkpoint'.format(corpus_id)
+        checkpoint = self.load_checkpoint(checkpoint_path, corpus_id,
+                directory)
+
+        total = sum(1 for path in iter_files(directory))
+        paths = iter_files(directory)
+        if checkpoint['imported']:
+            last_path = None
+            for last_path in itertools.islice(paths, checkpoint['imported']):
+                pass
+            if last_path != checkpoint['last_path']:
+                raise CommandError("The directory changed since the "
+                        "checkpoint was saved.")
+            self.stdout.write("Resuming after {} files.".format(
+                checkpoint['imported']))
+
+        max_file_size = settings.BULK_UPLOAD_MAX_FILE_SIZE
+        pool = multiprocessing.Pool(options['workers'])
+        try:
+            prepared = pool.imap(prepare_file, ((path, max_file_size) for path
+                in paths), chunksize=16)
+            self.import_files(corpus, directory, prepared, total, checkpoint,
+                    checkpoint_path, options['batch_size'])
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+        os.remove(checkpoint_path)
+        self.stdout.write("Done.")
+
+    def import_files(self, corpus, directory, prepared, total, checkpoint,
+            checkpoint_path, batch_size):
+        started_at = time.time()
+        resumed_from = checkpoint['imported']
+        max_file_size = settings.BULK_UPLOAD_MAX_FILE_SIZE
+        while True:
+            batch = list(itertools.islice(prepared, batch_size))
+            if not batch:
+                break
+            names = []
+            documents = []
+            for path, document in batch:
+                name = os.path.relpath(path, directory)
+                if document is None:
+                    self.stderr.write("Skipping {}: it's bigger than {} "
+                            "bytes.".format(name, max_file_size))
+                else:
+                    names.append(name)
+                    documents.append(document)
+            if documents:
+                save_document_batch(corpus.owner, corpus, names,
+                        mongodb_storage.save_prepared(documents))
+
+            checkpoint['imported'] += len(batch)
+            checkpoint['last_path'] = batch[-1][0]
+            self.save_checkpoint(checkpoint_path, checkpoint)
+            self.report_progress(checkpoint['imported'], total,
+                    checkpoint['imported'] - resumed_from,
+                    time.time() - started_at)
+
+    def load_checkpoint(self, path, corpus_id, directory):
+        checkpoint = {'corpus_id': corpus_id, 'directory': directory,
+                'imported': 0, 'last_path': None}
+        if not os.path.exists(path):
+            return checkpoint
+        with open(path) as fp:
+            saved_checkpoint = json.load(fp)
+        if saved_checkpoint['corpus_id'] != corpus_id or \
+                saved_checkpoint['directory'] != directory:
+            raise CommandError("The checkpoint file {} belongs to another "
+                    "import.".format(path))
+        return saved_checkpoint
+
+    def save_checkpoint(self, path, checkpoint):
+        # Writing to a temporary file and renaming it makes sure we never
+        # leave a partially written checkpoint behind.
+        temporary_path = '{}.tmp'.format(path)
+        with open(temporary_path, 'w') as fp:
+            json.dump(checkpoint, fp)
+        os.rename(temporary_path, path)
+
+    def report_progress(self, imported, total, imported_now, elapsed):
+        rate = imported_now / elapsed if elapsed else 0
+        if rate:
+            eta = datetime.timedelta(seconds=int((total - imported) / rate))
+        else:
+            eta = 'unknown'
+        self.stdout.write("Imported {}/{} files ({:.1f} files/s, ETA "
+                "{}).".format(imported, total, rate, eta))
@@ -1,6 +1,6 @@
 # -*- coding:utf-8 -*-
 #
-# Copyright 2013 NAMD-EMAP-FGV
+# Copyright 2015 NAMD-EMAP-FGV
 #
 # This file is part of PyPLN. You can get more information at: http://pypln.org/.
 #
@@ -16,20 +16,177 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import datetime
+import time
 
-from django.core.management.base import BaseCommand
+from bson import ObjectId
+from django.core.management.base import BaseCommand, CommandError
 from pypln.web.core.models import Document
-from pypln.web.backend_adapter.pipelines import create_pipeline
+from pypln.web.core.mongodb import connection_manager
+from pypln.web.backend_adapter.models import PipelineRequest
+from pypln.web.backend_adapter.pipelines import enqueue_pipelines
+from pypln.web.backend_adapter.pipelines import plan_pipelines
+
+
+def iter_chunks(queryset, chunk_size, after_id=0):
+    """
+    Yields lists of at most `chunk_size` objects from `queryset`, ordered by
+    primary key. Each chunk is fetched by a separate query starting after the
+    last primary key of the previous one, so no query needs an `OFFSET`.
+    """
+    while True:
+        chunk = list(queryset.filter(pk__gt=after_id).order_by('pk')[
+            :chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        after_id = chunk[-1].pk
+
+
+def without_property(documents, name):
+    """
+    Returns the documents for which the analysis result `name` is not
+    available.
+    """
+    doc_ids = [ObjectId(document.blob.name) for document in documents]
+    available = set(str(record['_id']) for record in
+            connection_manager.collection().find({'_id': {'$in': doc_ids},
+                name: {'$exists': True}}, {'_id': True}))
+    return [document for document in documents
+            if document.blob.name not in available]
+
+
+def unique_analyses(documents):
+    """
+    Returns the first one of the given documents for each analysis (documents
+    with the same contents share their analysis).
+    """
+    unique = {}
+    for document in documents:
+        unique.setdefault(document.blob.name, document)
+    return [document for document in documents
+            if unique[document.blob.name] is document]
+
+
+class RateLimiter(object):
+    """
+    Lets `wait` return at most `rate` times per second (if `rate` is not
+    zero). `wait(count)` counts as `count` calls.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = time.time()
+
+    def wait(self, count=1):
+        if not self.interval:
+            return
+        now = time.time()
+        wait_until = max(self.next_time, now)
+        self.next_time = wait_until + self.interval * count
+        time.sleep(wait_until - now)
+
+
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise CommandError("Dates must be in the YYYY-MM-DD format.")
+
 
 class Command(BaseCommand):
-    help = "Reruns the analysis for every document in the database."
+    help = ("Reruns the analysis for the selected documents (every document in "
+            "the database, by default). Documents are read in chunks ordered "
+            "by id and the last id of each chunk is shown, so an interrupted "
+            "run can be resumed with --after-id. The pipelines are requested "
+            "in the bulk lane, once for each analysis in a chunk, and sent by "
+            "dispatch_pipelines: run more dispatchers to send them in "
+            "parallel. --rate only limits how fast requests are saved; the "
+            "rate at which they reach the broker depends on the dispatchers "
+            "(and PIPELINE_BULK_SHARE).")
 
-    def handle(self, *args, **kwargs):
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus', type=int, action='append',
+                dest='corpora', help="Only documents in this corpus (can be "
+                "used more than once).")
+        parser.add_argument('--owner', help="Only documents owned by this "
+                "username.")
+        parser.add_argument('--uploaded-after', type=parse_date,
+                help="Only documents uploaded on or after this date "
+                "(YYYY-MM-DD).")
+        parser.add_argument('--uploaded-before', type=parse_date,
+                help="Only documents uploaded before this date (YYYY-MM-DD).")
+        parser.add_argument('--missing-property', help="Only documents "
+                "without this analysis result.")
+        parser.add_argument('--incremental', action='store_true',
+                default=False, help="Only run the stages with missing or "
+                "outdated results (and the ones that depend on them).")
+        parser.add_argument('--after-id', type=int, default=0,
+                help="Only documents with a bigger id (to resume a run).")
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                help="Number of documents read from the database at a time.")
+        parser.add_argument('--rate', type=float, default=50,
+                help="Maximum number of pipelines requested (saved for the "
+                "dispatchers) per second (0 means no limit).")
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                help="Only show which documents would be processed.")
+
+    def get_queryset(self, options):
         docs = Document.objects.all()
-        self.stdout.write("Sending pipelines for {} "
-                "documents... ".format(len(docs)))
-        for doc in docs:
-            data = {"_id": str(doc.blob.file._id), "id": doc.id}
-            create_pipeline(data)
+        if options['corpora']:
+            docs = docs.filter(corpus__in=options['corpora'])
+        if options['owner']:
+            docs = docs.filter(owner__username=options['owner'])
+        if options['uploaded_after']:
+            docs = docs.filter(uploaded_at__gte=options['uploaded_after'])
+        if options['uploaded_before']:
+            docs = docs.filter(uploaded_at__lt=options['uploaded_before'])
+        return docs
+
+    def handle(self, *args, **options):
+        docs = self.get_queryset(options).filter(pk__gt=options['after_id'])
+        self.stdout.write("Requesting pipelines for at most {} documents... "
+                "".format(docs.count()))
+        rate_limiter = RateLimiter(options['rate'])
+        requested = 0
+        for chunk in iter_chunks(docs, options['chunk_size']):
+            last_id = chunk[-1].pk
+            chunk = unique_analyses(chunk)
+            if options['missing_property']:
+                chunk = without_property(chunk, options['missing_property'])
+            plans = {}
+            if options['incremental']:
+                plans = plan_pipelines(chunk)
+                chunk = [doc for doc in chunk if plans[doc.blob.name]]
+            if options['dry_run']:
+                for doc in chunk:
+                    self.stdout.write("Would send pipeline for document {} "
+                            "({}){}.".format(doc.pk, doc.blob.name,
+                                self.describe_plan(plans.get(doc.blob.name))))
+            elif chunk:
+                rate_limiter.wait(len(chunk))
+                self.request_pipelines(chunk, plans)
+            requested += len(chunk)
+            self.stdout.write("{} pipelines requested, last id: {}.".format(
+                requested, last_id))
 
         self.stdout.write("Done.")
+
+    def request_pipelines(self, docs, plans):
+        # Documents with the same plan are requested together.
+        by_plan = {}
+        for doc in docs:
+            stages = plans.get(doc.blob.name)
+            key = None if stages is None else tuple(stages)
+            by_plan.setdefault(key, []).append(doc)
+        for stages, plan_docs in by_plan.items():
+            if stages is not None:
+                stages = list(stages)
+            enqueue_pipelines(plan_docs, stages, force=True,
+                    lane=PipelineRequest.BULK)
+
+    def describe_plan(self, stages):
+        if stages is None:
+            return ''
+        return ' with stages {}'.format(', '.join(stage.worker for stage in
+            stages))
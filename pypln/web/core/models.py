@@ -16,18 +16,21 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import hashlib
+
 from bson import ObjectId
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.dispatch import receiver
 from django.db import models
+from django.utils.module_loading import import_string
 
 from rest_framework.reverse import reverse
 from rest_framework.authtoken.models import Token
 
-from pypln.web.core.storage import MongoDBBase64Storage
+from pypln.web.core.mongodb import connection_manager
 
-mongodb_storage = MongoDBBase64Storage()
+mongodb_storage = import_string(settings.MONGODB_STORAGE)()
 
 
 class Corpus(models.Model):
@@ -35,6 +38,9 @@ class Corpus(models.Model):
     description = models.CharField(max_length=255, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     owner = models.ForeignKey('auth.User')
+    # Name of the pipeline (in the `ANALYSIS_PIPELINES` setting) used for the
+    # documents of this corpus.
+    pipeline = models.CharField(max_length=50, default='default')
 
     class Meta:
         verbose_name_plural = 'corpora'
@@ -50,19 +56,191 @@ class Document(models.Model):
     owner = models.ForeignKey('auth.User')
     corpus = models.ForeignKey(Corpus)
 
+    # Filled by `prefetch_blob_metadata`, so we don't need to query MongoDB
+    # for each document in a list.
+    _blob_metadata = None
+    _properties_cache = None
+
+    _ALL_PROPERTIES = object()
+    _ANALYSIS_STATE = object()
+    _NOT_AVAILABLE = object()
+
     def __unicode__(self):
         return self.blob.name
 
+    @property
+    def size(self):
+        if self._blob_metadata is not None:
+            return self._blob_metadata['_blob']['length']
+        return self.blob.size
+
     @property
     def properties(self):
-        return mongodb_storage.collection.find_one({"_id":
-            ObjectId(self.blob.name)}, {"_id": False})
+        cache = self._get_properties_cache()
+        if self._ALL_PROPERTIES not in cache:
+            document = connection_manager.collection().find_one({"_id":
+                ObjectId(self.blob.name)}, {"_id": False})
+            if document is not None:
+                # Keys starting with an underscore are storage metadata, not
+                # analysis results.
+                document = {key: value for key, value in document.items()
+                        if not key.startswith('_')}
+            cache[self._ALL_PROPERTIES] = document
+        return cache[self._ALL_PROPERTIES]
+
+    def fetch_property_slice(self, name, offset, limit):
+        """
+        Fetches at most `limit` items of an analysis result, starting at
+        `offset`, without remembering them. Returns a dict with the `value`,
+        if it `is_list` and the `count` of items in the whole list. If the
+        result is not a list, `value` contains all of it. Only the requested
+        items are transferred from MongoDB.
+        Raises `KeyError` if the result is not available.
+        """
+        if name.startswith('_'):
+            raise KeyError(name)
+        field = '${}'.format(name)
+        is_list = {'$isArray': field}
+        pipeline = [
+            {'$match': {'_id': ObjectId(self.blob.name)}},
+            {'$project': {
+                '_id': False,
+                'is_list': is_list,
+                'value': {'$cond': [is_list, {'$slice': [field, offset,
+                    limit]}, field]},
+                'count': {'$cond': [is_list, {'$size': field}, None]},
+            }},
+        ]
+        result = next(iter(connection_manager.collection().aggregate(pipeline,
+            cursor={})), {})
+        if 'value' not in result:
+            raise KeyError(name)
+        return result
+
+    def get_property_slice(self, name, offset, limit):
+        """
+        Returns at most `limit` items of a list-valued analysis result,
+        starting at `offset`, together with the length of the whole list.
+        Raises `KeyError` if the result is not available and `ValueError` if
+        it is not a list.
+        """
+        result = self.fetch_property_slice(name, offset, limit)
+        if not result['is_list']:
+            raise ValueError("Property '{}' is not a list.".format(name))
+        return result['value'], result['count']
+
+    def _get_analysis_state(self):
+        cache = self._get_properties_cache()
+        if self._ANALYSIS_STATE not in cache:
+            state = mongodb_storage.get_keys([self.blob.name],
+                    ['_version', '_modified', '_updated', '_status']).get(
+                            self.blob.name, {})
+            state['keys'] = sorted(key for key in state.get('keys', [])
+                    if not key.startswith('_'))
+            cache[self._ANALYSIS_STATE] = state
+        return cache[self._ANALYSIS_STATE]
+
+    def property_names(self):
+        """
+        Returns the sorted names of the available analysis results, without
+        fetching their values.
+        """
+        return self._get_analysis_state()['keys']
+
+    def analysis_state(self):
+        """
+        Returns the names of the available analysis results (`keys`) and the
+        `_version`, `_modified`, `_updated` and `_status` of the analysis,
+        without fetching the results.
+        """
+        return self._get_analysis_state()
+
+    def analysis_version(self):
+        """
+        Returns a string that changes whenever the analysis results change,
+        without fetching them. It's based on the available results and on the
+        `_version` and `_modified` keys, which should be updated by whoever
+        changes an existing result (see `finish_stages`).
+        """
+        state = self._get_analysis_state()
+        version = u'{}:{}:{}'.format(state.get('_version'),
+                state.get('_modified'), u','.join(state['keys']))
+        return hashlib.sha1(version.encode('utf-8')).hexdigest()
+
+    def analysis_modified_at(self):
+        """
+        Returns the last time the analysis results were changed, if it's
+        known: the time the last stage finished, recorded by `finish_stages`
+        in `_updated` (`_modified` is when the pipeline was sent, before its
+        results change).
+        """
+        return self._get_analysis_state().get('_updated')
+
+    def _get_properties_cache(self):
+        # The cache lives as long as this instance (usually a single request)
+        # and is discarded if the blob changes.
+        if self._properties_cache is None or \
+                self._properties_cache[0] != self.blob.name:
+            self._properties_cache = (self.blob.name, {})
+        return self._properties_cache[1]
+
+    def get_properties(self, names):
+        """
+        Returns a dict with the requested analysis results. Results that are
+        not available are not included. Only the requested keys are fetched
+        from MongoDB, and they are remembered by this instance, so requesting
+        them again does not query the database.
+        """
+        cache = self._get_properties_cache()
+        names = [name for name in names if not name.startswith('_')]
+        all_properties = cache.get(self._ALL_PROPERTIES)
+        if all_properties is not None:
+            return {name: all_properties[name] for name in names
+                    if name in all_properties}
+
+        missing = [name for name in names if name not in cache]
+        if missing:
+            document = connection_manager.collection().find_one({"_id":
+                ObjectId(self.blob.name)}, dict.fromkeys(missing, True)) or {}
+            for name in missing:
+                cache[name] = document.get(name, self._NOT_AVAILABLE)
+        return {name: cache[name] for name in names
+                if cache[name] is not self._NOT_AVAILABLE}
+
+    def get_property(self, name):
+        """
+        Returns a single analysis result, fetching only this key from MongoDB.
+        Raises `KeyError` if it is not available.
+        """
+        return self.get_properties([name])[name]
+
+
+def prefetch_blob_metadata(documents):
+    """
+    Fetches the blob metadata for all the given documents with a single
+    MongoDB query and attaches it to each one of them. Returns the documents
+    as a list.
+    """
+    documents = list(documents)
+    metadata = mongodb_storage.get_metadata([document.blob.name for document
+        in documents])
+    for document in documents:
+        document._blob_metadata = metadata.get(document.blob.name)
+    return documents
 
 
 class IndexedDocument(Document):
     doc_type = models.CharField(max_length=100)
     index_name = models.CharField(max_length=100)
 
+# The stored data may be shared with other documents (see
+# `MongoDBBase64Storage`), so the storage decides when to remove it. Deleting
+# an `IndexedDocument` also deletes its `Document`, so this handles both.
+@receiver(models.signals.post_delete, sender=Document)
+def delete_blob(sender, instance=None, **kwargs):
+    if instance.blob.name:
+        mongodb_storage.delete(instance.blob.name)
+
 # Create a authentication Token for each user it's created.
 @receiver(models.signals.post_save, sender=User)
 def create_auth_token(sender, instance=None, created=False, **kwargs):
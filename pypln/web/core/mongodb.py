@@ -0,0 +1,134 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import sys
+import threading
+
+from django.conf import settings
+from django.core.signals import got_request_exception
+from django.utils import timezone
+from pymongo import MongoClient
+from pymongo.errors import ConnectionFailure
+
+
+class ConnectionManager(object):
+    """
+    Keeps one MongoDB client (and it's connection pool) per process.
+
+    The client is only created when it's first used, so a client created in
+    the master process (e.g. at import time) is never shared with the workers
+    gunicorn forks from it: if the process id changes, a new client is
+    created.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._client = None
+        self._collections = {}
+        self._created_at = None
+        self.clients_created = 0
+        self.wait_queue_timeouts = 0
+
+    def _create_client(self):
+        return MongoClient(host=settings.MONGODB_URIS,
+                max_pool_size=settings.MONGODB_MAX_POOL_SIZE,
+                connectTimeoutMS=settings.MONGODB_CONNECT_TIMEOUT_MS,
+                socketTimeoutMS=settings.MONGODB_SOCKET_TIMEOUT_MS,
+                waitQueueTimeoutMS=settings.MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+                readPreference=settings.MONGODB_READ_PREFERENCE,
+                w=settings.MONGODB_WRITE_CONCERN, _connect=False)
+
+    @property
+    def client(self):
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    self._collections = {}
+                    self._client = self._create_client()
+                    self._pid = os.getpid()
+                    self._created_at = timezone.now()
+                    self.clients_created += 1
+        return self._client
+
+    @property
+    def database(self):
+        return self.client[settings.MONGODB_DBNAME]
+
+    def collection(self, name=None):
+        """
+        Returns the collection called `name` (by default, the collection that
+        stores the analysis). The same collection object is returned while
+        the client is the same.
+        """
+        name = name or settings.MONGODB_COLLECTION
+        database = self.database
+        if name not in self._collections:
+            self._collections[name] = database[name]
+        return self._collections[name]
+
+    def stats(self):
+        """
+        Statistics about the connection pool of the current process. These
+        are meant to help sizing `MONGODB_MAX_POOL_SIZE`: if there are often
+        no `idle_sockets`, `sockets_in_use` is close to `max_pool_size` or
+        requests fail with `wait_queue_timeouts`, the pool is too small.
+        """
+        stats = {
+            'pid': os.getpid(),
+            'clients_created': self.clients_created,
+            'client_created_at': None,
+            'max_pool_size': settings.MONGODB_MAX_POOL_SIZE,
+            'idle_sockets': None,
+            'sockets_in_use': None,
+            'wait_queue_timeouts': self.wait_queue_timeouts,
+        }
+        if self._client is None or self._pid != os.getpid():
+            return stats
+        stats['client_created_at'] = self._created_at
+        # pymongo does not expose the pool, so we need to look for it in the
+        # client's private attributes (which may change between versions).
+        member = getattr(self._client, '_MongoClient__member', None)
+        pool = getattr(member, 'pool', None)
+        if pool is None:
+            return stats
+        sockets = getattr(pool, 'sockets', None)
+        if sockets is not None:
+            stats['idle_sockets'] = len(sockets)
+        free_slots = getattr(getattr(pool, '_socket_semaphore', None),
+                'counter', None)
+        if free_slots is not None and pool.max_size is not None:
+            stats['sockets_in_use'] = pool.max_size - free_slots
+        return stats
+
+    def record_error(self, error):
+        """
+        Counts the requests that failed because no connection of the pool
+        became free in `MONGODB_WAIT_QUEUE_TIMEOUT_MS`.
+        """
+        if (isinstance(error, ConnectionFailure) and
+                'waiting for socket' in str(error)):
+            self.wait_queue_timeouts += 1
+
+connection_manager = ConnectionManager()
+
+def record_request_error(sender, **kwargs):
+    connection_manager.record_error(sys.exc_info()[1])
+
+got_request_exception.connect(record_request_error)
@@ -0,0 +1,98 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
+from rest_framework.utils import encoders
+
+
+class EventStreamRenderer(JSONRenderer):
+    """
+    Lets clients ask for server-sent events (`Accept: text/event-stream`).
+    Views that support it return the stream themselves, so this is only used
+    to render errors (as JSON).
+    """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+
+
+def _encoder():
+    separators = (',', ':') if api_settings.COMPACT_JSON else None
+    return encoders.JSONEncoder(ensure_ascii=not api_settings.UNICODE_JSON,
+            separators=separators)
+
+
+def _encode(encoder, value):
+    for chunk in encoder.iterencode(value):
+        yield chunk.encode('utf-8')
+
+
+def iter_property_json(document, name, batch_size):
+    """
+    Yields the JSON representation of an analysis result in parts. Lists are
+    fetched from MongoDB `batch_size` items at a time, so only one batch is
+    kept in memory. Raises `KeyError` (before yielding anything) if the
+    result is not available.
+    """
+    encoder = _encoder()
+    result = document.fetch_property_slice(name, 0, batch_size)
+    if not result['is_list']:
+        for chunk in _encode(encoder, result['value']):
+            yield chunk
+        return
+
+    offset = 0
+    yield b'['
+    while True:
+        for index, item in enumerate(result['value']):
+            if offset or index:
+                yield b','
+            for chunk in _encode(encoder, item):
+                yield chunk
+        offset += batch_size
+        if offset >= result['count']:
+            break
+        result = document.fetch_property_slice(name, offset, batch_size)
+    yield b']'
+
+
+def render_property_stream(document, name, batch_size):
+    """
+    Renders the same JSON as `PropertyDetail` (`{"value": ...}`) as a
+    generator, reading the analysis results from MongoDB while the response is
+    written. If `name` is `all_data`, every available result is rendered one
+    after the other.
+    """
+    encoder = _encoder()
+    yield b'{"value":'
+    if name != 'all_data':
+        for chunk in iter_property_json(document, name, batch_size):
+            yield chunk
+    else:
+        yield b'{'
+        for index, property_name in enumerate(document.property_names()):
+            if index:
+                yield b','
+            for chunk in _encode(encoder, property_name):
+                yield chunk
+            yield b':'
+            for chunk in iter_property_json(document, property_name,
+                    batch_size):
+                yield chunk
+        yield b'}'
+    yield b'}'
@@ -16,12 +16,29 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+from django.conf import settings
 from django.forms.models import ModelChoiceIterator
 from rest_framework import serializers
 from rest_framework.reverse import reverse
 
+from pypln.web.backend_adapter.pipelines import stages_for_analyses
 from pypln.web.core.models import Corpus, Document, IndexedDocument
 
+
+class AnalysesField(serializers.CharField):
+    """
+    Comma separated names of analysis results (such as `tokens,freqdist`),
+    validated into the list of stages needed to produce them.
+    """
+
+    def to_internal_value(self, data):
+        data = super(AnalysesField, self).to_internal_value(data)
+        analyses = [name.strip() for name in data.split(',') if name.strip()]
+        try:
+            return stages_for_analyses(analyses)
+        except ValueError as exc:
+            raise serializers.ValidationError(str(exc))
+
 class CorpusSerializer(serializers.HyperlinkedModelSerializer):
     owner = serializers.ReadOnlyField(source="owner.username")
     documents = serializers.HyperlinkedIdentityField(
@@ -36,13 +53,21 @@ class CorpusSerializer(serializers.HyperlinkedModelSerializer):
         else:
             return value
 
+    def validate_pipeline(self, value):
+        if value not in settings.ANALYSIS_PIPELINES:
+            raise serializers.ValidationError("Unknown pipeline. Available "
+                    "pipelines: {}.".format(', '.join(sorted(
+                        settings.ANALYSIS_PIPELINES))))
+        return value
+
 
 class DocumentSerializer(serializers.HyperlinkedModelSerializer):
     owner = serializers.ReadOnlyField(source="owner.username")
     corpus = serializers.HyperlinkedRelatedField(view_name="corpus-detail", queryset=Corpus.objects.all())
-    size = serializers.ReadOnlyField(source="blob.size")
+    size = serializers.ReadOnlyField()
     blob = serializers.FileField(use_url=False)
     properties = serializers.HyperlinkedIdentityField(view_name="property-list")
+    analyses = AnalysesField(write_only=True, required=False)
 
     def __init__(self, *args, **kwargs):
         super(DocumentSerializer, self).__init__(*args, **kwargs)
@@ -69,8 +94,13 @@ class DocumentSerializer(serializers.HyperlinkedModelSerializer):
 
     def create(self, validated_data):
         validated_data['owner'] = self.context['request'].user
+        validated_data.pop('analyses', None)
         return super(DocumentSerializer, self).create(validated_data)
 
+    def update(self, instance, validated_data):
+        validated_data.pop('analyses', None)
+        return super(DocumentSerializer, self).update(instance, validated_data)
+
     def validate_corpus(self, value):
         if value.owner != self.context['request'].user:
             raise serializers.ValidationError("The corpus must belong to the user that is creating the document.")
@@ -79,6 +109,26 @@ class DocumentSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = Document
 
+class DocumentBulkUploadSerializer(serializers.Serializer):
+    corpus = serializers.HyperlinkedRelatedField(view_name="corpus-detail",
+            queryset=Corpus.objects.all())
+    archive = serializers.FileField(required=False)
+    analyses = AnalysesField(required=False)
+
+    def __init__(self, *args, **kwargs):
+        super(DocumentBulkUploadSerializer, self).__init__(*args, **kwargs)
+        self.fields['corpus'].queryset = Corpus.objects.filter(
+                owner=self.context['request'].user)
+
+    def validate(self, data):
+        # Any number of files can be sent in `blob`, and they're not handled
+        # by a serializer field.
+        if 'archive' not in data and \
+                not self.context['request'].FILES.getlist('blob'):
+            raise serializers.ValidationError("Either an `archive` or at "
+                    "least one `blob` is required.")
+        return data
+
 class IndexedDocumentSerializer(DocumentSerializer):
 
     url = serializers.HyperlinkedIdentityField(view_name="document-detail")
@@ -95,6 +145,6 @@ class PropertyListSerializer(serializers.Serializer):
         try:
             return [reverse('property-detail', kwargs={"pk": obj.id,
                 "property": prop}, request=request) for prop
-                in obj.properties.keys()]
+                in obj.property_names()]
         except KeyError:
             return []
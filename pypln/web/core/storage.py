@@ -18,18 +18,28 @@
 # along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
 
 import base64
-from bson import ObjectId
+from bson import Binary, ObjectId
+import hashlib
+import io
+import itertools
 import os
 import time
 import urlparse
 from django.core.exceptions import ImproperlyConfigured
 from django.core.files.storage import Storage
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
 from django.conf import settings
 from django.utils.encoding import filepath_to_uri
-from pymongo import Connection
+from pymongo import ASCENDING
 from gridfs import GridFS, NoFile
 
+from pypln.web.core.mongodb import connection_manager
+
+
+def base64_decoded_length(encoded_content):
+    padding = len(encoded_content) - len(encoded_content.rstrip('='))
+    return len(encoded_content) // 4 * 3 - padding
+
 
 class MongoDBBase64Storage(Storage):
     """
@@ -37,13 +47,22 @@ class MongoDBBase64Storage(Storage):
     We're not using GridFS because the workers will need the base64 encoded
     data anyways, and we also have a small file size limit that should make
     sure the MongoDB document does not exceed the maximum document size.
+
+    If `deduplicate` is True, saving a file with the same content as an
+    existing one (analysed by the same `PIPELINE_VERSION`) returns the name
+    of the existing one, so they share the stored data and the analysis. The
+    number of names given to each document is kept in `_blob.refcount`, and
+    `delete` only removes a document when this reaches zero.
     """
 
-    def __init__(self):
+    def __init__(self, deduplicate=None):
+        if deduplicate is None:
+            deduplicate = settings.DEDUPLICATE_UPLOADS
+        self.deduplicate = deduplicate
 
-        self._connection = Connection(host=settings.MONGODB_URIS)
-        self._db = self._connection[settings.MONGODB_DBNAME]
-        self.collection = self._db[settings.MONGODB_COLLECTION]
+    @property
+    def collection(self):
+        return connection_manager.collection()
 
     def _open(self, name, mode='rb'):
         document = self.collection.find_one(ObjectId(name))
@@ -52,20 +71,307 @@ class MongoDBBase64Storage(Storage):
         content = base64.b64decode(document['contents'])
         return ContentFile(content)
 
+    def _new_document(self, data):
+        return {'contents': base64.b64encode(data), '_blob': {
+            'encoding': 'base64', 'length': len(data), 'refcount': 1,
+            'sha1': hashlib.sha1(data).hexdigest(),
+            'pipeline_version': settings.PIPELINE_VERSION}}
+
+    def _reuse(self, sha1):
+        """
+        Returns the name of a stored document with the given content hash,
+        adding a reference to it, or None if there isn't one.
+        """
+        if not self.deduplicate:
+            return None
+        self.collection.ensure_index([('_blob.sha1', ASCENDING),
+            ('_blob.pipeline_version', ASCENDING)], sparse=True)
+        document = self.collection.find_and_modify({'_blob.sha1': sha1,
+            '_blob.pipeline_version': settings.PIPELINE_VERSION},
+            {'$inc': {'_blob.refcount': 1}}, fields={'_id': True})
+        if document is None:
+            return None
+        return str(document['_id'])
+
     def _save(self, name, content):
         content.seek(0)
-        encoded_content = base64.b64encode(content.read())
-        _id = self.collection.insert({'contents': encoded_content})
-        return str(_id)
+        document = self._new_document(content.read())
+        existing_name = self._reuse(document['_blob']['sha1'])
+        if existing_name is not None:
+            return existing_name
+        return str(self.collection.insert(document))
+
+    def prepare(self, data):
+        """
+        Returns what `save_prepared` needs to store a file with the given
+        contents. Encoding and hashing the contents is the expensive part of
+        saving a file, so this may run in other processes.
+        """
+        return self._new_document(data)
+
+    def save_many(self, contents):
+        """
+        Saves many files with a single insert (see `save_prepared`). Returns
+        their names, in the same order.
+        """
+        documents = []
+        for content in contents:
+            content.seek(0)
+            documents.append(self.prepare(content.read()))
+        return self.save_prepared(documents)
+
+    def save_prepared(self, documents):
+        """
+        Saves many files prepared by `prepare` with a single insert (files
+        that are already stored are reused, as in `save`). Returns their
+        names, in the same order.
+        """
+        names = []
+        new_documents = {}
+        for document in documents:
+            sha1 = document['_blob']['sha1']
+            if sha1 in new_documents:
+                new_documents[sha1]['_blob']['refcount'] += 1
+            else:
+                existing_name = self._reuse(sha1)
+                if existing_name is not None:
+                    names.append(existing_name)
+                    continue
+                document['_id'] = ObjectId()
+                new_documents[sha1] = document
+            names.append(str(new_documents[sha1]['_id']))
+        if new_documents:
+            self.collection.insert(new_documents.values())
+        return names
+
+    def delete(self, name):
+        document = self.collection.find_and_modify({'_id': ObjectId(name)},
+                {'$inc': {'_blob.refcount': -1}}, fields={'_blob': True},
+                new=True)
+        # Documents saved before references were counted have no refcount, so
+        # it becomes negative.
+        if document is not None and document['_blob']['refcount'] <= 0:
+            self._remove(document['_id'])
+
+    def _remove(self, _id):
+        self.collection.remove({'_id': _id})
+
+    def make_private(self, name):
+        """
+        Returns the name of a document with the same contents and analysis as
+        `name` that is not shared with any other name, copying it if needed.
+        Changes that only concern one name must be made to a private copy.
+        """
+        document = self.collection.find_one({'_id': ObjectId(name)},
+                {'_blob.refcount': True})
+        if document is None or document.get('_blob', {}).get('refcount',
+                1) <= 1:
+            return name
+        copy = self.collection.find_one({'_id': ObjectId(name)})
+        copy['_id'] = ObjectId()
+        copy['_blob']['refcount'] = 1
+        # The copy may be changed, so it must not be reused by new uploads.
+        copy['_blob'].pop('sha1', None)
+        self.collection.insert(copy)
+        self.delete(name)
+        return str(copy['_id'])
 
     def get_available_name(self, name, max_length=None):
         return "fake_name"
 
     def size(self, path):
-        document = self.collection.find_one({'_id': ObjectId(path)})
-        # when we b64decode 'contents' we get a str (not a unicode obj) so we
-        # can just get it's len() and have it's size.
-        return len(base64.b64decode(document['contents']))
+        document = self.collection.find_one({'_id': ObjectId(path)},
+                {'_blob.length': True})
+        if document is None:
+            raise ValueError("Document with name {} does not exist".format(path))
+        try:
+            return document['_blob']['length']
+        except KeyError:
+            return self.store_size(document['_id'])
+
+    def store_size(self, _id):
+        """
+        Calculates the size of a document saved before the size was recorded
+        with it, and records it so the next calls to `size` don't need to
+        fetch the contents again. Records without contents (e.g. analyses
+        whose document was deleted) have size 0, which is not recorded (see
+        the `backfill_blob_sizes` command).
+        """
+        document = self.collection.find_one({'_id': _id}, {'contents': True})
+        if document is None or 'contents' not in document:
+            return 0
+        length = base64_decoded_length(document['contents'])
+        self.collection.update({'_id': _id}, {'$set': {
+            '_blob.encoding': 'base64', '_blob.length': length}})
+        return length
+
+    def get_metadata(self, names, fields=()):
+        """
+        Fetches the metadata (always including the size) of every one of the
+        given names using a single query. Returns a dict that maps each name to
+        its metadata document.
+        """
+        projection = dict.fromkeys(('_blob.length', ) + tuple(fields), True)
+        documents = self.collection.find({'_id': {'$in': [ObjectId(name) for
+            name in names]}}, projection)
+        metadata = {}
+        for document in documents:
+            blob = document.setdefault('_blob', {})
+            if 'length' not in blob:
+                blob['length'] = self.store_size(document['_id'])
+            metadata[str(document['_id'])] = document
+        return metadata
+
+    def get_keys(self, names, fields=()):
+        """
+        Lists the keys of each one of the given documents without transferring
+        their values. If a document has an `_available` list, it's used instead
+        of the actual keys. Returns a dict mapping each name to a dict with its
+        `keys` and the values of the requested (small) `fields`.
+        """
+        projection = dict.fromkeys(('_available', ) + tuple(fields), True)
+        projection['keys'] = {'$map': {
+            'input': {'$objectToArray': '$$ROOT'},
+            'as': 'field',
+            'in': '$$field.k',
+        }}
+        pipeline = [
+            {'$match': {'_id': {'$in': [ObjectId(name) for name in names]}}},
+            {'$project': projection},
+        ]
+        result = {}
+        for document in self.collection.aggregate(pipeline, cursor={}):
+            document['keys'] = document.pop('_available', document['keys'])
+            result[str(document.pop('_id'))] = document
+        return result
+
+
+class ChunkReader(io.RawIOBase):
+    """
+    Read-only raw stream over the chunks of a blob. Chunks are only fetched
+    from the cursor when the data they hold is requested, so a reader never
+    keeps more than one chunk in memory.
+    """
+
+    def __init__(self, cursor):
+        self._chunks = (chunk['data'] for chunk in cursor)
+        self._buffer = b''
 
-    def __del__(self):
-        self._connection.close()
+    def readable(self):
+        return True
+
+    def readinto(self, buffer_):
+        while not self._buffer:
+            try:
+                self._buffer = bytes(next(self._chunks))
+            except StopIteration:
+                return 0
+        length = min(len(buffer_), len(self._buffer))
+        buffer_[:length] = self._buffer[:length]
+        self._buffer = self._buffer[length:]
+        return length
+
+
+class MongoDBBinaryStorage(MongoDBBase64Storage):
+    """
+    This storage saves the file content as raw BSON binary data. Files that fit
+    in a single chunk are stored in the analysis document itself (in the
+    `_contents` key), bigger files are split into chunks stored in a separate
+    `<collection>.chunks` collection, similar to what GridFS does. Both the
+    upload and the download only keep one chunk in memory at a time.
+
+    Documents saved by `MongoDBBase64Storage` (with base64 encoded `contents`)
+    can still be read if `base64_fallback` is True.
+    """
+
+    def __init__(self, chunk_size=None, base64_fallback=True):
+        super(MongoDBBinaryStorage, self).__init__(deduplicate=False)
+        self.chunk_size = chunk_size or settings.MONGODB_BLOB_CHUNK_SIZE
+        self.base64_fallback = base64_fallback
+
+    @property
+    def chunks(self):
+        return connection_manager.collection(
+                '{}.chunks'.format(settings.MONGODB_COLLECTION))
+
+    def _read_chunks(self, content):
+        content.seek(0)
+        while True:
+            data = content.read(self.chunk_size)
+            if not data:
+                break
+            yield data
+
+    def _open(self, name, mode='rb'):
+        document = self.collection.find_one(ObjectId(name),
+                {'_blob': True, '_contents': True, 'contents': True})
+        if document is None:
+            raise ValueError("Document with name {} does not exist".format(name))
+        encoding = document.get('_blob', {}).get('encoding', 'base64')
+        if encoding == 'base64':
+            if not self.base64_fallback:
+                raise ValueError("Document with name {} was not saved as "
+                        "binary data".format(name))
+            return ContentFile(base64.b64decode(document['contents']))
+        if encoding == 'chunked':
+            cursor = self.chunks.find({'blob_id': document['_id']},
+                    {'data': True}).sort('n', ASCENDING)
+            return File(io.BufferedReader(ChunkReader(cursor),
+                self.chunk_size))
+        return ContentFile(document['_contents'])
+
+    def prepare(self, data):
+        # The contents are stored as they are.
+        return data
+
+    def save_prepared(self, documents):
+        return self.save_many([ContentFile(data) for data in documents])
+
+    def save_many(self, contents):
+        """
+        Saves many files, inserting all the ones that fit in a single chunk
+        with a single insert. Returns their names, in the same order.
+        """
+        names = []
+        documents = []
+        for content in contents:
+            chunks = self._read_chunks(content)
+            first_chunk = next(chunks, b'')
+            if next(chunks, None) is None:
+                _id = ObjectId()
+                documents.append({'_id': _id, '_contents': Binary(first_chunk),
+                    '_blob': {'encoding': 'binary',
+                        'length': len(first_chunk)}})
+                names.append(str(_id))
+            else:
+                names.append(self._save(None, content))
+        if documents:
+            self.collection.insert(documents)
+        return names
+
+    def _remove(self, _id):
+        super(MongoDBBinaryStorage, self)._remove(_id)
+        self.chunks.remove({'blob_id': _id})
+
+    def _save(self, name, content):
+        _id = ObjectId()
+        chunks = self._read_chunks(content)
+        first_chunk = next(chunks, b'')
+        second_chunk = next(chunks, None)
+        if second_chunk is None:
+            self.collection.insert({'_id': _id, '_contents': Binary(first_chunk),
+                '_blob': {'encoding': 'binary', 'length': len(first_chunk)}})
+            return str(_id)
+
+        self.chunks.ensure_index([('blob_id', ASCENDING), ('n', ASCENDING)],
+                unique=True)
+        length = 0
+        for n, data in enumerate(itertools.chain([first_chunk, second_chunk],
+                chunks)):
+            self.chunks.insert({'blob_id': _id, 'n': n, 'data': Binary(data)})
+            length += len(data)
+        # The analysis document is only created after all the chunks are
+        # stored, so a partially written blob is never visible.
+        self.collection.insert({'_id': _id, '_blob': {'encoding': 'chunked',
+            'chunks': n + 1, 'length': length}})
+        return str(_id)
@@ -0,0 +1,165 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import threading
+
+from django.core.cache import caches
+from django.test import TestCase
+
+from pypln.web.core.cache import LRUCache, PropertyCache
+
+__all__ = ["LRUCacheTest", "PropertyCacheTest"]
+
+
+class LRUCacheTest(TestCase):
+    def test_evicts_least_recently_used_entries_when_full(self):
+        cache = LRUCache(max_bytes=10)
+        cache.set('a', b'1234')
+        cache.set('b', b'1234')
+        cache.get('a')
+        cache.set('c', b'1234')
+        self.assertEqual(cache.get('a'), b'1234')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), b'1234')
+        self.assertEqual(cache.size, 8)
+
+    def test_does_not_keep_values_bigger_than_the_cache(self):
+        cache = LRUCache(max_bytes=3)
+        cache.set('a', b'1234')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.size, 0)
+
+    def test_replacing_a_value_updates_the_size(self):
+        cache = LRUCache(max_bytes=10)
+        cache.set('a', b'1234')
+        cache.set('a', b'12')
+        self.assertEqual(cache.size, 2)
+
+
+class PropertyCacheTest(TestCase):
+    def setUp(self):
+        self.cache = PropertyCache(local_max_bytes=100, max_entry_bytes=10,
+                alias='properties', timeout=60, wait_timeout=5)
+        self.cache.clear()
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def test_miss(self):
+        self.assertIsNone(self.cache.get('key', 'doc'))
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_local_hit(self):
+        self.cache.set('key', 'doc', b'content')
+        self.assertEqual(self.cache.get('key', 'doc'), b'content')
+        self.assertEqual(self.cache.stats()['local_hits'], 1)
+
+    def test_shared_hit_fills_the_local_cache(self):
+        caches['properties'].set('key', b'content')
+        self.assertEqual(self.cache.get('key', 'doc'), b'content')
+        self.assertEqual(self.cache.local.get('key'), b'content')
+        self.assertEqual(self.cache.stats()['shared_hits'], 1)
+
+    def test_does_not_cache_big_entries(self):
+        self.cache.set('key', 'doc', b'more than 10 bytes')
+        self.assertIsNone(self.cache.get('key', 'doc'))
+
+    def test_cache_stream(self):
+        chunks = list(self.cache.cache_stream('key', 'doc', [b'con', b'tent']))
+        self.assertEqual(chunks, [b'con', b'tent'])
+        self.assertEqual(self.cache.get('key', 'doc'), b'content')
+
+    def test_cache_stream_does_not_cache_big_streams(self):
+        chunks = [b'more than', b' 10 bytes']
+        self.assertEqual(list(self.cache.cache_stream('key', 'doc', chunks)),
+                chunks)
+        self.assertIsNone(self.cache.get('key', 'doc'))
+
+    def test_invalidate_removes_the_entries_of_the_document(self):
+        self.cache.set('key', 'doc', b'content')
+        self.cache.set('other', 'other_doc', b'content')
+        self.cache.invalidate('doc')
+        self.assertIsNone(self.cache.local.get('key'))
+        self.assertIsNone(caches['properties'].get('key'))
+        self.assertEqual(self.cache.local.get('other'), b'content')
+        self.assertEqual(caches['properties'].get('other'), b'content')
+
+    def test_evicted_entries_are_forgotten(self):
+        for i in range(20):
+            self.cache.set('key{}'.format(i), 'doc{}'.format(i), b'1234567890')
+        self.assertEqual(len(self.cache.local), 10)
+        self.assertEqual(len(self.cache._document_by_key), 10)
+        self.assertEqual(len(self.cache._keys_by_document), 10)
+        self.assertNotIn('doc0', self.cache._keys_by_document)
+
+    def test_first_request_leads(self):
+        content, token = self.cache.get_or_lead('key', 'doc')
+        self.assertIsNone(content)
+        self.assertIsNotNone(token)
+        self.assertEqual(self.cache.stats()['in_flight'], 1)
+        self.cache.set('key', 'doc', b'content', token)
+        self.assertEqual(self.cache.stats()['in_flight'], 0)
+
+    def test_concurrent_requests_wait_for_the_leader(self):
+        content, token = self.cache.get_or_lead('key', 'doc')
+        results = []
+        followers = [threading.Thread(target=lambda: results.append(
+            self.cache.get_or_lead('key', 'doc'))) for i in range(3)]
+        for follower in followers:
+            follower.start()
+        self.cache.set('key', 'doc', b'content', token)
+        for follower in followers:
+            follower.join()
+        self.assertEqual(results, [(b'content', None)] * 3)
+
+    def test_waiting_requests_render_themselves_if_it_is_not_cached(self):
+        content, token = self.cache.get_or_lead('key', 'doc')
+        results = []
+        follower = threading.Thread(target=lambda: results.append(
+            self.cache.get_or_lead('key', 'doc')))
+        follower.start()
+        self.cache.release('key', token)
+        follower.join()
+        # The follower may also become the next leader, if it's late.
+        self.assertIsNone(results[0][0])
+
+    def test_only_the_leader_wakes_up_waiting_requests(self):
+        content, token = self.cache.get_or_lead('key', 'doc')
+        # A request that stopped waiting renders and caches the content
+        # without releasing the leader's waiting requests.
+        self.cache.release('key', None)
+        self.cache.set('key', 'doc', b'content')
+        self.assertEqual(self.cache.stats()['in_flight'], 1)
+        self.cache.local.delete('key')
+        caches['properties'].delete('key')
+        results = []
+        follower = threading.Thread(target=lambda: results.append(
+            self.cache.get_or_lead('key', 'doc')))
+        follower.start()
+        self.cache.set('key', 'doc', b'content', token)
+        follower.join()
+        self.assertEqual(results, [(b'content', None)])
+        self.assertEqual(self.cache.stats()['in_flight'], 0)
+
+    def test_big_stream_releases_waiting_requests(self):
+        content, token = self.cache.get_or_lead('key', 'doc')
+        stream = self.cache.cache_stream('key', 'doc', [b'more than',
+            b' 10 bytes', b'!'], token)
+        next(stream)
+        next(stream)
+        self.assertEqual(self.cache.stats()['in_flight'], 0)
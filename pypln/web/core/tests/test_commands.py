@@ -0,0 +1,193 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import base64
+import json
+import os
+import shutil
+from StringIO import StringIO
+import tempfile
+
+from bson import ObjectId
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import patch
+
+from pypln.web.backend_adapter.models import PipelineRequest
+from pypln.web.core.management.commands.resend_pipelines import RateLimiter
+from pypln.web.core.models import Corpus, Document, mongodb_storage
+from pypln.web.core.tests.utils import TestWithMongo
+
+__all__ = ["BackfillBlobSizesTest", "ImportDirectoryTest",
+    "ResendPipelinesTest", "RateLimiterTest"]
+
+
+class BackfillBlobSizesTest(TestWithMongo):
+
+    def test_records_missing_sizes(self):
+        _id = mongodb_storage.collection.insert(
+                {'contents': base64.b64encode('abcde')})
+        call_command('backfill_blob_sizes', stdout=StringIO())
+        record = mongodb_storage.collection.find_one({'_id': _id})
+        self.assertEqual(record['_blob'], {'encoding': 'base64',
+            'length': 5})
+
+    def test_skips_records_without_contents(self):
+        without_contents = mongodb_storage.collection.insert({'text': 'abc'})
+        _id = mongodb_storage.collection.insert(
+                {'contents': base64.b64encode('abcde')})
+        output = StringIO()
+        call_command('backfill_blob_sizes', stdout=output)
+        self.assertEqual(mongodb_storage.collection.find_one(
+            {'_id': _id})['_blob']['length'], 5)
+        self.assertNotIn('_blob', mongodb_storage.collection.find_one(
+            {'_id': without_contents}))
+        self.assertIn("Skipped 1 records without contents.",
+                output.getvalue())
+
+
+class ImportDirectoryTest(TestWithMongo):
+    fixtures = ['users', 'corpora']
+
+    def setUp(self):
+        self.corpus = Corpus.objects.filter(owner__username="user")[0]
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        os.mkdir(os.path.join(self.directory, 'sub'))
+        for name, content in [('first.txt', 'First'),
+                ('sub/second.txt', 'Second')]:
+            with open(os.path.join(self.directory, name), 'w') as fp:
+                fp.write(content)
+        checkpoint_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, checkpoint_directory)
+        self.checkpoint = os.path.join(checkpoint_directory, 'import.checkpoint')
+        self.stderr = StringIO()
+
+    def import_directory(self):
+        call_command('import_directory', str(self.corpus.id), self.directory,
+                workers=2, batch_size=1, checkpoint=self.checkpoint,
+                stdout=StringIO(), stderr=self.stderr)
+
+    def imported_contents(self):
+        return [document.blob.read() for document in
+                self.corpus.document_set.order_by('id')]
+
+    @patch('pypln.web.core.ingest.enqueue_pipelines')
+    def test_imports_every_file(self, enqueue_pipelines):
+        self.import_directory()
+        self.assertEqual(self.imported_contents(), ['First', 'Second'])
+        self.assertEqual(enqueue_pipelines.call_count, 2)
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    @override_settings(BULK_UPLOAD_MAX_FILE_SIZE=5)
+    @patch('pypln.web.core.ingest.enqueue_pipelines')
+    def test_skips_big_files(self, enqueue_pipelines):
+        self.import_directory()
+        self.assertEqual(self.imported_contents(), ['First'])
+        self.assertIn("Skipping sub/second.txt", self.stderr.getvalue())
+
+    @patch('pypln.web.core.ingest.enqueue_pipelines')
+    def test_resumes_from_the_checkpoint(self, enqueue_pipelines):
+        with open(self.checkpoint, 'w') as fp:
+            json.dump({'corpus_id': self.corpus.id,
+                'directory': self.directory, 'imported': 1,
+                'last_path': os.path.join(self.directory, 'first.txt')}, fp)
+        self.import_directory()
+        self.assertEqual(self.imported_contents(), ['Second'])
+
+
+class ResendPipelinesTest(TestWithMongo):
+    fixtures = ['users', 'corpora', 'documents']
+
+    def setUp(self):
+        self.document = Document.objects.get(owner__username="user")
+        # Shares the analysis of the first document.
+        self.copy = Document.objects.create(blob=self.document.blob.name,
+                owner=self.document.owner, corpus=self.document.corpus)
+        self.stdout = StringIO()
+
+    def resend_pipelines(self, *args, **options):
+        call_command('resend_pipelines', *args, stdout=self.stdout, **options)
+
+    def requested_documents(self):
+        return [request.document for request in
+                PipelineRequest.objects.order_by('id')]
+
+    def test_requests_each_analysis_once(self):
+        self.resend_pipelines()
+        self.assertEqual(self.requested_documents(), list(
+            Document.objects.exclude(pk=self.copy.pk).order_by('id')))
+        requests = PipelineRequest.objects.all()
+        self.assertTrue(all(request.force for request in requests))
+        self.assertTrue(all(request.lane == PipelineRequest.BULK
+            for request in requests))
+        self.assertTrue(all(request.status == PipelineRequest.PENDING
+            for request in requests))
+
+    def test_reads_the_documents_in_chunks(self):
+        self.resend_pipelines('--chunk-size', '1')
+        self.assertIn("last id: {}.".format(self.copy.pk),
+                self.stdout.getvalue())
+        self.assertEqual(self.stdout.getvalue().count("last id"), 3)
+        # Documents sharing an analysis are only deduplicated in a chunk.
+        self.assertEqual(PipelineRequest.objects.count(), 3)
+
+    def test_resumes_after_an_id(self):
+        self.resend_pipelines('--after-id', str(self.document.pk))
+        self.assertEqual(self.requested_documents(), [self.copy])
+
+    def test_incremental_requests_only_the_missing_stages(self):
+        mongodb_storage.collection.update(
+                {'_id': ObjectId(self.document.blob.name)},
+                {'$unset': {'freqdist': True}})
+        self.resend_pipelines('--incremental')
+        request = PipelineRequest.objects.get()
+        self.assertEqual(request.document, self.document)
+        self.assertEqual(request.stages, 'FreqDist,Statistics')
+
+    def test_dry_run_does_not_request_anything(self):
+        self.resend_pipelines('--dry-run')
+        self.assertFalse(PipelineRequest.objects.exists())
+        self.assertIn("Would send pipeline for document {}".format(
+            self.document.pk), self.stdout.getvalue())
+
+    @patch('pypln.web.core.management.commands.resend_pipelines.RateLimiter')
+    def test_limits_the_rate_of_requests(self, RateLimiter):
+        self.resend_pipelines('--rate', '10')
+        RateLimiter.assert_called_with(10)
+        RateLimiter.return_value.wait.assert_called_with(2)
+
+
+@patch('pypln.web.core.management.commands.resend_pipelines.time')
+class RateLimiterTest(TestCase):
+
+    def test_waits_for_the_previous_calls(self, time):
+        time.time.return_value = 100.0
+        rate_limiter = RateLimiter(10)
+        rate_limiter.wait(5)
+        time.sleep.assert_called_with(0)
+        rate_limiter.wait()
+        time.sleep.assert_called_with(0.5)
+
+    def test_does_not_wait_without_a_rate(self, time):
+        time.time.return_value = 100.0
+        rate_limiter = RateLimiter(0)
+        rate_limiter.wait(5)
+        rate_limiter.wait()
+        self.assertFalse(time.sleep.called)
@@ -18,13 +18,17 @@
 # along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
 from StringIO import StringIO
 
+from bson import ObjectId
+
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.files import File
 from django.db import IntegrityError
 from django.test import TestCase
+from mock import patch
 
-from pypln.web.core.models import Corpus, Document
+from pypln.web.core.models import Corpus, Document, mongodb_storage
+from pypln.web.core.models import prefetch_blob_metadata
 from pypln.web.core.tests.utils import TestWithMongo
 
 __all__ = ["CorpusModelTest", "DocumentModelTest"]
@@ -64,3 +68,72 @@ class DocumentModelTest(TestWithMongo):
         expected_data = u'Test file with non-ascii char: á.'
         document = Document.objects.all()[0]
         self.assertEqual(document.properties['text'], expected_data)
+
+    def test_size_is_the_blob_size(self):
+        document = Document.objects.all()[0]
+        self.assertEqual(document.size, document.blob.size)
+
+    def test_prefetch_blob_metadata_gets_sizes_in_a_single_query(self):
+        expected_sizes = [document.blob.size for document in
+                Document.objects.all()]
+        with patch.object(mongodb_storage, 'size') as size:
+            documents = prefetch_blob_metadata(Document.objects.all())
+            self.assertEqual([document.size for document in documents],
+                    expected_sizes)
+            self.assertFalse(size.called)
+
+    def test_get_property_from_store(self):
+        document = Document.objects.all()[0]
+        self.assertEqual(document.get_property('text'),
+                u'Test file with non-ascii char: á.')
+
+    def test_get_property_that_does_not_exist(self):
+        document = Document.objects.all()[0]
+        with self.assertRaises(KeyError):
+            document.get_property('inexistent')
+
+    def test_get_properties_only_includes_available_properties(self):
+        document = Document.objects.all()[0]
+        properties = document.get_properties(['text', 'language',
+            'inexistent'])
+        self.assertEqual(sorted(properties.keys()), ['language', 'text'])
+
+    def test_get_properties_does_not_include_storage_metadata(self):
+        document = Document.objects.all()[0]
+        self.assertEqual(document.get_properties(['_blob']), {})
+
+    def test_get_properties_only_fetches_requested_keys(self):
+        document = Document.objects.all()[0]
+        with patch('pypln.web.core.models.connection_manager') as manager:
+            find_one = manager.collection.return_value.find_one
+            find_one.return_value = {'text': 'Some text'}
+            document.get_properties(['text'])
+        self.assertEqual(find_one.call_args[0][1], {'text': True})
+
+    def test_get_properties_remembers_fetched_properties(self):
+        document = Document.objects.all()[0]
+        expected_data = document.get_properties(['text', 'inexistent'])
+        with patch('pypln.web.core.models.connection_manager') as manager:
+            self.assertEqual(document.get_properties(['text', 'inexistent']),
+                    expected_data)
+        self.assertFalse(manager.collection.called)
+
+    def test_property_names_from_store(self):
+        document = Document.objects.all()[0]
+        self.assertEqual(document.property_names(),
+                sorted(document.properties.keys()))
+
+    def test_property_names_does_not_fetch_values(self):
+        document = Document.objects.all()[0]
+        with patch('pypln.web.core.storage.connection_manager') as manager:
+            collection = manager.collection.return_value
+            collection.aggregate.return_value = [{'_id': document.blob.name,
+                'keys': ['_id', '_blob', 'text', 'tokens']}]
+            self.assertEqual(document.property_names(), ['text', 'tokens'])
+        self.assertFalse(collection.find_one.called)
+
+    def test_property_names_uses_available_list_if_it_exists(self):
+        document = Document.objects.all()[0]
+        mongodb_storage.collection.update({'_id': ObjectId(document.blob.name)},
+                {'$set': {'_available': ['text']}})
+        self.assertEqual(document.property_names(), ['text'])
@@ -0,0 +1,90 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+from django.conf import settings
+from django.test import TestCase
+from mock import patch
+from pymongo.errors import ConnectionFailure
+
+from pypln.web.core.mongodb import ConnectionManager
+
+__all__ = ["ConnectionManagerTest"]
+
+
+class ConnectionManagerTest(TestCase):
+    def test_client_is_only_created_when_used(self):
+        manager = ConnectionManager()
+        self.assertEqual(manager.clients_created, 0)
+        manager.client
+        self.assertEqual(manager.clients_created, 1)
+
+    def test_client_is_reused_in_the_same_process(self):
+        manager = ConnectionManager()
+        self.assertIs(manager.client, manager.client)
+        self.assertEqual(manager.clients_created, 1)
+
+    @patch('pypln.web.core.mongodb.os.getpid')
+    def test_new_client_is_created_after_fork(self, getpid):
+        manager = ConnectionManager()
+        getpid.return_value = 1000
+        parent_client = manager.client
+        parent_collection = manager.collection()
+        getpid.return_value = 1001
+        self.assertIsNot(manager.client, parent_client)
+        self.assertIsNot(manager.collection(), parent_collection)
+        self.assertEqual(manager.clients_created, 2)
+
+    def test_collection_defaults_to_analysis_collection(self):
+        manager = ConnectionManager()
+        collection = manager.collection()
+        self.assertEqual(collection.name, settings.MONGODB_COLLECTION)
+        self.assertEqual(collection.database.name, settings.MONGODB_DBNAME)
+        self.assertIs(manager.collection(), collection)
+
+    def test_stats_before_client_is_created(self):
+        manager = ConnectionManager()
+        stats = manager.stats()
+        self.assertEqual(stats['clients_created'], 0)
+        self.assertEqual(stats['max_pool_size'],
+                settings.MONGODB_MAX_POOL_SIZE)
+        self.assertIsNone(stats['client_created_at'])
+
+    def test_stats_after_client_is_used(self):
+        manager = ConnectionManager()
+        manager.collection().find_one()
+        stats = manager.stats()
+        self.assertEqual(stats['clients_created'], 1)
+        self.assertIsNotNone(stats['client_created_at'])
+        self.assertGreaterEqual(stats['idle_sockets'], 1)
+        self.assertEqual(stats['sockets_in_use'], 0)
+
+    def test_stats_without_the_pool(self):
+        manager = ConnectionManager()
+        manager.client
+        with patch.object(manager._client, '_MongoClient__member', None):
+            stats = manager.stats()
+        self.assertIsNone(stats['idle_sockets'])
+        self.assertIsNone(stats['sockets_in_use'])
+
+    def test_counts_wait_queue_timeouts(self):
+        manager = ConnectionManager()
+        manager.record_error(ConnectionFailure('Timed out waiting for socket '
+            'from pool with max_size 1 and wait_queue_timeout 1'))
+        manager.record_error(ConnectionFailure('connection refused'))
+        manager.record_error(ValueError())
+        self.assertEqual(manager.stats()['wait_queue_timeouts'], 1)
@@ -0,0 +1,57 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import json
+
+from pypln.web.core.models import Document
+from pypln.web.core.renderers import render_property_stream
+from pypln.web.core.tests.utils import TestWithMongo
+
+__all__ = ["RenderPropertyStreamTest"]
+
+
+class RenderPropertyStreamTest(TestWithMongo):
+    fixtures = ['users', 'corpora', 'documents']
+
+    def setUp(self):
+        self.document = Document.objects.all()[0]
+
+    def render(self, name, batch_size):
+        return json.loads(''.join(render_property_stream(self.document, name,
+            batch_size)))
+
+    def test_renders_list_property_in_batches(self):
+        expected_data = {'value': self.document.properties['tokens']}
+        for batch_size in (1, 3, 8, 100):
+            self.assertEqual(self.render('tokens', batch_size), expected_data)
+
+    def test_renders_nested_list_property(self):
+        self.assertEqual(self.render('pos', 3),
+                {'value': self.document.properties['pos']})
+
+    def test_renders_property_that_is_not_a_list(self):
+        self.assertEqual(self.render('text', 3),
+                {'value': self.document.properties['text']})
+
+    def test_renders_all_data(self):
+        self.assertEqual(self.render('all_data', 3),
+                {'value': self.document.properties})
+
+    def test_inexistent_property(self):
+        with self.assertRaises(KeyError):
+            self.render('inexistent', 3)
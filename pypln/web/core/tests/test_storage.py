@@ -19,20 +19,22 @@
 import base64
 
 from bson import ObjectId
-from mock import MagicMock
+from mock import patch
 from django.core.files.base import ContentFile
 from django.test import TestCase
 
-from pypln.web.core.storage import MongoDBBase64Storage
+from pypln.web.core.storage import MongoDBBase64Storage, MongoDBBinaryStorage
+from pypln.web.core.tests.utils import TestWithMongo
 
 
-class MongoDBBase64StorageTest(TestCase):
+class MongoDBBase64StorageTest(TestWithMongo):
     def test_saving_file_returns_document_id_as_filename(self):
         content = 'This is the file content with non-ascii chars: á.'
         storage = MongoDBBase64Storage()
-        storage.collection.insert = MagicMock(return_value='mocked_id')
         file_obj = ContentFile(content)
-        name = storage.save('filename.txt', content=file_obj)
+        with patch.object(storage.collection, 'insert',
+                return_value='mocked_id'):
+            name = storage.save('filename.txt', content=file_obj)
         self.assertEqual('mocked_id', name)
 
     def test_saving_file_stores_base64_encoded_data(self):
@@ -63,3 +65,169 @@ class MongoDBBase64StorageTest(TestCase):
         with self.assertRaises(ValueError):
             storage.open(ObjectId('abcdabcd1234567812345678'))
 
+    def test_saving_file_records_its_size(self):
+        content = 'This is the file content with non-ascii chars: á.'
+        storage = MongoDBBase64Storage()
+        name = storage.save('filename.txt', content=ContentFile(content))
+        saved_file = storage.collection.find_one({'_id': ObjectId(name)})
+        self.assertEqual(saved_file['_blob']['length'], len(content))
+
+    def test_size_uses_recorded_size(self):
+        storage = MongoDBBase64Storage()
+        _id = storage.collection.insert({'contents': base64.b64encode('abc'),
+            '_blob': {'encoding': 'base64', 'length': 42}})
+        self.assertEqual(storage.size(str(_id)), 42)
+
+    def test_size_of_file_saved_without_size_is_recorded(self):
+        content = 'This is the file content with non-ascii chars: á.'
+        storage = MongoDBBase64Storage()
+        _id = storage.collection.insert(
+                {'contents': base64.b64encode(content)})
+        self.assertEqual(storage.size(str(_id)), len(content))
+        saved_file = storage.collection.find_one({'_id': _id})
+        self.assertEqual(saved_file['_blob']['length'], len(content))
+
+    def test_size_of_record_without_contents_is_zero(self):
+        storage = MongoDBBase64Storage()
+        _id = storage.collection.insert({'text': 'Analysis only'})
+        self.assertEqual(storage.size(str(_id)), 0)
+        self.assertEqual(storage.get_metadata([str(_id)])[str(_id)][
+            '_blob']['length'], 0)
+        self.assertNotIn('_blob', storage.collection.find_one({'_id': _id}))
+
+    def test_save_many_inserts_all_files_at_once(self):
+        storage = MongoDBBase64Storage()
+        contents = [ContentFile('first'), ContentFile('second')]
+        with patch.object(storage.collection, 'insert') as insert:
+            names = storage.save_many(contents)
+        self.assertEqual(len(names), 2)
+        self.assertEqual(insert.call_count, 1)
+
+    def test_save_many_stores_each_file(self):
+        storage = MongoDBBase64Storage()
+        names = storage.save_many([ContentFile('first'),
+            ContentFile('second')])
+        self.assertEqual([storage.open(name).read() for name in names],
+                ['first', 'second'])
+
+    def test_saving_same_content_twice_reuses_the_stored_document(self):
+        storage = MongoDBBase64Storage(deduplicate=True)
+        name = storage.save('filename.txt', content=ContentFile('content'))
+        other_name = storage.save('other.txt', content=ContentFile('content'))
+        self.assertEqual(name, other_name)
+        saved_file = storage.collection.find_one({'_id': ObjectId(name)})
+        self.assertEqual(saved_file['_blob']['refcount'], 2)
+
+    def test_saving_same_content_without_deduplication(self):
+        storage = MongoDBBase64Storage(deduplicate=False)
+        name = storage.save('filename.txt', content=ContentFile('content'))
+        other_name = storage.save('other.txt', content=ContentFile('content'))
+        self.assertNotEqual(name, other_name)
+
+    def test_documents_of_other_pipeline_versions_are_not_reused(self):
+        storage = MongoDBBase64Storage(deduplicate=True)
+        name = storage.save('filename.txt', content=ContentFile('content'))
+        with self.settings(PIPELINE_VERSION='another version'):
+            other_name = storage.save('other.txt',
+                    content=ContentFile('content'))
+        self.assertNotEqual(name, other_name)
+
+    def test_save_many_reuses_documents_with_the_same_content(self):
+        storage = MongoDBBase64Storage(deduplicate=True)
+        name = storage.save('filename.txt', content=ContentFile('stored'))
+        names = storage.save_many([ContentFile('stored'), ContentFile('new'),
+            ContentFile('new')])
+        self.assertEqual(names[0], name)
+        self.assertEqual(names[1], names[2])
+        saved_file = storage.collection.find_one({'_id': ObjectId(names[1])})
+        self.assertEqual(saved_file['_blob']['refcount'], 2)
+
+    def test_delete_only_removes_the_document_without_references(self):
+        storage = MongoDBBase64Storage(deduplicate=True)
+        name = storage.save('filename.txt', content=ContentFile('content'))
+        storage.save('other.txt', content=ContentFile('content'))
+        storage.delete(name)
+        self.assertIsNotNone(storage.collection.find_one(
+            {'_id': ObjectId(name)}))
+        storage.delete(name)
+        self.assertIsNone(storage.collection.find_one({'_id': ObjectId(name)}))
+
+    def test_delete_document_saved_without_refcount(self):
+        storage = MongoDBBase64Storage()
+        _id = storage.collection.insert({'contents': base64.b64encode('abc')})
+        storage.delete(str(_id))
+        self.assertIsNone(storage.collection.find_one({'_id': _id}))
+
+    def test_make_private_copies_shared_documents(self):
+        storage = MongoDBBase64Storage(deduplicate=True)
+        name = storage.save('filename.txt', content=ContentFile('content'))
+        storage.save('other.txt', content=ContentFile('content'))
+        private_name = storage.make_private(name)
+        self.assertNotEqual(private_name, name)
+        self.assertEqual(storage.open(private_name).read(), 'content')
+        saved_file = storage.collection.find_one({'_id': ObjectId(name)})
+        self.assertEqual(saved_file['_blob']['refcount'], 1)
+        self.assertEqual(storage.make_private(private_name), private_name)
+
+
+class MongoDBBinaryStorageTest(TestCase):
+    def test_saving_small_file_stores_binary_data_in_the_document(self):
+        content = 'This is the file content with non-ascii chars: á.'
+        storage = MongoDBBinaryStorage()
+        name = storage.save('filename.txt', content=ContentFile(content))
+        saved_file = storage.collection.find_one({'_id': ObjectId(name)})
+        self.assertEqual(saved_file['_contents'], content)
+        self.assertEqual(saved_file['_blob']['encoding'], 'binary')
+        self.assertNotIn('contents', saved_file)
+
+    def test_saving_big_file_splits_data_in_chunks(self):
+        content = 'abcdefghij' * 3
+        storage = MongoDBBinaryStorage(chunk_size=8)
+        name = storage.save('filename.txt', content=ContentFile(content))
+        saved_file = storage.collection.find_one({'_id': ObjectId(name)})
+        self.assertEqual(saved_file['_blob']['encoding'], 'chunked')
+        self.assertEqual(saved_file['_blob']['chunks'], 4)
+        self.assertNotIn('_contents', saved_file)
+        chunks = storage.chunks.find({'blob_id': ObjectId(name)}).sort('n')
+        self.assertEqual(''.join(chunk['data'] for chunk in chunks), content)
+
+    def test_opening_small_file_returns_original_data(self):
+        content = 'This is the file content with non-ascii chars: á.'
+        storage = MongoDBBinaryStorage()
+        name = storage.save('filename.txt', content=ContentFile(content))
+        self.assertEqual(storage.open(name).read(), content)
+
+    def test_opening_chunked_file_returns_original_data(self):
+        content = 'This is the file content with non-ascii chars: á.'
+        storage = MongoDBBinaryStorage(chunk_size=8)
+        name = storage.save('filename.txt', content=ContentFile(content))
+        self.assertEqual(storage.open(name).read(), content)
+
+    def test_opening_base64_file_with_fallback(self):
+        content = 'This is the file content with non-ascii chars: á.'
+        storage = MongoDBBinaryStorage()
+        _id = storage.collection.insert(
+                {'contents': base64.b64encode(content)})
+        self.assertEqual(storage.open(str(_id)).read(), content)
+
+    def test_opening_base64_file_without_fallback(self):
+        content = 'This is the file content with non-ascii chars: á.'
+        storage = MongoDBBinaryStorage(base64_fallback=False)
+        _id = storage.collection.insert(
+                {'contents': base64.b64encode(content)})
+        with self.assertRaises(ValueError):
+            storage.open(str(_id))
+
+    def test_size_of_chunked_file(self):
+        content = 'This is the file content with non-ascii chars: á.'
+        storage = MongoDBBinaryStorage(chunk_size=8)
+        name = storage.save('filename.txt', content=ContentFile(content))
+        self.assertEqual(storage.size(name), len(content))
+
+    def test_save_many_keeps_the_order_of_small_and_chunked_files(self):
+        storage = MongoDBBinaryStorage(chunk_size=8)
+        contents = ['small', 'abcdefghij' * 3, 'tiny']
+        names = storage.save_many([ContentFile(content) for content in
+            contents])
+        self.assertEqual([storage.open(name).read() for name in names],
+                contents)
@@ -25,23 +25,26 @@ from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
 
+from pypln.web.core.cache import property_cache
 from pypln.web.core.models import Document, mongodb_storage
+from pypln.web.core.mongodb import connection_manager
 
 class TestWithMongo(TestCase):
 
     def _pre_setup(self, *args, **kwargs):
         super(TestWithMongo, self)._pre_setup(*args, **kwargs)
-        mongodb_storage._connection.drop_database(mongodb_storage._db.name)
+        connection_manager.client.drop_database(settings.MONGODB_DBNAME)
+        property_cache.clear()
 
         if hasattr(self, 'fixtures') and self.fixtures is not None and 'documents' in self.fixtures:
             filename = os.path.join(settings.PROJECT_ROOT, 'core/fixtures/mongodb/analysis.json')
             with open(filename, 'r') as mongo_fixture:
                 for obj in json_util.loads(mongo_fixture.read()):
-                    mongodb_storage._connection[settings.MONGODB_DBNAME][settings.MONGODB_COLLECTION].insert(obj)
+                    connection_manager.collection().insert(obj)
             for doc in Document.objects.all():
                 mongodb_storage.save(os.path.basename(doc.blob.name),
                     StringIO(u"Test file with non-ascii char: á.".encode('utf-8')))
 
     def _post_teardown(self, *args, **kwargs):
-        mongodb_storage._connection.drop_database(mongodb_storage._db.name)
+        connection_manager.client.drop_database(settings.MONGODB_DBNAME)
         super(TestWithMongo, self)._post_teardown(*args, **kwargs)
@@ -0,0 +1,267 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+from StringIO import StringIO
+import zipfile
+
+from bson import ObjectId
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
+from mock import patch
+from rest_framework.reverse import reverse as rest_framework_reverse
+
+from pypln.web.backend_adapter.models import PipelineRequest
+from pypln.web.backend_adapter.pipelines import dispatch_pipelines
+from pypln.web.core.models import Corpus, Document
+from pypln.web.core.tests.utils import TestWithMongo
+
+__all__ = ["DocumentBulkUploadViewTest"]
+
+
+class DocumentBulkUploadViewTest(TestWithMongo):
+    fixtures = ['users', 'corpora']
+
+    def setUp(self):
+        self.user = User.objects.get(username="user")
+        self.corpus = self.user.corpus_set.all()[0]
+        self.corpus_url = rest_framework_reverse('corpus-detail',
+                kwargs={'pk': self.corpus.id})
+
+    def make_zip(self, files):
+        archive = StringIO()
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            for name, content in files:
+                zip_file.writestr(name, content)
+        archive.seek(0)
+        archive.name = 'documents.zip'
+        return archive
+
+    def make_encrypted_zip(self, files):
+        # Only the flag is set, which is enough for `zipfile` to refuse to
+        # read them without a password.
+        archive = StringIO()
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            for name, content, encrypted in files:
+                info = zipfile.ZipInfo(name)
+                if encrypted:
+                    info.flag_bits |= 0x1
+                zip_file.writestr(info, content)
+        archive.seek(0)
+        archive.name = 'documents.zip'
+        return archive
+
+    def make_file(self, name, content):
+        fp = StringIO(content)
+        fp.name = name
+        return fp
+
+    def test_requires_login(self):
+        response = self.client.post(reverse('document-bulk-upload'))
+        self.assertEqual(response.status_code, 403)
+
+    @patch('pypln.web.core.ingest.enqueue_pipelines')
+    def test_creates_a_document_for_each_file_in_an_archive(self,
+            enqueue_pipelines):
+        self.client.login(username="user", password="user")
+        archive = self.make_zip([('first.txt', 'First'),
+            ('dir/second.txt', 'Second')])
+        response = self.client.post(reverse('document-bulk-upload'),
+                {'corpus': self.corpus_url, 'archive': archive})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual([document['filename'] for document in
+            response.data['documents']], ['first.txt', 'dir/second.txt'])
+        documents = self.corpus.document_set.order_by('id')
+        self.assertEqual([document.blob.read() for document in documents],
+                ['First', 'Second'])
+        self.assertTrue(all(document.owner == self.user for document in
+            documents))
+
+    @patch('pypln.web.core.ingest.enqueue_pipelines')
+    def test_creates_a_document_for_each_blob(self, enqueue_pipelines):
+        self.client.login(username="user", password="user")
+        response = self.client.post(reverse('document-bulk-upload'),
+                {'corpus': self.corpus_url, 'blob': [
+                    self.make_file('first.txt', 'First'),
+                    self.make_file('second.txt', 'Second')]})
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(self.corpus.document_set.count(), 2)
+
+    @patch('pypln.web.core.ingest.enqueue_pipelines')
+    def test_requests_the_pipelines_of_all_documents_together(self,
+            enqueue_pipelines):
+        self.client.login(username="user", password="user")
+        archive = self.make_zip([('first.txt', 'First'),
+            ('second.txt', 'Second')])
+        self.client.post(reverse('document-bulk-upload'),
+                {'corpus': self.corpus_url, 'archive': archive})
+
+        self.assertEqual(enqueue_pipelines.call_count, 1)
+        documents = enqueue_pipelines.call_args[0][0]
+        self.assertEqual(documents, list(self.corpus.document_set.order_by(
+            'id')))
+        self.assertEqual(enqueue_pipelines.call_args[1]['lane'],
+                PipelineRequest.BULK)
+
+    @patch('pypln.web.backend_adapter.pipelines.group')
+    @patch('pypln.web.backend_adapter.pipelines.default_pipeline')
+    def test_pipelines_are_created_for_each_document(self, default_pipeline,
+            group):
+        self.client.login(username="user", password="user")
+        archive = self.make_zip([('first.txt', 'First'),
+            ('second.txt', 'Second')])
+        self.client.post(reverse('document-bulk-upload'),
+                {'corpus': self.corpus_url, 'archive': archive})
+        dispatch_pipelines()
+
+        doc_ids = [ObjectId(document.blob.name) for document in
+                self.corpus.document_set.order_by('id')]
+        self.assertEqual([call[0][0] for call in
+            default_pipeline.call_args_list], doc_ids)
+        self.assertEqual(group.return_value.call_count, 1)
+
+    def test_requires_an_archive_or_blobs(self):
+        self.client.login(username="user", password="user")
+        response = self.client.post(reverse('document-bulk-upload'),
+                {'corpus': self.corpus_url})
+        self.assertEqual(response.status_code, 400)
+
+    def test_invalid_archive(self):
+        self.client.login(username="user", password="user")
+        response = self.client.post(reverse('document-bulk-upload'),
+                {'corpus': self.corpus_url,
+                 'archive': self.make_file('documents.zip', 'Not a zip')})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.corpus.document_set.count(), 0)
+
+    def test_refuses_archives_with_encrypted_files(self):
+        self.client.login(username="user", password="user")
+        archive = self.make_encrypted_zip([('first.txt', 'First', True)])
+        response = self.client.post(reverse('document-bulk-upload'),
+                {'corpus': self.corpus_url, 'archive': archive})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.corpus.document_set.count(), 0)
+
+    def test_refuses_corrupted_archives(self):
+        self.client.login(username="user", password="user")
+        archive = StringIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr('first.txt', 'First' * 100)
+        data = archive.getvalue()
+        # Replaces the compressed contents of the file, after its header.
+        header_size = 30 + len('first.txt')
+        corrupted = data[:header_size] + '\xff' * 10 + data[header_size + 10:]
+        response = self.client.post(reverse('document-bulk-upload'),
+                {'corpus': self.corpus_url, 'archive': self.make_file(
+                    'documents.zip', corrupted)})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.corpus.document_set.count(), 0)
+
+    @override_settings(BULK_UPLOAD_BATCH_SIZE=1)
+    @patch('pypln.web.core.ingest.mongodb_storage.delete')
+    def test_creates_no_documents_if_a_later_file_fails(self, delete):
+        self.client.login(username="user", password="user")
+        archive = self.make_encrypted_zip([('first.txt', 'First', False),
+            ('second.txt', 'Second', True)])
+        response = self.client.post(reverse('document-bulk-upload'),
+                {'corpus': self.corpus_url, 'archive': archive})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.corpus.document_set.count(), 0)
+        self.assertEqual(PipelineRequest.objects.count(), 0)
+        self.assertEqual(delete.call_count, 1)
+
+    @override_settings(BULK_UPLOAD_MAX_FILE_SIZE=5)
+    def test_refuses_blobs_that_are_too_big(self):
+        self.client.login(username="user", password="user")
+        response = self.client.post(reverse('document-bulk-upload'),
+                {'corpus': self.corpus_url, 'blob': [
+                    self.make_file('first.txt', 'First'),
+                    self.make_file('second.txt', 'Second')]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.corpus.document_set.count(), 0)
+
+    def test_cant_create_documents_in_another_users_corpus(self):
+        self.client.login(username="user", password="user")
+        corpus = Corpus.objects.filter(owner__username="admin")[0]
+        corpus_url = rest_framework_reverse('corpus-detail',
+                kwargs={'pk': corpus.id})
+        response = self.client.post(reverse('document-bulk-upload'),
+                {'corpus': corpus_url, 'blob': self.make_file('first.txt',
+                    'First')})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Document.objects.count(), 0)
+
+    @override_settings(BULK_UPLOAD_MAX_FILES=2)
+    def test_refuses_archives_with_too_many_files(self):
+        self.client.login(username="user", password="user")
+        archive = self.make_zip([('first.txt', 'First'),
+            ('second.txt', 'Second'), ('third.txt', 'Third')])
+        response = self.client.post(reverse('document-bulk-upload'),
+                {'corpus': self.corpus_url, 'archive': archive})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.corpus.document_set.count(), 0)
+
+    @override_settings(BULK_UPLOAD_MAX_TOTAL_SIZE=10)
+    def test_refuses_archives_that_are_too_big(self):
+        self.client.login(username="user", password="user")
+        archive = self.make_zip([('first.txt', 'First'),
+            ('second.txt', 'Second')])
+        response = self.client.post(reverse('document-bulk-upload'),
+                {'corpus': self.corpus_url, 'archive': archive})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.corpus.document_set.count(), 0)
+
+    @override_settings(BULK_UPLOAD_MAX_FILES=1)
+    def test_refuses_too_many_blobs(self):
+        self.client.login(username="user", password="user")
+        response = self.client.post(reverse('document-bulk-upload'),
+                {'corpus': self.corpus_url, 'blob': [
+                    self.make_file('first.txt', 'First'),
+                    self.make_file('second.txt', 'Second')]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.corpus.document_set.count(), 0)
+
+    @override_settings(BULK_UPLOAD_BATCH_MAX_BYTES=6)
+    @patch('pypln.web.core.ingest.enqueue_pipelines')
+    def test_batches_are_limited_by_their_size(self, enqueue_pipelines):
+        self.client.login(username="user", password="user")
+        archive = self.make_zip([('first.txt', 'First'),
+            ('second.txt', 'Second'), ('third.txt', 'Third')])
+        response = self.client.post(reverse('document-bulk-upload'),
+                {'corpus': self.corpus_url, 'archive': archive})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(enqueue_pipelines.call_count, 2)
+        self.assertEqual(self.corpus.document_set.count(), 3)
+
+    @patch('pypln.web.core.ingest.enqueue_pipelines')
+    def test_documents_with_the_same_contents_are_returned_in_order(self,
+            enqueue_pipelines):
+        self.client.login(username="user", password="user")
+        archive = self.make_zip([('first.txt', 'Same'),
+            ('second.txt', 'Same')])
+        response = self.client.post(reverse('document-bulk-upload'),
+                {'corpus': self.corpus_url, 'archive': archive})
+        documents = list(self.corpus.document_set.order_by('id'))
+        self.assertEqual(len(documents), 2)
+        for created, document in zip(response.data['documents'], documents):
+            self.assertTrue(created['url'].endswith('/{}/'.format(
+                document.id)))
@@ -53,6 +53,23 @@ class CorpusListViewTest(TestCase):
             "description": "description"})
         self.assertEqual(response.status_code, 201)
         self.assertEqual(len(user.corpus_set.all()), 2)
+        self.assertEqual(user.corpus_set.get(name="Corpus").pipeline,
+                'default')
+
+    def test_create_corpus_with_another_pipeline(self):
+        user = User.objects.get(username="user")
+        self.client.login(username="user", password="user")
+        response = self.client.post(reverse('corpus-list'), {"name": "Corpus",
+            "description": "description", "pipeline": "basic"})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(user.corpus_set.get(name="Corpus").pipeline, 'basic')
+
+    def test_cant_create_corpus_with_unknown_pipeline(self):
+        self.client.login(username="user", password="user")
+        response = self.client.post(reverse('corpus-list'), {"name": "Corpus",
+            "description": "description", "pipeline": "everything"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('pipeline', response.data)
 
     def test_cant_create_new_corpus_for_another_user(self):
         self.client.login(username="user", password="user")
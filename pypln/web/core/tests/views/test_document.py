@@ -25,7 +25,9 @@ from django.core.urlresolvers import reverse
 from django.test.client import encode_multipart, BOUNDARY, MULTIPART_CONTENT
 from rest_framework.reverse import reverse as rest_framework_reverse
 
-from pypln.web.core.models import Corpus, Document
+from pypln.web.backend_adapter.models import PipelineRequest
+from pypln.web.backend_adapter.pipelines import dispatch_pipelines
+from pypln.web.core.models import Corpus, Document, mongodb_storage
 from pypln.web.core.tests.utils import TestWithMongo
 
 __all__ = ["DocumentListViewTest", "DocumentDetailViewTest"]
@@ -54,7 +56,17 @@ class DocumentListViewTest(TestWithMongo):
 
         self.assertEqual(list(expected_data), list(object_list))
 
-    @patch('pypln.web.core.views.create_pipeline_from_document')
+    def test_list_fetches_document_sizes_in_a_single_query(self):
+        self.client.login(username="user", password="user")
+        document = self.user.document_set.all()[0]
+        expected_size = document.blob.size
+        with patch.object(mongodb_storage, 'size') as size:
+            response = self.client.get(reverse('document-list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(size.called)
+        self.assertEqual(response.data['results'][0]['size'], expected_size)
+
+    @patch('pypln.web.core.views.enqueue_pipeline')
     def test_create_new_document(self, create_pipelines):
         self.assertEqual(len(self.user.document_set.all()), 1)
         self.client.login(username="user", password="user")
@@ -67,7 +79,42 @@ class DocumentListViewTest(TestWithMongo):
         self.assertEqual(response.status_code, 201)
         self.assertEqual(len(self.user.document_set.all()), 2)
 
-    @patch('pypln.web.core.views.create_pipeline_from_document')
+    def test_create_document_with_some_analyses(self):
+        self.client.login(username="user", password="user")
+        corpus = self.user.corpus_set.all()[0]
+        data = {"corpus": rest_framework_reverse('corpus-detail',
+            kwargs={'pk': corpus.id}), "blob": self.fp,
+            "analyses": "tokens,freqdist"}
+        response = self.client.post(reverse('document-list'), data)
+        self.assertEqual(response.status_code, 201)
+        document = self.user.document_set.latest('id')
+        self.assertEqual(document.pipelinerequest_set.get().stages,
+                'Extractor,Tokenizer,FreqDist')
+
+    def test_cant_create_document_with_unknown_analyses(self):
+        self.client.login(username="user", password="user")
+        corpus = self.user.corpus_set.all()[0]
+        data = {"corpus": rest_framework_reverse('corpus-detail',
+            kwargs={'pk': corpus.id}), "blob": self.fp,
+            "analyses": "tokens,horoscope"}
+        response = self.client.post(reverse('document-list'), data)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('analyses', response.data)
+
+    def test_documents_use_the_pipeline_of_their_corpus(self):
+        self.client.login(username="user", password="user")
+        corpus = self.user.corpus_set.all()[0]
+        corpus.pipeline = 'basic'
+        corpus.save()
+        data = {"corpus": rest_framework_reverse('corpus-detail',
+            kwargs={'pk': corpus.id}), "blob": self.fp}
+        response = self.client.post(reverse('document-list'), data)
+        self.assertEqual(response.status_code, 201)
+        document = self.user.document_set.latest('id')
+        self.assertEqual(document.pipelinerequest_set.get().stages,
+                'Extractor,Tokenizer,FreqDist,Statistics')
+
+    @patch('pypln.web.core.views.enqueue_pipeline')
     def test_cant_create_document_for_another_user(self, create_pipeline):
         self.client.login(username="user", password="user")
 
@@ -89,7 +136,7 @@ class DocumentListViewTest(TestWithMongo):
 
         self.assertEqual(response.status_code, 400)
 
-    @patch('pypln.web.core.views.create_pipeline_from_document')
+    @patch('pypln.web.core.views.enqueue_pipeline')
     def test_cant_create_document_in_another_users_corpus(self, create_pipelines):
         self.client.login(username="user", password="user")
 
@@ -102,8 +149,9 @@ class DocumentListViewTest(TestWithMongo):
 
         self.assertEqual(response.status_code, 400)
 
-    @patch('pypln.web.backend_adapter.pipelines.call_default_pipeline')
-    def test_creating_a_document_should_create_a_pipeline_for_it(self, call_default_pipeline):
+    @patch('pypln.web.backend_adapter.pipelines.group')
+    @patch('pypln.web.backend_adapter.pipelines.default_pipeline')
+    def test_creating_a_document_should_create_a_pipeline_for_it(self, default_pipeline, group):
         self.assertEqual(len(self.user.document_set.all()), 1)
         self.client.login(username="user", password="user")
 
@@ -113,10 +161,15 @@ class DocumentListViewTest(TestWithMongo):
         response = self.client.post(reverse('document-list'), data)
 
         self.assertEqual(response.status_code, 201)
-        self.assertTrue(call_default_pipeline.called)
         doc_id = int(response.data['url'].split('/')[-2])
         document = Document.objects.get(pk=doc_id)
-        call_default_pipeline.assert_called_with(ObjectId(document.blob.name))
+        # The pipeline is only sent to the broker by the dispatcher.
+        self.assertFalse(default_pipeline.called)
+        self.assertEqual(document.pipelinerequest_set.get().status,
+                PipelineRequest.PENDING)
+        dispatch_pipelines()
+        default_pipeline.assert_called_with(ObjectId(document.blob.name))
+        self.assertTrue(group.return_value.called)
 
 
 class DocumentDetailViewTest(TestWithMongo):
@@ -146,6 +199,39 @@ class DocumentDetailViewTest(TestWithMongo):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.renderer_context['view'].get_object(), document)
 
+    def test_returns_304_if_document_did_not_change(self):
+        self.client.login(username="user", password="user")
+        document = Document.objects.filter(owner__username="user")[0]
+        url = reverse('document-detail', kwargs={'pk': document.id})
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_returns_304_if_any_of_the_etags_match(self):
+        self.client.login(username="user", password="user")
+        document = Document.objects.filter(owner__username="user")[0]
+        url = reverse('document-detail', kwargs={'pk': document.id})
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url,
+                HTTP_IF_NONE_MATCH='"outdated", {}'.format(etag))
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"outdated"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_etag_changes_when_document_changes(self):
+        self.client.login(username="user", password="user")
+        document = Document.objects.filter(owner__username="user")[0]
+        url = reverse('document-detail', kwargs={'pk': document.id})
+        etag = self.client.get(url)['ETag']
+        document.corpus = Corpus.objects.create(name="New corpus",
+                description="", owner=self.user)
+        document.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
     def test_returns_404_for_inexistent_document(self):
         self.client.login(username="user", password="user")
         response = self.client.get(reverse('document-detail',
@@ -159,7 +245,7 @@ class DocumentDetailViewTest(TestWithMongo):
             kwargs={'pk': document.id}))
         self.assertEqual(response.status_code, 404)
 
-    @patch('pypln.web.core.views.create_pipeline_from_document')
+    @patch('pypln.web.core.views.enqueue_pipeline')
     def test_edit_document(self, create_pipeline):
         self.client.login(username="user", password="user")
 
@@ -175,6 +261,26 @@ class DocumentDetailViewTest(TestWithMongo):
         updated_document = Document.objects.get(id=document.id)
         self.assertEqual(updated_document.corpus, new_corpus)
 
+    @patch('pypln.web.core.views.enqueue_pipeline')
+    def test_changing_only_the_corpus_keeps_the_blob(self, create_pipeline):
+        self.client.login(username="user", password="user")
+        document = self.user.document_set.all()[0]
+        new_corpus = Corpus.objects.create(name="New corpus",
+                description="", owner=self.user)
+        data = encode_multipart(BOUNDARY, {"corpus": self._get_corpus_url(
+            new_corpus.id)})
+        response = self.client.patch(reverse('document-detail',
+            kwargs={'pk': document.id}), data, content_type=MULTIPART_CONTENT)
+
+        self.assertEqual(response.status_code, 200)
+        updated_document = Document.objects.get(id=document.id)
+        self.assertEqual(updated_document.corpus, new_corpus)
+        self.assertEqual(updated_document.blob.name, document.blob.name)
+        self.assertEqual(updated_document.blob.read(), document.blob.read())
+        response = self.client.get(reverse('property-detail',
+            kwargs={'pk': document.id, 'property': 'text'}))
+        self.assertEqual(response.status_code, 200)
+
     def test_cant_edit_other_peoples_documents(self):
         self.client.login(username="user", password="user")
         document = Document.objects.filter(owner__username="admin")[0]
@@ -189,7 +295,7 @@ class DocumentDetailViewTest(TestWithMongo):
         # appears not to exist.
         self.assertEqual(response.status_code, 404)
 
-    @patch('pypln.web.core.views.create_pipeline_from_document')
+    @patch('pypln.web.core.views.enqueue_pipeline')
     def test_cant_change_the_owner_of_a_document(self, create_pipeline):
         self.client.login(username="user", password="user")
         document = self.user.document_set.all()[0]
@@ -226,8 +332,9 @@ class DocumentDetailViewTest(TestWithMongo):
         self.assertEqual(response.status_code, 404)
         self.assertEqual(len(Corpus.objects.filter(owner__username="admin")), 1)
 
-    @patch('pypln.web.backend_adapter.pipelines.call_default_pipeline')
-    def test_updating_a_document_should_create_a_pipeline_for_it(self, call_default_pipeline):
+    @patch('pypln.web.backend_adapter.pipelines.group')
+    @patch('pypln.web.backend_adapter.pipelines.default_pipeline')
+    def test_updating_a_document_should_create_a_pipeline_for_it(self, default_pipeline, group):
         self.client.login(username="user", password="user")
         document = self.user.document_set.all()[0]
         corpus = self.user.corpus_set.all()[0]
@@ -239,6 +346,6 @@ class DocumentDetailViewTest(TestWithMongo):
             kwargs={'pk': document.id}), data, content_type=MULTIPART_CONTENT)
 
         self.assertEqual(response.status_code, 200)
-        self.assertTrue(call_default_pipeline.called)
+        dispatch_pipelines()
         document = response.renderer_context['view'].get_object()
-        call_default_pipeline.assert_called_with(ObjectId(document.blob.name))
+        default_pipeline.assert_called_with(ObjectId(document.blob.name))
@@ -0,0 +1,188 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import json
+import threading
+import time
+
+from bson import ObjectId
+from django.core.urlresolvers import reverse
+from mock import patch
+
+from pypln.web.core.models import Corpus, Document, mongodb_storage
+from pypln.web.core.tests.utils import TestWithMongo
+
+__all__ = ["DocumentEventsViewTest", "CorpusEventsViewTest"]
+
+
+def parse_events(content):
+    events = []
+    for block in content.split('\n\n'):
+        lines = dict(line.split(': ', 1) for line in block.splitlines()
+                if line.startswith(('event: ', 'data: ')))
+        if 'event' in lines:
+            events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+
+class LocalPubSub(object):
+    """
+    Change feed that wakes up the requests waiting for an analysis when the
+    test calls `publish` for it, so tests don't wait for the polling
+    interval.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._changed = set()
+
+    def publish(self, blob_name):
+        with self._condition:
+            self._changed.add(blob_name)
+            self._condition.notify_all()
+
+    def wait(self, blob_names, timeout):
+        blob_names = set(blob_names)
+        deadline = time.time() + timeout
+        with self._condition:
+            while not blob_names & self._changed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            self._changed -= blob_names
+
+
+class EventsTestMixin(object):
+
+    def setUp(self):
+        self.feed = LocalPubSub()
+        feed_patcher = patch('pypln.web.core.events.event_feed', self.feed)
+        feed_patcher.start()
+        self.addCleanup(feed_patcher.stop)
+        self.document = Document.objects.filter(owner__username="user")[0]
+        self.doc_id = ObjectId(self.document.blob.name)
+
+    def change_later(self, update):
+        def change():
+            mongodb_storage.collection.update({'_id': self.doc_id}, update)
+            self.feed.publish(self.document.blob.name)
+        timer = threading.Timer(0.1, change)
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+
+class DocumentEventsViewTest(EventsTestMixin, TestWithMongo):
+    fixtures = ['users', 'corpora', 'documents']
+
+    def setUp(self):
+        super(DocumentEventsViewTest, self).setUp()
+        self.url = reverse('document-events', kwargs={'pk': self.document.id})
+
+    def test_requires_login(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 403)
+
+    def test_shows_only_documents_of_the_user(self):
+        self.client.login(username="user", password="user")
+        document = Document.objects.filter(owner__username="admin")[0]
+        response = self.client.get(reverse('document-events',
+            kwargs={'pk': document.id}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_returns_the_status_without_waiting_when_there_is_no_token(self):
+        self.client.login(username="user", password="user")
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['changed'])
+        self.assertEqual(response.data['status']['state'], 'done')
+        self.assertIn('token', response.data)
+
+    def test_returns_unchanged_status_after_the_timeout(self):
+        self.client.login(username="user", password="user")
+        token = self.client.get(self.url).data['token']
+        response = self.client.get(self.url, {'since': token, 'timeout': 0})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.data['changed'])
+        self.assertEqual(response.data['token'], token)
+
+    def test_returns_when_a_stage_changes(self):
+        self.client.login(username="user", password="user")
+        token = self.client.get(self.url).data['token']
+        self.change_later({'$set': {'_status.POS': {'state': 'failed'}}})
+        response = self.client.get(self.url, {'since': token, 'timeout': 10})
+        self.assertTrue(response.data['changed'])
+        self.assertNotEqual(response.data['token'], token)
+        self.assertEqual(response.data['status']['state'], 'failed')
+
+    def test_invalid_timeout(self):
+        self.client.login(username="user", password="user")
+        response = self.client.get(self.url, {'timeout': 'soon'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_streams_the_state_of_a_finished_analysis(self):
+        self.client.login(username="user", password="user")
+        response = self.client.get(self.url, HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = parse_events(b''.join(response.streaming_content))
+        stage_events = [data for event, data in events if event == 'stage']
+        self.assertTrue(stage_events)
+        self.assertTrue(all(data['state'] == 'done' for data in stage_events))
+        self.assertEqual(events[-1], ('end', {'finished': True,
+            'token': events[-1][1]['token']}))
+
+    def test_streams_stage_changes_until_the_analysis_is_done(self):
+        freqdist = mongodb_storage.collection.find_one({'_id': self.doc_id},
+                ['freqdist'])['freqdist']
+        mongodb_storage.collection.update({'_id': self.doc_id},
+                {'$unset': {'freqdist': True}})
+        self.client.login(username="user", password="user")
+        self.change_later({'$set': {'freqdist': freqdist}})
+        response = self.client.get(self.url, {'timeout': 10},
+                HTTP_ACCEPT='text/event-stream')
+        events = parse_events(b''.join(response.streaming_content))
+        freqdist_states = [data['state'] for event, data in events
+                if event == 'stage' and data['stage'] == 'FreqDist']
+        self.assertEqual(freqdist_states, ['queued', 'done'])
+        self.assertTrue(events[-1][1]['finished'])
+
+
+class CorpusEventsViewTest(EventsTestMixin, TestWithMongo):
+    fixtures = ['users', 'corpora', 'documents']
+
+    def setUp(self):
+        super(CorpusEventsViewTest, self).setUp()
+        self.url = reverse('corpus-events',
+                kwargs={'pk': self.document.corpus.id})
+
+    def test_shows_only_corpora_of_the_user(self):
+        self.client.login(username="user", password="user")
+        corpus = Corpus.objects.filter(owner__username="admin")[0]
+        response = self.client.get(reverse('corpus-events',
+            kwargs={'pk': corpus.id}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_returns_the_status_of_the_corpus_when_a_document_changes(self):
+        self.client.login(username="user", password="user")
+        token = self.client.get(self.url).data['token']
+        self.change_later({'$set': {'_status.POS': {'state': 'running'}}})
+        response = self.client.get(self.url, {'since': token, 'timeout': 10})
+        self.assertTrue(response.data['changed'])
+        self.assertEqual(response.data['status']['documents'], 1)
+        self.assertEqual(response.data['status']['states']['running'], 1)
@@ -16,12 +16,17 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import datetime
+import json
+
+from bson import ObjectId
 from django.core.urlresolvers import reverse
+from mock import patch
 from django.test.client import RequestFactory
 
 from rest_framework.reverse import reverse as rest_framework_reverse
 
-from pypln.web.core.models import Document
+from pypln.web.core.models import Document, mongodb_storage
 from pypln.web.core.tests.utils import TestWithMongo
 
 __all__ = ["DocumentListTest", "DocumentDetailTest"]
@@ -51,7 +56,7 @@ class DocumentListTest(TestWithMongo):
 
         expected_urls = [rest_framework_reverse('property-detail', kwargs={
             'pk': self.document.id, 'property': prop}, request=fake_request)
-            for prop in self.document.properties.keys()]
+            for prop in sorted(self.document.properties.keys())]
         self.assertEqual(response.data['properties'], expected_urls)
 
     def test_returns_404_for_inexistent_document(self):
@@ -83,6 +88,32 @@ class DocumentListTest(TestWithMongo):
             kwargs={'pk': self.document.id}))
         self.assertEqual(response.status_code, 405)
 
+    def test_sends_etag(self):
+        self.client.login(username="user", password="user")
+        response = self.client.get(reverse('property-list',
+            kwargs={'pk': self.document.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('ETag', response)
+
+    def test_returns_304_if_properties_did_not_change(self):
+        self.client.login(username="user", password="user")
+        url = reverse('property-list', kwargs={'pk': self.document.id})
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_etag_changes_when_a_property_is_added(self):
+        self.client.login(username="user", password="user")
+        url = reverse('property-list', kwargs={'pk': self.document.id})
+        etag = self.client.get(url)['ETag']
+        mongodb_storage.collection.update(
+                {'_id': ObjectId(self.document.blob.name)},
+                {'$set': {'new_property': 'value'}})
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
 
 class DocumentDetailTest(TestWithMongo):
     fixtures = ['users', 'corpora', 'documents']
@@ -151,7 +182,186 @@ class DocumentDetailTest(TestWithMongo):
                 self.document.properties.keys()}
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.renderer_context['view'].get_object(),
-                         self.document)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(''.join(response.streaming_content)),
+                {'value': expected_result})
+
+    def test_shows_all_properties_for_all_data_in_browsable_api(self):
+        self.client.login(username="user", password="user")
+        response = self.client.get(reverse('property-detail',
+            kwargs={'pk': self.document.id, 'property': 'all_data'}),
+            {'format': 'api'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['value'], self.document.properties)
+
+    def test_streams_big_properties(self):
+        self.client.login(username="user", password="user")
+        response = self.client.get(reverse('property-detail',
+            kwargs={'pk': self.document.id, 'property': 'tokens'}))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(json.loads(''.join(response.streaming_content)),
+                {'value': self.document.properties['tokens']})
+
+    def test_returns_404_for_inexistent_streamed_property(self):
+        self.client.login(username="user", password="user")
+        mongodb_storage.collection.update(
+                {'_id': ObjectId(self.document.blob.name)},
+                {'$unset': {'tokens': True}})
+        response = self.client.get(reverse('property-detail',
+            kwargs={'pk': self.document.id, 'property': 'tokens'}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_shows_part_of_a_list_property(self):
+        self.client.login(username="user", password="user")
+        url = reverse('property-detail', kwargs={'pk': self.document.id,
+            'property': 'tokens'})
+        response = self.client.get(url, {'offset': 2, 'limit': 3})
+
+        tokens = self.document.properties['tokens']
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['value'], tokens[2:5])
+        self.assertEqual(response.data['count'], len(tokens))
+        self.assertIn('offset=5', response.data['next'])
+        self.assertIn('offset=0', response.data['previous'])
+
+    def test_last_part_of_a_list_property_has_no_next_url(self):
+        self.client.login(username="user", password="user")
+        url = reverse('property-detail', kwargs={'pk': self.document.id,
+            'property': 'tokens'})
+        response = self.client.get(url, {'limit': 100})
+
+        self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data['value'],
-                expected_result)
+                self.document.properties['tokens'])
+        self.assertIsNone(response.data['next'])
+        self.assertIsNone(response.data['previous'])
+
+    def test_returns_400_for_part_of_a_property_that_is_not_a_list(self):
+        self.client.login(username="user", password="user")
+        response = self.client.get(reverse('property-detail',
+            kwargs={'pk': self.document.id, 'property': 'text'}),
+            {'limit': 2})
+        self.assertEqual(response.status_code, 400)
+
+    def test_returns_400_for_invalid_offset_or_limit(self):
+        self.client.login(username="user", password="user")
+        url = reverse('property-detail', kwargs={'pk': self.document.id,
+            'property': 'tokens'})
+        for params in ({'offset': 'a'}, {'offset': -1}, {'limit': 0}):
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 400)
+
+    def test_returns_400_for_part_of_all_data(self):
+        self.client.login(username="user", password="user")
+        response = self.client.get(reverse('property-detail',
+            kwargs={'pk': self.document.id, 'property': 'all_data'}),
+            {'limit': 2})
+        self.assertEqual(response.status_code, 400)
+
+    def test_returns_404_for_part_of_inexistent_property(self):
+        self.client.login(username="user", password="user")
+        response = self.client.get(reverse('property-detail',
+            kwargs={'pk': self.document.id, 'property': 'inexistent'}),
+            {'limit': 2})
+        self.assertEqual(response.status_code, 404)
+
+    def test_sends_etag_and_last_modified(self):
+        self.client.login(username="user", password="user")
+        mongodb_storage.collection.update(
+                {'_id': ObjectId(self.document.blob.name)},
+                {'$set': {'_modified': datetime.datetime(2015, 10, 19, 17),
+                    '_updated': datetime.datetime(2015, 10, 19, 18)}})
+        response = self.client.get(reverse('property-detail',
+            kwargs={'pk': self.document.id, 'property': 'text'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('ETag', response)
+        self.assertEqual(response['Last-Modified'],
+                'Mon, 19 Oct 2015 18:00:00 GMT')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+
+    def test_sends_no_last_modified_before_a_stage_finishes(self):
+        self.client.login(username="user", password="user")
+        mongodb_storage.collection.update(
+                {'_id': ObjectId(self.document.blob.name)},
+                {'$set': {'_modified': datetime.datetime(2015, 10, 19, 17)}})
+        response = self.client.get(reverse('property-detail',
+            kwargs={'pk': self.document.id, 'property': 'text'}))
+        self.assertNotIn('Last-Modified', response)
+
+    def test_returns_304_without_loading_the_property(self):
+        self.client.login(username="user", password="user")
+        url = reverse('property-detail', kwargs={'pk': self.document.id,
+            'property': 'text'})
+        etag = self.client.get(url)['ETag']
+        with patch.object(Document, 'get_properties') as get_properties:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(get_properties.called)
+
+    def test_etag_depends_on_the_query_string(self):
+        self.client.login(username="user", password="user")
+        url = reverse('property-detail', kwargs={'pk': self.document.id,
+            'property': 'tokens'})
+        etag = self.client.get(url, {'limit': 2})['ETag']
+        response = self.client.get(url, {'limit': 3},
+                HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_etag_changes_when_the_analysis_is_modified(self):
+        self.client.login(username="user", password="user")
+        url = reverse('property-detail', kwargs={'pk': self.document.id,
+            'property': 'text'})
+        etag = self.client.get(url)['ETag']
+        mongodb_storage.collection.update(
+                {'_id': ObjectId(self.document.blob.name)},
+                {'$inc': {'_version': 1}})
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_second_request_is_served_from_the_cache(self):
+        self.client.login(username="user", password="user")
+        url = reverse('property-detail', kwargs={'pk': self.document.id,
+            'property': 'text'})
+        response = self.client.get(url)
+        with patch.object(Document, 'get_properties') as get_properties:
+            cached_response = self.client.get(url)
+        self.assertFalse(get_properties.called)
+        self.assertEqual(cached_response.status_code, 200)
+        self.assertEqual(cached_response.content, response.content)
+
+    def test_analysis_that_is_not_done_is_not_cached(self):
+        mongodb_storage.collection.update(
+                {'_id': ObjectId(self.document.blob.name)},
+                {'$set': {'_status.Extractor': {'state': 'queued'}}})
+        self.client.login(username="user", password="user")
+        url = reverse('property-detail', kwargs={'pk': self.document.id,
+            'property': 'text'})
+        self.client.get(url)
+        with patch.object(Document, 'get_properties',
+                return_value={'text': u'New text'}) as get_properties:
+            response = self.client.get(url)
+        self.assertTrue(get_properties.called)
+        self.assertEqual(json.loads(response.content)['value'], u'New text')
+
+    def test_streamed_property_is_cached(self):
+        self.client.login(username="user", password="user")
+        url = reverse('property-detail', kwargs={'pk': self.document.id,
+            'property': 'tokens'})
+        content = b''.join(self.client.get(url).streaming_content)
+        cached_response = self.client.get(url)
+        self.assertFalse(cached_response.streaming)
+        self.assertEqual(cached_response.content, content)
+
+    def test_modified_analysis_is_not_served_from_the_cache(self):
+        self.client.login(username="user", password="user")
+        url = reverse('property-detail', kwargs={'pk': self.document.id,
+            'property': 'text'})
+        self.client.get(url)
+        mongodb_storage.collection.update(
+                {'_id': ObjectId(self.document.blob.name)},
+                {'$set': {'text': u'New text'}, '$inc': {'_version': 1}})
+        response = self.client.get(url)
+        self.assertEqual(json.loads(response.content)['value'], u'New text')
@@ -0,0 +1,60 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from mock import patch
+
+__all__ = ["WorkerStatsViewTest"]
+
+
+class WorkerStatsViewTest(TestCase):
+    fixtures = ['users']
+
+    def test_requires_login(self):
+        response = self.client.get(reverse('worker-stats'))
+        self.assertEqual(response.status_code, 403)
+
+    def test_requires_staff_user(self):
+        self.client.login(username="user", password="user")
+        response = self.client.get(reverse('worker-stats'))
+        self.assertEqual(response.status_code, 403)
+
+    def test_shows_mongodb_pool_stats(self):
+        self.client.login(username="admin", password="admin")
+        response = self.client.get(reverse('worker-stats'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('max_pool_size', response.data['mongodb'])
+        self.assertIn('idle_sockets', response.data['mongodb'])
+
+    def test_shows_property_cache_stats(self):
+        self.client.login(username="admin", password="admin")
+        response = self.client.get(reverse('worker-stats'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('local_hits', response.data['property_cache'])
+        self.assertIn('misses', response.data['property_cache'])
+
+    @patch('pypln.web.backend_adapter.pipelines.broker_queue_size')
+    def test_shows_pipeline_queue_depths(self, broker_queue_size):
+        broker_queue_size.return_value = 3
+        self.client.login(username="admin", password="admin")
+        response = self.client.get(reverse('worker-stats'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['pipelines']['bulk']['queued'], 3)
+        self.assertEqual(response.data['pipelines']['interactive']['pending'],
+                0)
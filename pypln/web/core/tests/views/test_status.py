@@ -0,0 +1,134 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import datetime
+
+from bson import ObjectId
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+
+from pypln.web.core.models import Corpus, Document, mongodb_storage
+from pypln.web.core.tests.utils import TestWithMongo
+
+__all__ = ["DocumentStatusViewTest", "CorpusStatusViewTest"]
+
+
+class DocumentStatusViewTest(TestWithMongo):
+    fixtures = ['users', 'corpora', 'documents']
+
+    def setUp(self):
+        self.document = Document.objects.filter(owner__username="user")[0]
+        self.doc_id = ObjectId(self.document.blob.name)
+        self.url = reverse('document-status', kwargs={'pk': self.document.id})
+
+    def get_stage(self, data, name):
+        return [stage for stage in data['stages'] if stage['name'] == name][0]
+
+    def test_requires_login(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 403)
+
+    def test_shows_only_documents_of_the_user(self):
+        self.client.login(username="user", password="user")
+        document = Document.objects.filter(owner__username="admin")[0]
+        response = self.client.get(reverse('document-status',
+            kwargs={'pk': document.id}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_complete_analysis_is_done(self):
+        self.client.login(username="user", password="user")
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['state'], 'done')
+        self.assertTrue(all(stage['state'] == 'done' for stage in
+            response.data['stages']))
+
+    def test_stages_without_results_are_queued(self):
+        mongodb_storage.collection.update({'_id': self.doc_id},
+                {'$unset': {'freqdist': True}})
+        self.client.login(username="user", password="user")
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['state'], 'queued')
+        self.assertEqual(self.get_stage(response.data, 'FreqDist')['state'],
+                'queued')
+
+    def test_stages_that_were_not_requested_are_skipped(self):
+        mongodb_storage.collection.update({'_id': self.doc_id},
+                {'$unset': {'pos': True},
+                 '$set': {'_status.Extractor': {'state': 'done'}}})
+        self.client.login(username="user", password="user")
+        response = self.client.get(self.url)
+        self.assertEqual(self.get_stage(response.data, 'POS')['state'],
+                'skipped')
+        self.assertEqual(response.data['state'], 'done')
+
+    def test_stages_sent_again_are_queued_until_they_finish(self):
+        mongodb_storage.collection.update({'_id': self.doc_id},
+                {'$set': {'_status.FreqDist': {'state': 'queued'}}})
+        self.client.login(username="user", password="user")
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['state'], 'queued')
+        self.assertEqual(self.get_stage(response.data, 'FreqDist')['state'],
+                'queued')
+
+    def test_shows_states_recorded_by_the_workers(self):
+        failed_at = datetime.datetime(2015, 10, 19, 17)
+        mongodb_storage.collection.update({'_id': self.doc_id},
+                {'$set': {'_status.POS': {'state': 'failed',
+                    'at': failed_at, 'error': 'Something went wrong'}}})
+        self.client.login(username="user", password="user")
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['state'], 'failed')
+        self.assertEqual(self.get_stage(response.data, 'POS'), {'name': 'POS',
+            'state': 'failed', 'at': failed_at,
+            'error': 'Something went wrong'})
+
+
+class CorpusStatusViewTest(TestWithMongo):
+    fixtures = ['users', 'corpora', 'documents']
+
+    def setUp(self):
+        self.user = User.objects.get(username="user")
+        self.corpus = self.user.corpus_set.all()[0]
+        self.url = reverse('corpus-status', kwargs={'pk': self.corpus.id})
+
+    def test_requires_login(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 403)
+
+    def test_shows_only_corpora_of_the_user(self):
+        self.client.login(username="user", password="user")
+        corpus = Corpus.objects.filter(owner__username="admin")[0]
+        response = self.client.get(reverse('corpus-status',
+            kwargs={'pk': corpus.id}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_counts_documents_in_each_state(self):
+        document = self.corpus.document_set.all()[0]
+        Document.objects.create(blob=document.blob.name, owner=self.user,
+                corpus=self.corpus)
+        Document.objects.create(blob='562526c5798ebd4616b23bff',
+                owner=self.user, corpus=self.corpus)
+        self.client.login(username="user", password="user")
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['documents'], 3)
+        self.assertEqual(response.data['states']['done'], 2)
+        self.assertEqual(response.data['states']['queued'], 1)
+        self.assertEqual(response.data['stages']['Tokenizer'], {
+            'queued': 1, 'running': 0, 'done': 2, 'failed': 0, 'skipped': 0})
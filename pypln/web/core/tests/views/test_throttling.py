@@ -0,0 +1,144 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+from StringIO import StringIO
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache, caches
+from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
+from mock import patch
+from rest_framework.reverse import reverse as rest_framework_reverse
+
+from pypln.web.backend_adapter.pipelines import get_backlog, refresh_backlog
+from pypln.web.core.tests.utils import TestWithMongo
+from pypln.web.core.throttling import UploadRateThrottle
+
+__all__ = ["BacklogAdmissionTest", "UploadRateThrottleTest"]
+
+
+class UploadTestMixin(object):
+    fixtures = ['users', 'corpora', 'documents']
+
+    def setUp(self):
+        cache.clear()
+        caches[settings.THROTTLE_CACHE_ALIAS].clear()
+        self.user = User.objects.get(username="user")
+        self.corpus_url = rest_framework_reverse('corpus-detail',
+                kwargs={'pk': self.user.corpus_set.all()[0].id})
+        self.client.login(username="user", password="user")
+
+    def upload(self, url_name='document-list', field='blob'):
+        fp = StringIO("Content")
+        fp.name = "document.txt"
+        return self.client.post(reverse(url_name), {"corpus": self.corpus_url,
+            field: fp})
+
+
+@override_settings(PIPELINE_BACKLOG_LIMITS={'interactive': 100, 'bulk': 10})
+class BacklogAdmissionTest(UploadTestMixin, TestWithMongo):
+
+    @patch('pypln.web.core.throttling.get_backlog', return_value=99)
+    def test_accepts_documents_under_the_limit(self, get_backlog):
+        response = self.upload()
+        self.assertEqual(response.status_code, 201)
+
+    @patch('pypln.web.core.throttling.get_backlog', return_value=100)
+    def test_refuses_documents_over_the_limit(self, get_backlog):
+        response = self.upload()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'],
+                str(settings.PIPELINE_BACKLOG_RETRY_AFTER))
+        self.assertEqual(self.user.document_set.count(), 1)
+
+    @patch('pypln.web.core.throttling.get_backlog', return_value=100)
+    def test_still_lists_documents_over_the_limit(self, get_backlog):
+        response = self.client.get(reverse('document-list'))
+        self.assertEqual(response.status_code, 200)
+
+    @patch('pypln.web.core.throttling.get_backlog', return_value=50)
+    def test_bulk_uploads_are_refused_first(self, get_backlog):
+        response = self.upload('document-bulk-upload')
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(self.upload().status_code, 201)
+
+    @override_settings(PIPELINE_BACKLOG_LIMITS={'interactive': 0, 'bulk': 0})
+    @patch('pypln.web.core.throttling.get_backlog')
+    def test_limit_can_be_disabled(self, get_backlog):
+        self.assertEqual(self.upload().status_code, 201)
+        self.assertFalse(get_backlog.called)
+
+    @patch('pypln.web.backend_adapter.pipelines.broker_queue_size',
+            return_value=5)
+    def test_backlog_counts_pending_and_queued_pipelines(self,
+            broker_queue_size):
+        # Two queues with 5 tasks.
+        self.assertEqual(get_backlog(), 10)
+        self.upload()
+        # The value is cached.
+        self.assertEqual(get_backlog(), 10)
+        caches[settings.THROTTLE_CACHE_ALIAS].clear()
+        # And the pipeline of the new document.
+        self.assertEqual(get_backlog(), 11)
+
+    @patch('pypln.web.backend_adapter.pipelines.queue_depths')
+    def test_backlog_is_counted_by_one_process_at_a_time(self,
+            queue_depths):
+        queue_depths.return_value = {'interactive': {'pending': 3,
+            'queued': 4}}
+        self.assertEqual(refresh_backlog(), 7)
+        throttling_cache = caches[settings.THROTTLE_CACHE_ALIAS]
+        throttling_cache.delete('pipeline-backlog')
+        # Another process is counting it, so the last count is used.
+        throttling_cache.add('pipeline-backlog-lock', True)
+        queue_depths.return_value = {'interactive': {'pending': 5,
+            'queued': 4}}
+        self.assertEqual(get_backlog(), 7)
+        self.assertEqual(queue_depths.call_count, 1)
+        throttling_cache.delete('pipeline-backlog-lock')
+        self.assertEqual(get_backlog(), 9)
+
+
+@patch.object(UploadRateThrottle, 'THROTTLE_RATES', {'uploads': '2/minute',
+    'bulk_uploads': '1/minute', 'index_uploads': '2/minute'})
+@override_settings(PIPELINE_BACKLOG_LIMITS={'interactive': 0, 'bulk': 0})
+class UploadRateThrottleTest(UploadTestMixin, TestWithMongo):
+
+    def test_limits_uploads_of_each_user(self):
+        self.assertEqual(self.upload().status_code, 201)
+        self.assertEqual(self.upload().status_code, 201)
+        response = self.upload()
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        self.client.login(username="admin", password="admin")
+        self.corpus_url = rest_framework_reverse('corpus-detail', kwargs={
+            'pk': User.objects.get(username="admin").corpus_set.all()[0].id})
+        self.assertEqual(self.upload().status_code, 201)
+
+    def test_does_not_limit_listing_documents(self):
+        self.upload()
+        self.upload()
+        response = self.client.get(reverse('document-list'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_each_endpoint_has_its_own_limit(self):
+        self.assertEqual(self.upload('document-bulk-upload').status_code, 201)
+        self.assertEqual(self.upload('document-bulk-upload').status_code, 429)
+        self.assertEqual(self.upload().status_code, 201)
@@ -0,0 +1,80 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework import exceptions
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.throttling import ScopedRateThrottle
+
+from pypln.web.backend_adapter.models import PipelineRequest
+from pypln.web.backend_adapter.pipelines import get_backlog
+
+
+class Overloaded(exceptions.APIException):
+    status_code = 503
+    default_detail = ("Too many documents are waiting to be analysed. "
+            "Please try again later.")
+
+    def __init__(self, wait, detail=None):
+        super(Overloaded, self).__init__(detail)
+        self.wait = wait
+
+
+def check_backlog(lane):
+    """
+    Raises `Overloaded` if the number of pipelines waiting to be processed
+    reached the limit for new documents in the given lane (in the
+    `PIPELINE_BACKLOG_LIMITS` setting, where 0 means there's no limit).
+    `Retry-After` is set to `PIPELINE_BACKLOG_RETRY_AFTER` seconds.
+    """
+    limit = settings.PIPELINE_BACKLOG_LIMITS[lane]
+    if limit and get_backlog() >= limit:
+        raise Overloaded(settings.PIPELINE_BACKLOG_RETRY_AFTER)
+
+
+class BacklogAdmissionMixin(object):
+    """
+    Rejects requests that create documents (any method that is not safe)
+    while the pipeline backlog is over the limit of `admission_lane`.
+    """
+    admission_lane = PipelineRequest.INTERACTIVE
+
+    def initial(self, request, *args, **kwargs):
+        super(BacklogAdmissionMixin, self).initial(request, *args, **kwargs)
+        if request.method not in SAFE_METHODS:
+            check_backlog(self.admission_lane)
+
+
+class UploadRateThrottle(ScopedRateThrottle):
+    """
+    Limits how often each user can send documents to a view, by the rate of
+    its `throttle_scope` (in the `DEFAULT_THROTTLE_RATES` of
+    `REST_FRAMEWORK`). Requests with safe methods are not limited. Counts
+    are kept in the `THROTTLE_CACHE_ALIAS` cache, so they can be shared by
+    all the processes.
+    """
+
+    @property
+    def cache(self):
+        return caches[settings.THROTTLE_CACHE_ALIAS]
+
+    def allow_request(self, request, view):
+        if request.method in SAFE_METHODS:
+            return True
+        return super(UploadRateThrottle, self).allow_request(request, view)
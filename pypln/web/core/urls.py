@@ -21,17 +21,31 @@ from django.conf.urls import patterns, url, include
 from rest_framework.urlpatterns import format_suffix_patterns
 from pypln.web.core.views import CorpusList, CorpusDetail, CorpusDocumentList
 from pypln.web.core.views import DocumentList, DocumentDetail
+from pypln.web.core.views import DocumentBulkUpload
 from pypln.web.core.views import PropertyList, PropertyDetail
+from pypln.web.core.views import CorpusStatus, DocumentStatus
+from pypln.web.core.views import CorpusEvents, DocumentEvents
 
 urlpatterns = patterns('pypln.web.core.views',
     url(r'^$', 'api_root'),
     url(r'^user/api-token/$', 'auth_token', name='auth_token'),
+    url(r'^stats/$', 'worker_stats', name='worker-stats'),
     url(r'^corpora/$', CorpusList.as_view(), name='corpus-list'),
     url(r'^corpora/(?P<pk>\d+)/$', CorpusDetail.as_view(), name='corpus-detail'),
     url(r'^corpora/(?P<pk>\d+)/documents/$', CorpusDocumentList.as_view(),
                 name='corpus-document-list'),
+    url(r'^corpora/(?P<pk>\d+)/status/$', CorpusStatus.as_view(),
+                name='corpus-status'),
+    url(r'^corpora/(?P<pk>\d+)/events/$', CorpusEvents.as_view(),
+                name='corpus-events'),
     url(r'^documents/$', DocumentList.as_view(), name='document-list'),
+    url(r'^documents/bulk/$', DocumentBulkUpload.as_view(),
+        name='document-bulk-upload'),
     url(r'^documents/(?P<pk>\d+)/$', DocumentDetail.as_view(), name='document-detail'),
+    url(r'^documents/(?P<pk>\d+)/status/$', DocumentStatus.as_view(),
+        name='document-status'),
+    url(r'^documents/(?P<pk>\d+)/events/$', DocumentEvents.as_view(),
+        name='document-events'),
     url(r'^documents/(?P<pk>\d+)/properties/$',
         PropertyList.as_view(), name='property-list'),
     url(r'^documents/(?P<pk>\d+)/properties/(?P<property>[\w\d-]+)/$',
@@ -17,7 +17,13 @@
 # You should have received a copy of the GNU General Public License
 # along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.http import Http404
+import calendar
+import hashlib
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_etags, quote_etag
 
 from rest_framework import generics
 from rest_framework import permissions
@@ -25,13 +31,33 @@ from rest_framework.authtoken.models import Token
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.exceptions import ParseError
 from rest_framework.reverse import reverse
+from rest_framework.settings import api_settings
 from rest_framework.response import Response
 from rest_framework import serializers
-
-from pypln.web.backend_adapter.pipelines import create_pipeline_from_document
-from pypln.web.core.models import Corpus, Document
+from rest_framework.utils.urls import replace_query_param
+
+from pypln.web.backend_adapter.models import PipelineRequest
+from pypln.web.backend_adapter.pipelines import DONE, analysis_status
+from pypln.web.backend_adapter.pipelines import enqueue_pipeline
+from pypln.web.backend_adapter.pipelines import get_analysis_status
+from pypln.web.backend_adapter.pipelines import queue_depths
+from pypln.web.backend_adapter.pipelines import requested_stages
+from pypln.web.backend_adapter.pipelines import summarize_status
+from pypln.web.core.cache import property_cache
+from pypln.web.core.events import event_stream, wait_for_change
+from pypln.web.core.ingest import check_file_size, check_upload_limits
+from pypln.web.core.ingest import create_documents
+from pypln.web.core.ingest import read_archive
+from pypln.web.core.models import Corpus, Document, mongodb_storage
+from pypln.web.core.models import prefetch_blob_metadata
+from pypln.web.core.mongodb import connection_manager
+from pypln.web.core.renderers import EventStreamRenderer
+from pypln.web.core.renderers import render_property_stream
 from pypln.web.core.serializers import CorpusSerializer, DocumentSerializer
+from pypln.web.core.serializers import DocumentBulkUploadSerializer
 from pypln.web.core.serializers import PropertyListSerializer
+from pypln.web.core.throttling import BacklogAdmissionMixin
+from pypln.web.core.throttling import UploadRateThrottle
 
 @api_view(['GET', 'HEAD'])
 def api_root(request, format=None):
@@ -56,6 +82,81 @@ def auth_token(request, format=None):
         'token': token,
     })
 
+@api_view(['GET'])
+@permission_classes((permissions.IsAdminUser,))
+def worker_stats(request, format=None):
+    """
+    Shows statistics about the worker process that handled this request, such
+    as the state of its MongoDB connection pool, and how many pipelines are
+    waiting in each lane.
+    """
+    return Response({
+        'mongodb': connection_manager.stats(),
+        'property_cache': property_cache.stats(),
+        'pipelines': queue_depths(),
+    })
+
+
+class BlobMetadataPrefetchMixin(object):
+    """
+    Fetches the blob metadata of all documents in a page with a single query
+    before they are serialized.
+    """
+    def paginate_queryset(self, queryset):
+        page = super(BlobMetadataPrefetchMixin, self).paginate_queryset(
+                queryset)
+        if page is not None:
+            page = prefetch_blob_metadata(page)
+        return page
+
+
+class ConditionalGetMixin(object):
+    """
+    Adds `ETag` and `Last-Modified` headers to `GET` responses and answers
+    with `304 Not Modified` when the client sends an `If-None-Match` header
+    with the current ETag. Responses are sent with `Cache-Control: no-cache`,
+    since the analysis may change at any time: clients and proxies may keep
+    them, but must check that they're current before using them. The ETag is calculated from `get_etag_data` before
+    the response is built, so nothing else needs to be loaded to answer a
+    conditional request.
+    """
+    def get_object(self):
+        # The object is needed to calculate the ETag, so we keep it to avoid
+        # fetching it again to build the response.
+        if getattr(self, '_object', None) is None:
+            self._object = super(ConditionalGetMixin, self).get_object()
+        return self._object
+
+    def get_etag_data(self, obj):
+        raise NotImplementedError
+
+    def get_last_modified(self, obj):
+        return None
+
+    def get(self, request, *args, **kwargs):
+        obj = ConditionalGetMixin.get_object(self)
+        # The same resource has different representations depending on the
+        # format and the query string.
+        etag_data = u'{}|{}|{}'.format(self.get_etag_data(obj),
+                request.accepted_renderer.format, request.GET.urlencode())
+        digest = hashlib.sha1(etag_data.encode('utf-8')).hexdigest()
+        etag = quote_etag(digest)
+        self.etag = etag
+        # `parse_etags` returns the ETags without the quotes.
+        client_etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+        if digest in client_etags or '*' in client_etags:
+            response = Response(status=304)
+        else:
+            response = super(ConditionalGetMixin, self).get(request, *args,
+                    **kwargs)
+        response['ETag'] = etag
+        response['Cache-Control'] = 'no-cache'
+        last_modified = self.get_last_modified(obj)
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(calendar.timegm(
+                last_modified.utctimetuple()))
+        return response
+
 
 class CorpusList(generics.ListCreateAPIView):
     """
@@ -68,6 +169,10 @@ class CorpusList(generics.ListCreateAPIView):
     - `name`: A string that will be used as the corpus' name (at most 60 chars).
     - `description`: A short (at most 255 chars) description of the new corpus.
 
+    A `pipeline` may also be given, to choose which analyses run for the
+    documents of the corpus: `default` (every analysis) or `basic` (without
+    the analyses that require palavras, which only supports portuguese).
+
     The list will only include corpora owned by the requesting user, and a
     newly created corpus will always have the user that sent the `POST` request
     as it's owner.
@@ -96,6 +201,7 @@ class CorpusDetail(generics.RetrieveUpdateDestroyAPIView):
     - `name`: the corpus name.
     - `description`: the corpus description.
     - `created_at`: the creation date of the corpus.
+    - `pipeline`: the name of the pipeline that analyses its documents.
 
 
     `PUT` requests will edit a corpus and require:
@@ -116,7 +222,8 @@ class CorpusDetail(generics.RetrieveUpdateDestroyAPIView):
     def perform_update(self, serializer):
         instance = serializer.save(owner=self.request.user)
 
-class DocumentList(generics.ListCreateAPIView):
+class DocumentList(BacklogAdmissionMixin, BlobMetadataPrefetchMixin,
+        generics.ListCreateAPIView):
     """
     Lists all documents available to the current user and creates new documents.
 
@@ -128,26 +235,93 @@ class DocumentList(generics.ListCreateAPIView):
       document.
     - `blob`: The document to be processed.
 
+    By default, the document is analysed by the pipeline of its corpus. To
+    run only what is needed for some analyses, send their names in
+    `analyses` (for example, `tokens,freqdist`).
+
     The list will only include documents owned by the requesting user, and a
     newly created document will always have the user that sent the `POST` request
     as it's owner.
 
     As soon as a document is uploaded it will be processed and the results will
-    be available as soon as they are ready.
+    be available as soon as they are ready. When too many documents are
+    waiting to be processed, new documents are refused with status 503 and a
+    `Retry-After` header. Users that send too many documents in a short time
+    get status 429.
     """
     model = Document
     serializer_class = DocumentSerializer
     permission_classes = (permissions.IsAuthenticated, )
+    throttle_classes = (UploadRateThrottle, )
+    throttle_scope = 'uploads'
 
     def get_queryset(self):
         return Document.objects.filter(owner=self.request.user)
 
     def perform_create(self, serializer):
-        instance = serializer.save(owner=self.request.user)
-        create_pipeline_from_document(instance)
+        with transaction.atomic():
+            instance = serializer.save(owner=self.request.user)
+            enqueue_pipeline(instance, requested_stages(instance.corpus,
+                serializer.validated_data.get('analyses')))
 
 
-class DocumentDetail(generics.RetrieveUpdateDestroyAPIView):
+class DocumentBulkUpload(BacklogAdmissionMixin, generics.GenericAPIView):
+    """
+    Creates many documents in a corpus at once.
+
+    `POST` requests require:
+
+    - `corpus`: Fully qualified url of the corpus that will contain the new
+      documents.
+    - `archive`: A zip or tar file. Each file in it will become a document.
+
+    Instead of an `archive`, many files can be sent as `blob`. Uploads with
+    too many files or too much data (see the `BULK_UPLOAD_*` settings) are
+    refused with status 400. `analyses` may be sent as in the creation of a
+    single document.
+
+    The response includes the number of documents created (`count`) and the
+    `url` of the document created from each file (`filename`). The documents
+    are processed just like the ones created one by one, but after them, and
+    they are refused (with status 503) sooner when too many documents are
+    waiting to be processed.
+    """
+    serializer_class = DocumentBulkUploadSerializer
+    permission_classes = (permissions.IsAuthenticated, )
+    throttle_classes = (UploadRateThrottle, )
+    throttle_scope = 'bulk_uploads'
+    admission_lane = PipelineRequest.BULK
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        archive = serializer.validated_data.get('archive')
+        try:
+            if archive is not None:
+                files = read_archive(archive)
+            else:
+                files = [(blob.name, blob) for blob in
+                        request.FILES.getlist('blob')]
+                for name, blob in files:
+                    check_file_size(name, blob.size)
+                check_upload_limits([blob.size for name, blob in files])
+            created = create_documents(request.user,
+                    serializer.validated_data['corpus'], files,
+                    stages=serializer.validated_data.get('analyses'))
+        except ValueError as exc:
+            raise ParseError(str(exc))
+        return Response({
+            'count': len(created),
+            'documents': [{
+                'filename': name,
+                'url': reverse('document-detail', kwargs={'pk': document.pk},
+                    request=request),
+            } for name, document in created],
+        }, status=201)
+
+
+class DocumentDetail(ConditionalGetMixin,
+        generics.RetrieveUpdateDestroyAPIView):
     """
     Show details of a specific document and allows the document to be edited.
 
@@ -179,16 +353,27 @@ class DocumentDetail(generics.RetrieveUpdateDestroyAPIView):
     def get_queryset(self):
         return Document.objects.filter(owner=self.request.user)
 
-    def perform_update(self, serializer):
-        instance = serializer.save(owner=self.request.user)
-        create_pipeline_from_document(instance)
+    def get_etag_data(self, obj):
+        return u'{}|{}|{}|{}'.format(obj.pk, obj.blob.name, obj.corpus_id,
+                obj.uploaded_at.isoformat())
 
-class PropertyList(generics.RetrieveAPIView):
+    def perform_update(self, serializer):
+        old_blob_name = serializer.instance.blob.name
+        with transaction.atomic():
+            instance = serializer.save(owner=self.request.user)
+            enqueue_pipeline(instance, requested_stages(instance.corpus,
+                serializer.validated_data.get('analyses')))
+        # A partial update may keep the blob (and its analysis).
+        if instance.blob.name != old_blob_name:
+            property_cache.invalidate(old_blob_name)
+            mongodb_storage.delete(old_blob_name)
+
+class PropertyList(ConditionalGetMixin, generics.RetrieveAPIView):
     """
     Lists all the available analysis results for a document. If a property is
     not listed here, the analysis is either not yet complete or not applicable
-    to the specified document.
-    <!-- TODO: We need to warn the user when the analysis failed -->
+    to the specified document. The state of the analysis (including failures)
+    is shown by the status of the document.
     """
     serializer_class = PropertyListSerializer
     permission_classes = (permissions.IsAuthenticated, )
@@ -196,7 +381,142 @@ class PropertyList(generics.RetrieveAPIView):
     def get_queryset(self):
         return Document.objects.filter(owner=self.request.user)
 
-class CorpusDocumentList(generics.ListAPIView):
+    def get_etag_data(self, obj):
+        return u'{}|{}'.format(obj.blob.name, obj.analysis_version())
+
+    def get_last_modified(self, obj):
+        return obj.analysis_modified_at()
+
+class DocumentStatus(generics.RetrieveAPIView):
+    """
+    Shows the state of the analysis of a document:
+
+    - `state`: `queued`, `running`, `done` or `failed`.
+    - `stages`: the `name`, `state` and, when it's known, the time of the
+      last change (`at`) of each stage of the analysis. Failed stages may
+      include an `error`.
+    - `modified_at`: the last time the analysis was sent to be processed.
+    """
+    permission_classes = (permissions.IsAuthenticated, )
+
+    def get_queryset(self):
+        return Document.objects.filter(owner=self.request.user)
+
+    def retrieve(self, request, *args, **kwargs):
+        blob_name = self.get_object().blob.name
+        return Response(get_analysis_status([blob_name])[blob_name])
+
+class CorpusStatus(generics.RetrieveAPIView):
+    """
+    Shows how many documents of a corpus are in each state of the analysis
+    (see the status of a document), overall (`states`) and for each stage
+    (`stages`), and the total number of `documents`.
+    """
+    permission_classes = (permissions.IsAuthenticated, )
+
+    def get_queryset(self):
+        return Corpus.objects.filter(owner=self.request.user)
+
+    def retrieve(self, request, *args, **kwargs):
+        blob_names = list(self.get_object().document_set.values_list('blob',
+            flat=True))
+        statuses = get_analysis_status(blob_names)
+        return Response(summarize_status([statuses[name] for name in
+            blob_names]))
+
+class EventsMixin(object):
+    """
+    Waits for changes in the analysis of the documents returned by
+    `get_documents` (a list of `(pk, blob_name)` pairs).
+
+    Clients that accept `text/event-stream` receive server-sent events.
+    Others make long-poll requests: the response is sent as soon as the
+    state of a stage changes after the one identified by the `since` token
+    (or after `timeout` seconds) and includes a new `token`.
+
+    Nothing tells the web processes when an analysis changes, so while a
+    request waits the status is read again from MongoDB every
+    `EVENTS_POLL_INTERVAL` seconds (see `pypln.web.core.events.PollingFeed`).
+    """
+    permission_classes = (permissions.IsAuthenticated, )
+    renderer_classes = tuple(api_settings.DEFAULT_RENDERER_CLASSES) + (
+            EventStreamRenderer, )
+
+    def get_timeout(self, maximum):
+        try:
+            timeout = float(self.request.query_params.get('timeout',
+                maximum))
+        except ValueError:
+            raise ParseError("'timeout' must be a number.")
+        return max(0, min(timeout, maximum))
+
+    def retrieve(self, request, *args, **kwargs):
+        documents = self.get_documents()
+        # The rest of the request doesn't use the database and may take
+        # minutes, so it shouldn't hold a connection.
+        if not connection.in_atomic_block:
+            connection.close()
+
+        if request.accepted_renderer.format == 'event-stream':
+            timeout = self.get_timeout(settings.EVENTS_STREAM_TIMEOUT)
+            response = StreamingHttpResponse(event_stream(documents,
+                timeout), content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+            return response
+
+        since = request.query_params.get('since')
+        blob_names = [blob_name for pk, blob_name in documents]
+        statuses, token = wait_for_change(blob_names, since,
+                self.get_timeout(settings.EVENTS_LONG_POLL_TIMEOUT))
+        return Response({
+            'token': token,
+            'changed': token != since,
+            'status': self.get_status(blob_names, statuses),
+        })
+
+class DocumentEvents(EventsMixin, generics.RetrieveAPIView):
+    """
+    Notifies the changes in the analysis of a document.
+
+    With `Accept: text/event-stream`, sends a `stage` event with the
+    `document`, `stage`, `state` (and `at`/`error`, when known) and
+    `document_state` for each stage and then for every change, until the
+    analysis is done or failed (or `timeout` seconds pass, at most 10
+    minutes). An `end` event closes the stream.
+
+    Otherwise, waits (at most `timeout` seconds, up to 30) until the analysis
+    changes after the `since` token and returns the new `token`, whether it
+    `changed` and the `status` of the document.
+    """
+
+    def get_queryset(self):
+        return Document.objects.filter(owner=self.request.user)
+
+    def get_documents(self):
+        document = self.get_object()
+        return [(document.pk, document.blob.name)]
+
+    def get_status(self, blob_names, statuses):
+        return statuses[blob_names[0]]
+
+class CorpusEvents(EventsMixin, generics.RetrieveAPIView):
+    """
+    Notifies the changes in the analysis of the documents of a corpus, in the
+    same way as the events of a document. Long-poll responses include the
+    status of the corpus.
+    """
+
+    def get_queryset(self):
+        return Corpus.objects.filter(owner=self.request.user)
+
+    def get_documents(self):
+        return list(self.get_object().document_set.values_list('pk', 'blob'))
+
+    def get_status(self, blob_names, statuses):
+        return summarize_status([statuses[name] for name in blob_names])
+
+class CorpusDocumentList(BlobMetadataPrefetchMixin, generics.ListAPIView):
     """
     Lists all the documents contained in a Corpus.
 
@@ -212,38 +532,174 @@ class CorpusDocumentList(generics.ListAPIView):
         return Document.objects.filter(owner=self.request.user,
                 corpus_id=corpus_id)
 
-class PropertyDetail(generics.RetrieveAPIView):
+class PropertyDetail(ConditionalGetMixin, generics.RetrieveAPIView):
     """
     Shows the result of an analysis for the specified document. The result
     always has one key named `value` and it will contain your result. A list of
     all possible analysis and the corresponding result formats is available in
     our documentation.
+
+    Results that are lists (like `tokens` or `pos`) can be requested in parts
+    using the `offset` and `limit` query parameters. In this case the response
+    will also include the total number of items (`count`) and the urls for the
+    `next` and `previous` parts.
+
+    Big results (and `all_data`) are sent as they're read from the database
+    when JSON is requested. JSON responses of finished analyses are cached
+    until the analysis of the document changes.
     <!-- TODO: add link to the part of the documentation that specifies all the
     available analysis -->
     """
     permission_classes = (permissions.IsAuthenticated, )
+    cache_key = None
+    cache_token = None
+
+    def is_slice_request(self):
+        return ('offset' in self.request.query_params or
+                'limit' in self.request.query_params)
+
+    def is_streaming_request(self):
+        return (self.kwargs['property'] in settings.STREAMING_PROPERTIES and
+                self.request.accepted_renderer.format == 'json')
+
+    def get_slice_params(self):
+        max_limit = settings.PROPERTY_SLICE_MAX_LIMIT
+        try:
+            offset = int(self.request.query_params.get('offset', 0))
+            limit = int(self.request.query_params.get('limit', max_limit))
+        except ValueError:
+            raise ParseError("`offset` and `limit` must be integers.")
+        if offset < 0 or limit < 1:
+            raise ParseError("`offset` can't be negative and `limit` must be "
+                    "positive.")
+        return offset, min(limit, max_limit)
 
     def get_object(self, *args, **kwargs):
         doc = super(PropertyDetail, self).get_object(*args, **kwargs)
         prop = self.kwargs['property']
         #XXX: Maybe `all_data` should be another view with its own url?
-        if prop == "all_data" or prop in doc.properties:
+        # Slices are checked when they're fetched, so we don't load the
+        # property here.
+        if prop == "all_data" or self.is_slice_request():
+            return doc
+        # The names were already fetched to calculate the ETag, so we don't
+        # load the value here: it may come from the cache or be streamed.
+        if prop in doc.property_names():
             return doc
         else:
-            raise Http404("Property '{}' does not exist for document "
-                    "{}.".format(prop, doc))
+            raise self.not_found(doc)
+
+    def not_found(self, doc):
+        return Http404("Property '{}' does not exist for document "
+                "{}.".format(self.kwargs['property'], doc))
+
+    def is_cacheable_request(self):
+        # Results of analyses that are not done may still be replaced without
+        # changing the ETag.
+        return (self.request.accepted_renderer.format == 'json' and
+                analysis_status(self.get_object().analysis_state())['state']
+                == DONE)
+
+    def get_cache_key(self):
+        # The ETag already identifies the document, the property, the version
+        # of the analysis and the representation.
+        return 'property:{}'.format(self.etag.strip('"'))
+
+    def retrieve(self, request, *args, **kwargs):
+        if self.is_cacheable_request():
+            # Concurrent requests for the same content wait for the first one
+            # to render it.
+            content, self.cache_token = property_cache.get_or_lead(
+                    self.get_cache_key(), self.get_object().blob.name)
+            if content is not None:
+                return HttpResponse(content, content_type='application/json')
+            self.cache_key = self.get_cache_key()
+        try:
+            return self.render_property(request, *args, **kwargs)
+        except:
+            if self.cache_key is not None:
+                property_cache.release(self.cache_key, self.cache_token)
+            raise
+
+    def render_property(self, request, *args, **kwargs):
+        if self.is_slice_request():
+            return self.retrieve_slice(request)
+        if self.is_streaming_request():
+            return self.retrieve_stream(request)
+        return super(PropertyDetail, self).retrieve(request, *args, **kwargs)
+
+    def retrieve_slice(self, request):
+        prop = self.kwargs['property']
+        if prop == "all_data":
+            raise ParseError("`all_data` can't be requested in parts.")
+        offset, limit = self.get_slice_params()
+        doc = self.get_object()
+        try:
+            value, count = doc.get_property_slice(prop, offset, limit)
+        except KeyError:
+            raise self.not_found(doc)
+        except ValueError as exc:
+            raise ParseError(str(exc))
+
+        url = request.build_absolute_uri()
+        next_url, previous_url = None, None
+        if offset + limit < count:
+            next_url = replace_query_param(url, 'offset', offset + limit)
+        if offset > 0:
+            previous_url = replace_query_param(url, 'offset',
+                    max(offset - limit, 0))
+        return Response({
+            'count': count,
+            'next': next_url,
+            'previous': previous_url,
+            'value': value,
+        })
+
+    def retrieve_stream(self, request):
+        return StreamingHttpResponse(render_property_stream(self.get_object(),
+            self.kwargs['property'], settings.PROPERTY_STREAMING_BATCH_SIZE),
+            content_type='application/json')
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(PropertyDetail, self).finalize_response(request,
+                response, *args, **kwargs)
+        if self.cache_key is None:
+            return response
+        if response.status_code != 200:
+            property_cache.release(self.cache_key, self.cache_token)
+            return response
+        document_name = self.get_object().blob.name
+        if response.streaming:
+            response.streaming_content = property_cache.cache_stream(
+                    self.cache_key, document_name, response.streaming_content,
+                    self.cache_token)
+        else:
+            if isinstance(response, Response):
+                response.render()
+            property_cache.set(self.cache_key, document_name,
+                    response.content, self.cache_token)
+        return response
 
     def get_queryset(self):
         return Document.objects.filter(owner=self.request.user)
 
+    def get_etag_data(self, obj):
+        return u'{}|{}|{}'.format(obj.blob.name, self.kwargs['property'],
+                obj.analysis_version())
+
+    def get_last_modified(self, obj):
+        return obj.analysis_modified_at()
+
     def get_serializer_class(self, *args, **kwargs):
         prop = self.kwargs['property']
-        if prop == "all_data":
-            source = "properties"
-        else:
-            source = "properties.{}".format(self.kwargs['property'])
 
         class PropertySerializer(serializers.Serializer):
-            value = serializers.ReadOnlyField(source=source)
+            value = serializers.SerializerMethodField()
+
+            def get_value(self, obj):
+                if prop == "all_data":
+                    return obj.properties
+                # Only this result is fetched from MongoDB.
+                return obj.get_property(prop)
 
         return PropertySerializer
@@ -29,11 +29,13 @@ from rest_framework.views import APIView
 
 from pypln.web.core.models import Document
 from pypln.web.core.serializers import IndexedDocumentSerializer
+from pypln.web.core.throttling import BacklogAdmissionMixin
+from pypln.web.core.throttling import UploadRateThrottle
 from pypln.web.indexing.serializers import QuerySerializer
 from pypln.web.backend_adapter.pipelines import create_indexing_pipeline
 
 
-class IndexDocument(generics.CreateAPIView):
+class IndexDocument(BacklogAdmissionMixin, generics.CreateAPIView):
     """
     Create a new Document and runs the backend workers necessary to index it in
     elasticsearch. The index will be accessible by the index querying endpoint
@@ -51,6 +53,8 @@ class IndexDocument(generics.CreateAPIView):
     """
     serializer_class = IndexedDocumentSerializer
     permission_classes = (permissions.IsAuthenticated, )
+    throttle_classes = (UploadRateThrottle, )
+    throttle_scope = 'index_uploads'
 
     def perform_create(self, serializer):
         username = self.request.user.username
@@ -19,6 +19,16 @@
 
 PYPLN_HOME="/srv/pypln"
 NUM_WORKERS=8
+# Requests to the `events` endpoints wait for the analyses for up to 10
+# minutes (sleeping between reads of their status). With synchronous workers
+# each one would hold a worker process, so NUM_WORKERS clients waiting would
+# block every other request. Gevent workers serve up to WORKER_CONNECTIONS
+# requests each, switching between them while they sleep or wait for
+# MongoDB or the database (gunicorn patches the standard library for this).
+# Requests that use the CPU for long (rendering big properties) still delay
+# the other requests of the same worker.
+WORKER_CLASS="gevent"
+WORKER_CONNECTIONS=1000
 WSGI_HOST="127.0.0.1"
 WSGI_PORT="8000"
 ERRLOG="$PYPLN_HOME/logs/wsgi_server.err"
@@ -30,4 +40,4 @@ source "$PYPLN_HOME/project/bin/activate"
 # Supervisord is not passing $HOME to this script, and because of that we get
 # errors like trying to use "//.python-eggs" as PYTHON_EGG_CACHE
 export HOME=$PYPLN_HOME
-exec gunicorn -w $NUM_WORKERS -b $WSGI_HOST:$WSGI_PORT --error-logfile=$ERRLOG --access-logfile=$ACCESS_LOG pypln.web.wsgi:application
+exec gunicorn -w $NUM_WORKERS -k $WORKER_CLASS --worker-connections $WORKER_CONNECTIONS -b $WSGI_HOST:$WSGI_PORT --error-logfile=$ERRLOG --access-logfile=$ACCESS_LOG pypln.web.wsgi:application
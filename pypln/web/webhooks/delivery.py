@@ -0,0 +1,212 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import datetime
+import hashlib
+import hmac
+import httplib
+import json
+import socket
+import time
+import urlparse
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.utils import encoders
+
+from pypln.web.backend_adapter.models import PipelineRequest, new_request_key
+from pypln.web.backend_adapter.pipelines import DONE, FAILED
+from pypln.web.backend_adapter.pipelines import get_analysis_status
+from pypln.web.core.models import Corpus
+from pypln.web.webhooks.models import Webhook, WebhookDelivery
+from pypln.web.webhooks.serializers import is_public_address, resolve
+
+
+def sign(secret, timestamp, body):
+    """
+    Returns the signature of a notification: the HMAC-SHA256 of
+    `<timestamp>.<body>`, using the secret of the webhook as the key.
+    """
+    message = '{}.{}'.format(timestamp, body)
+    return hmac.new(secret.encode('utf-8'), message,
+            hashlib.sha256).hexdigest()
+
+def collect_notifications(batch_size=None):
+    """
+    Looks for sent pipeline requests of documents in corpora with active
+    webhooks whose analysis finished (is done or failed), `batch_size` at a
+    time, and creates a delivery for each webhook with the documents that
+    finished (so each delivery has at most `batch_size` documents). Requests
+    sent more than `WEBHOOK_NOTIFICATION_TIMEOUT` seconds ago are dropped
+    (their analysis is stuck), so each call only looks at recent requests.
+    Returns the number of finished requests.
+    """
+    batch_size = batch_size or settings.WEBHOOK_BATCH_SIZE
+    sent_after = timezone.now() - datetime.timedelta(
+            seconds=settings.WEBHOOK_NOTIFICATION_TIMEOUT)
+    candidates = PipelineRequest.objects.filter(
+            status=PipelineRequest.SENT, finished_at__isnull=True,
+            sent_at__gte=sent_after,
+            document__corpus__in=Corpus.objects.filter(
+                webhooks__active=True))
+    finished_count = 0
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            requests = list(candidates.filter(id__gt=last_id)
+                    .select_for_update().select_related('document')
+                    .order_by('id')[:batch_size])
+            if not requests:
+                break
+            last_id = requests[-1].id
+            statuses = get_analysis_status([request.document.blob.name for
+                request in requests])
+            finished = []
+            for request in requests:
+                state = statuses[request.document.blob.name]['state']
+                if state in (DONE, FAILED):
+                    finished.append((request, state))
+            if not finished:
+                continue
+
+            finished_at = timezone.now()
+            webhooks = Webhook.objects.filter(active=True,
+                    corpus__in=set(request.document.corpus_id for request, _
+                        in finished))
+            for webhook in webhooks:
+                # Analyses requested before the webhook was registered are
+                # not notified.
+                documents = [{
+                    'id': finished_request.document_id,
+                    'state': finished_state,
+                    'finished_at': finished_at,
+                } for finished_request, finished_state in finished
+                    if finished_request.document.corpus_id ==
+                    webhook.corpus_id and
+                    finished_request.created_at >= webhook.created_at]
+                if documents:
+                    WebhookDelivery.objects.create(webhook=webhook,
+                            payload=json.dumps({'corpus': webhook.corpus_id,
+                                'documents': documents},
+                                cls=encoders.JSONEncoder))
+            PipelineRequest.objects.filter(id__in=[finished_request.id for
+                finished_request, _ in finished]).update(
+                    finished_at=finished_at)
+            finished_count += len(finished)
+    return finished_count
+
+def claim_deliveries(batch_size):
+    """
+    Marks at most `batch_size` pending deliveries to active webhooks as
+    being sent by this sender, for `WEBHOOK_LEASE` seconds. Returns the
+    claimed deliveries.
+    """
+    now = timezone.now()
+    pending = WebhookDelivery.objects.filter(status=WebhookDelivery.PENDING,
+            next_attempt_at__lte=now, webhook__active=True)
+    ids = list(pending.order_by('id').values_list('id', flat=True)[
+        :batch_size])
+    claim = new_request_key()
+    WebhookDelivery.objects.filter(id__in=ids).update(claim=claim,
+            next_attempt_at=now + datetime.timedelta(
+                seconds=settings.WEBHOOK_LEASE))
+    return list(WebhookDelivery.objects.filter(claim=claim).select_related(
+        'webhook').order_by('id'))
+
+def pinned_connection(url, address, timeout):
+    """
+    Returns an HTTP(S) connection to the host of the (split) url that
+    connects to the given `address` instead of resolving the host again, so
+    the request goes to the address that was checked. The host is still used
+    in the `Host` header and to verify the certificate of https callbacks.
+    """
+    connection_class = httplib.HTTPSConnection if url.scheme == 'https' \
+            else httplib.HTTPConnection
+    connection = connection_class(url.hostname, url.port, timeout=timeout)
+    def create_connection(host_and_port, *args):
+        return socket.create_connection((address, host_and_port[1]), *args)
+    # `connect` (of both connection classes) opens the socket with
+    # `_create_connection`.
+    connection._create_connection = create_connection
+    return connection
+
+def deliver(delivery, timeout=None):
+    """
+    POSTs the payload of a delivery to its webhook. The request has the
+    `X-PyPLN-Timestamp` it was signed at and the `X-PyPLN-Signature` (see
+    `sign`). The host of the callback url is resolved and checked again for
+    every delivery (it may point somewhere else since the webhook was
+    registered), and the request is sent to the checked address. Raises an
+    exception if the host points to a private, loopback or reserved address
+    or if the webhook doesn't answer with a success status (redirects are not
+    followed).
+    """
+    url = urlparse.urlsplit(delivery.webhook.callback_url)
+    addresses = resolve(url.hostname)
+    if not addresses or not all(is_public_address(address) for address in
+            addresses):
+        raise ValueError("The callback url points to a private, loopback or "
+                "reserved address.")
+    connection = pinned_connection(url, sorted(addresses)[0],
+            timeout or settings.WEBHOOK_TIMEOUT)
+    body = delivery.payload.encode('utf-8')
+    timestamp = str(int(time.time()))
+    try:
+        connection.request('POST', urlparse.urlunsplit(('', '',
+            url.path or '/', url.query, '')), body, {
+            'Content-Type': 'application/json',
+            'User-Agent': 'PyPLN-Webhooks',
+            'X-PyPLN-Delivery': str(delivery.id),
+            'X-PyPLN-Timestamp': timestamp,
+            'X-PyPLN-Signature': 'sha256=' + sign(delivery.webhook.secret,
+                timestamp, body),
+        })
+        response = connection.getresponse()
+        response.read()
+    finally:
+        connection.close()
+    if not 200 <= response.status < 300:
+        raise httplib.HTTPException("HTTP Error {}: {}".format(
+            response.status, response.reason))
+
+def send_webhooks(batch_size=None):
+    """
+    Sends a batch of pending deliveries. Deliveries that fail are tried again
+    after `WEBHOOK_RETRY_DELAY` seconds (doubling at each attempt), up to
+    `WEBHOOK_MAX_ATTEMPTS` times. Returns the number of deliveries handled.
+    """
+    deliveries = claim_deliveries(batch_size or settings.WEBHOOK_BATCH_SIZE)
+    for delivery in deliveries:
+        try:
+            deliver(delivery)
+        except (httplib.HTTPException, socket.error, ValueError) as exc:
+            delivery.attempts += 1
+            delivery.last_error = '{}: {}'.format(type(exc).__name__, exc)
+            if delivery.attempts >= settings.WEBHOOK_MAX_ATTEMPTS:
+                delivery.status = WebhookDelivery.FAILED
+            else:
+                delay = settings.WEBHOOK_RETRY_DELAY * 2 ** (
+                        delivery.attempts - 1)
+                delivery.next_attempt_at = timezone.now() + \
+                        datetime.timedelta(seconds=delay)
+        else:
+            delivery.status = WebhookDelivery.SENT
+            delivery.sent_at = timezone.now()
+        delivery.save()
+    return len(deliveries)
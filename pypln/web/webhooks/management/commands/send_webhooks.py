@@ -0,0 +1,54 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from pypln.web.webhooks.delivery import collect_notifications, send_webhooks
+
+
+class Command(BaseCommand):
+    help = ("Notifies the webhooks of corpora whose documents finished "
+            "being analysed. Runs until it's interrupted, unless --once is "
+            "used.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', default=False,
+                help="Send the pending notifications and exit.")
+        parser.add_argument('--batch-size', type=int,
+                default=settings.WEBHOOK_BATCH_SIZE,
+                help="Number of documents per notification and of "
+                "notifications sent at a time.")
+        parser.add_argument('--interval', type=float, default=5,
+                help="Seconds to wait when there is nothing to send.")
+
+    def handle(self, *args, **options):
+        while True:
+            finished = collect_notifications(options['batch_size'])
+            if finished:
+                self.stdout.write("Found {} finished analyses.".format(
+                    finished))
+            sent = send_webhooks(options['batch_size'])
+            if sent:
+                self.stdout.write("Handled {} notifications.".format(sent))
+            elif options['once']:
+                break
+            else:
+                time.sleep(options['interval'])
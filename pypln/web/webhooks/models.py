@@ -0,0 +1,74 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import binascii
+import os
+
+from django.db import models
+from django.utils import timezone
+
+
+def new_secret():
+    return binascii.hexlify(os.urandom(20))
+
+
+class Webhook(models.Model):
+    """
+    A URL that is notified (see `pypln.web.webhooks.delivery`) when the
+    analyses of documents of a corpus finish. Notifications are signed with
+    the `secret`.
+    """
+    corpus = models.ForeignKey('core.Corpus', related_name='webhooks')
+    callback_url = models.URLField(max_length=1000)
+    secret = models.CharField(max_length=40, default=new_secret)
+    active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return u'{} ({})'.format(self.callback_url, self.corpus)
+
+
+class WebhookDelivery(models.Model):
+    """
+    A notification (the JSON `payload`, about one or more documents) that
+    must be sent to a webhook. `claim` identifies the sender that is
+    delivering it.
+    """
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    )
+
+    webhook = models.ForeignKey(Webhook, related_name='deliveries')
+    payload = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+            default=PENDING, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now,
+            db_index=True)
+    claim = models.CharField(max_length=32, blank=True, db_index=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return u'{} ({})'.format(self.webhook, self.status)
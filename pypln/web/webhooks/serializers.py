@@ -0,0 +1,110 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import binascii
+import socket
+import urlparse
+
+from rest_framework import serializers
+
+from pypln.web.core.models import Corpus
+from pypln.web.webhooks.models import Webhook
+
+# Addresses webhooks can't be sent to (private, loopback, link-local,
+# multicast and other reserved networks), so they can't be used to reach the
+# internal network of the server.
+BLOCKED_NETWORKS = [
+    (socket.AF_INET, '0.0.0.0', 8),
+    (socket.AF_INET, '10.0.0.0', 8),
+    (socket.AF_INET, '100.64.0.0', 10),
+    (socket.AF_INET, '127.0.0.0', 8),
+    (socket.AF_INET, '169.254.0.0', 16),
+    (socket.AF_INET, '172.16.0.0', 12),
+    (socket.AF_INET, '192.0.0.0', 24),
+    (socket.AF_INET, '192.168.0.0', 16),
+    (socket.AF_INET, '198.18.0.0', 15),
+    (socket.AF_INET, '224.0.0.0', 4),
+    (socket.AF_INET, '240.0.0.0', 4),
+    (socket.AF_INET6, '::', 127),
+    (socket.AF_INET6, 'fc00::', 7),
+    (socket.AF_INET6, 'fe80::', 10),
+    (socket.AF_INET6, 'ff00::', 8),
+]
+
+def _packed_bits(packed):
+    return int(binascii.hexlify(packed), 16)
+
+def is_public_address(address):
+    """
+    Returns False if the IP address (v4 or v6) is in one of the
+    `BLOCKED_NETWORKS`.
+    """
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    # Scoped IPv6 addresses end with the interface (`fe80::1%eth0`).
+    packed = socket.inet_pton(family, address.split('%')[0])
+    if family == socket.AF_INET6 and packed.startswith(
+            '\x00' * 10 + '\xff' * 2):
+        # IPv4 mapped address.
+        family, packed = socket.AF_INET, packed[12:]
+    size = len(packed) * 8
+    for network_family, network, prefix in BLOCKED_NETWORKS:
+        if network_family != family:
+            continue
+        network_bits = _packed_bits(socket.inet_pton(family, network))
+        if (_packed_bits(packed) >> (size - prefix) ==
+                network_bits >> (size - prefix)):
+            return False
+    return True
+
+def resolve(host):
+    """
+    Returns the IP addresses of a host name.
+    """
+    return set(info[4][0] for info in socket.getaddrinfo(host, None))
+
+
+class WebhookSerializer(serializers.HyperlinkedModelSerializer):
+    corpus = serializers.HyperlinkedRelatedField(view_name="corpus-detail",
+            queryset=Corpus.objects.all())
+    secret = serializers.ReadOnlyField()
+
+    def __init__(self, *args, **kwargs):
+        super(WebhookSerializer, self).__init__(*args, **kwargs)
+        if 'context' in kwargs:
+            user = kwargs['context']['request'].user
+            self.fields['corpus'].queryset = Corpus.objects.filter(owner=user)
+
+    def validate_callback_url(self, value):
+        url = urlparse.urlsplit(value)
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            raise serializers.ValidationError("Callback urls must use http "
+                    "or https.")
+        try:
+            addresses = resolve(url.hostname)
+        except socket.error:
+            raise serializers.ValidationError("The host of the callback url "
+                    "could not be found.")
+        if not all(is_public_address(address) for address in addresses):
+            raise serializers.ValidationError("Callback urls can't point to "
+                    "private, loopback or reserved addresses.")
+        return value
+
+    class Meta:
+        model = Webhook
+        fields = ('url', 'corpus', 'callback_url', 'secret', 'active',
+                'created_at')
@@ -0,0 +1,312 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+import BaseHTTPServer
+import datetime
+import json
+import socket
+import threading
+
+from bson import ObjectId
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
+from django.utils import timezone
+from mock import patch
+from rest_framework.reverse import reverse as rest_framework_reverse
+
+from pypln.web.backend_adapter.models import PipelineRequest
+from pypln.web.core.models import Corpus, Document, mongodb_storage
+from pypln.web.core.tests.utils import TestWithMongo
+from pypln.web.webhooks.delivery import collect_notifications, send_webhooks
+from pypln.web.webhooks.delivery import sign
+from pypln.web.webhooks.models import Webhook, WebhookDelivery
+
+__all__ = ["WebhookViewsTest", "CollectNotificationsTest",
+        "SendWebhooksTest"]
+
+
+class WebhookReceiver(BaseHTTPServer.HTTPServer):
+    """
+    Local HTTP server that records the requests it receives and answers them
+    with `status`.
+    """
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                WebhookRequestHandler)
+        self.status = 200
+        self.location = None
+        self.received = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/callback'.format(self.server_address[1])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class WebhookRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append((dict(self.headers.items()), body))
+        self.send_response(self.server.status)
+        if self.server.location:
+            self.send_header('Location', self.server.location)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class WebhookViewsTest(TestWithMongo):
+    fixtures = ['users', 'corpora', 'documents']
+
+    def setUp(self):
+        self.user = User.objects.get(username="user")
+        self.corpus = self.user.corpus_set.all()[0]
+
+    def test_requires_login(self):
+        response = self.client.get(reverse('webhook-list'))
+        self.assertEqual(response.status_code, 403)
+
+    def register(self, callback_url):
+        return self.client.post(reverse('webhook-list'), {
+            'corpus': rest_framework_reverse('corpus-detail',
+                kwargs={'pk': self.corpus.id}),
+            'callback_url': callback_url})
+
+    @patch('pypln.web.webhooks.serializers.resolve',
+            return_value={'93.184.216.34'})
+    def test_register_a_webhook(self, resolve):
+        self.client.login(username="user", password="user")
+        response = self.register('http://example.com/callback')
+        resolve.assert_called_with('example.com')
+        self.assertEqual(response.status_code, 201)
+        webhook = Webhook.objects.get()
+        self.assertEqual(webhook.corpus, self.corpus)
+        self.assertEqual(response.data['secret'], webhook.secret)
+
+    def test_callback_url_must_use_http(self):
+        self.client.login(username="user", password="user")
+        response = self.register('ftp://example.com/callback')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('callback_url', response.data)
+        self.assertFalse(Webhook.objects.exists())
+
+    @patch('pypln.web.webhooks.serializers.resolve')
+    def test_callback_url_cant_point_to_internal_addresses(self, resolve):
+        self.client.login(username="user", password="user")
+        for addresses in [{'127.0.0.1'}, {'10.0.0.5'}, {'169.254.169.254'},
+                {'::1'}, {'fd00::1'}, {'::ffff:192.168.0.1'},
+                {'93.184.216.34', '192.168.0.1'}]:
+            resolve.return_value = addresses
+            response = self.register('http://internal.example.com/')
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('callback_url', response.data)
+        self.assertFalse(Webhook.objects.exists())
+
+    @patch('pypln.web.webhooks.serializers.resolve',
+            side_effect=socket.gaierror)
+    def test_callback_url_must_resolve(self, resolve):
+        self.client.login(username="user", password="user")
+        response = self.register('http://inexistent.example.com/')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('callback_url', response.data)
+
+    def test_cant_register_a_webhook_for_another_users_corpus(self):
+        self.client.login(username="user", password="user")
+        corpus = Corpus.objects.filter(owner__username="admin")[0]
+        response = self.client.post(reverse('webhook-list'), {
+            'corpus': rest_framework_reverse('corpus-detail',
+                kwargs={'pk': corpus.id}),
+            'callback_url': 'http://example.com/callback'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Webhook.objects.exists())
+
+    def test_only_lists_webhooks_of_the_user(self):
+        Webhook.objects.create(corpus=self.corpus,
+                callback_url='http://example.com/user')
+        Webhook.objects.create(corpus=Corpus.objects.filter(
+            owner__username="admin")[0], callback_url='http://example.com/admin')
+        self.client.login(username="user", password="user")
+        response = self.client.get(reverse('webhook-list'))
+        self.assertEqual([webhook['callback_url'] for webhook in
+            response.data['results']], ['http://example.com/user'])
+
+
+class CollectNotificationsTest(TestWithMongo):
+    fixtures = ['users', 'corpora', 'documents']
+
+    def setUp(self):
+        self.document = Document.objects.filter(owner__username="user")[0]
+        self.webhook = Webhook.objects.create(corpus=self.document.corpus,
+                callback_url='http://example.com/callback')
+
+    def create_request(self):
+        return PipelineRequest.objects.create(document=self.document,
+                status=PipelineRequest.SENT, sent_at=timezone.now())
+
+    def test_creates_a_delivery_for_finished_analyses(self):
+        request = self.create_request()
+        self.assertEqual(collect_notifications(), 1)
+        delivery = WebhookDelivery.objects.get()
+        self.assertEqual(delivery.webhook, self.webhook)
+        payload = json.loads(delivery.payload)
+        self.assertEqual(payload['corpus'], self.document.corpus.id)
+        self.assertEqual([(document['id'], document['state']) for document
+            in payload['documents']], [(self.document.id, 'done')])
+        self.assertIsNotNone(PipelineRequest.objects.get(
+            id=request.id).finished_at)
+
+    def test_notifies_each_analysis_once(self):
+        self.create_request()
+        collect_notifications()
+        self.assertEqual(collect_notifications(), 0)
+        self.assertEqual(WebhookDelivery.objects.count(), 1)
+
+    def test_waits_for_the_analysis_to_finish(self):
+        mongodb_storage.collection.update(
+                {'_id': ObjectId(self.document.blob.name)},
+                {'$unset': {'freqdist': True}})
+        request = self.create_request()
+        self.assertEqual(collect_notifications(), 0)
+        self.assertFalse(WebhookDelivery.objects.exists())
+        self.assertIsNone(PipelineRequest.objects.get(
+            id=request.id).finished_at)
+
+    def test_ignores_corpora_without_active_webhooks(self):
+        self.webhook.active = False
+        self.webhook.save()
+        self.create_request()
+        self.assertEqual(collect_notifications(), 0)
+        self.assertFalse(WebhookDelivery.objects.exists())
+
+    def test_drops_requests_sent_before_the_timeout(self):
+        request = self.create_request()
+        request.sent_at -= datetime.timedelta(
+                seconds=settings.WEBHOOK_NOTIFICATION_TIMEOUT + 1)
+        request.save()
+        self.assertEqual(collect_notifications(), 0)
+        self.assertFalse(WebhookDelivery.objects.exists())
+
+    def test_ignores_requests_made_before_the_webhook_was_registered(self):
+        request = self.create_request()
+        self.webhook.created_at = request.created_at + \
+                datetime.timedelta(seconds=1)
+        self.webhook.save()
+        self.assertEqual(collect_notifications(), 1)
+        self.assertFalse(WebhookDelivery.objects.exists())
+
+
+class SendWebhooksTest(TestWithMongo):
+    fixtures = ['users', 'corpora']
+
+    def setUp(self):
+        self.receiver = WebhookReceiver()
+        self.addCleanup(self.receiver.stop)
+        # The receiver listens on a loopback address.
+        patcher = patch('pypln.web.webhooks.delivery.is_public_address',
+                return_value=True)
+        self.is_public_address = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.webhook = Webhook.objects.create(
+                corpus=Corpus.objects.filter(owner__username="user")[0],
+                callback_url=self.receiver.url)
+        self.payload = json.dumps({'corpus': self.webhook.corpus_id,
+            'documents': [{'id': 1, 'state': 'done'}, {'id': 2,
+                'state': 'failed'}]})
+        self.delivery = WebhookDelivery.objects.create(webhook=self.webhook,
+                payload=self.payload)
+
+    def test_posts_signed_notifications(self):
+        self.assertEqual(send_webhooks(), 1)
+        headers, body = self.receiver.received[0]
+        self.assertEqual(body, self.payload)
+        self.assertEqual(headers['content-type'], 'application/json')
+        self.assertEqual(headers['x-pypln-signature'], 'sha256=' + sign(
+            self.webhook.secret, headers['x-pypln-timestamp'], body))
+        delivery = WebhookDelivery.objects.get()
+        self.assertEqual(delivery.status, WebhookDelivery.SENT)
+        self.assertIsNotNone(delivery.sent_at)
+
+    def test_does_not_send_notifications_twice(self):
+        send_webhooks()
+        self.assertEqual(send_webhooks(), 0)
+        self.assertEqual(len(self.receiver.received), 1)
+
+    def test_retries_failed_notifications_later(self):
+        self.receiver.status = 500
+        self.assertEqual(send_webhooks(), 1)
+        delivery = WebhookDelivery.objects.get()
+        self.assertEqual(delivery.status, WebhookDelivery.PENDING)
+        self.assertEqual(delivery.attempts, 1)
+        self.assertIn('500', delivery.last_error)
+        # It's not sent again before the retry delay.
+        self.assertEqual(send_webhooks(), 0)
+
+    @override_settings(WEBHOOK_MAX_ATTEMPTS=1)
+    def test_gives_up_after_the_maximum_number_of_attempts(self):
+        self.receiver.status = 500
+        send_webhooks()
+        self.assertEqual(WebhookDelivery.objects.get().status,
+                WebhookDelivery.FAILED)
+
+    def test_does_not_notify_inactive_webhooks(self):
+        self.webhook.active = False
+        self.webhook.save()
+        self.assertEqual(send_webhooks(), 0)
+        self.assertEqual(self.receiver.received, [])
+
+    def test_does_not_send_notifications_to_private_addresses(self):
+        self.is_public_address.return_value = False
+        self.assertEqual(send_webhooks(), 1)
+        self.assertEqual(self.receiver.received, [])
+        delivery = WebhookDelivery.objects.get()
+        self.assertEqual(delivery.status, WebhookDelivery.PENDING)
+        self.assertIn('private', delivery.last_error)
+
+    @patch('pypln.web.webhooks.delivery.resolve',
+            return_value={'127.0.0.1'})
+    def test_sends_notifications_to_the_checked_address(self, resolve):
+        self.webhook.callback_url = \
+                'http://webhooks.example.com:{}/callback'.format(
+                        self.receiver.server_address[1])
+        self.webhook.save()
+        send_webhooks()
+        resolve.assert_called_with('webhooks.example.com')
+        self.is_public_address.assert_called_with('127.0.0.1')
+        headers, body = self.receiver.received[0]
+        self.assertEqual(headers['host'], 'webhooks.example.com:{}'.format(
+            self.receiver.server_address[1]))
+
+    def test_does_not_follow_redirects(self):
+        self.receiver.status = 302
+        self.receiver.location = 'http://169.254.169.254/'
+        send_webhooks()
+        self.assertEqual(len(self.receiver.received), 1)
+        delivery = WebhookDelivery.objects.get()
+        self.assertEqual(delivery.status, WebhookDelivery.PENDING)
+        self.assertIn('302', delivery.last_error)
@@ -0,0 +1,59 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright 2015 NAMD-EMAP-FGV
+#
+# This file is part of PyPLN. You can get more information at: http://pypln.org/.
+#
+# PyPLN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyPLN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyPLN.  If not, see <http://www.gnu.org/licenses/>.
+from rest_framework import generics
+from rest_framework import permissions
+
+from pypln.web.webhooks.models import Webhook
+from pypln.web.webhooks.serializers import WebhookSerializer
+
+
+class WebhookList(generics.ListCreateAPIView):
+    """
+    Lists the webhooks registered for your corpora.
+
+    `POST` requests register a new webhook. They should include:
+
+    - `corpus`: Fully qualified url of the corpus.
+    - `callback_url`: The url that will be notified.
+
+    When the analyses of documents of the corpus finish, the `callback_url`
+    receives a `POST` request with a JSON body like `{"corpus": 1,
+    "documents": [{"id": 2, "state": "done", "finished_at": "..."}]}` (one
+    request may list many documents). The request includes the headers
+    `X-PyPLN-Timestamp` and `X-PyPLN-Signature`: `sha256=` followed by the
+    hex HMAC-SHA256 of `<timestamp>.<body>` using the `secret` of the
+    webhook as the key. Requests that don't get a success response are
+    tried again later.
+    """
+    serializer_class = WebhookSerializer
+    permission_classes = (permissions.IsAuthenticated, )
+
+    def get_queryset(self):
+        return Webhook.objects.filter(corpus__owner=self.request.user)
+
+class WebhookDetail(generics.RetrieveUpdateDestroyAPIView):
+    """
+    Shows, edits or removes one of your webhooks. Inactive webhooks are not
+    notified.
+    """
+    serializer_class = WebhookSerializer
+    permission_classes = (permissions.IsAuthenticated, )
+
+    def get_queryset(self):
+        return Webhook.objects.filter(corpus__owner=self.request.user)